@@ -0,0 +1,3495 @@
+"""
+Sends Claude Code traces to Langfuse and/or Grafana Cloud after each response.
+
+Hook type: Stop (runs after each assistant response)
+Opt-in: Only runs when TRACE_TO_LANGFUSE=true and/or TRACE_TO_GRAFANA=true.
+
+Resilience: If backends are unavailable, traces are queued locally and
+automatically drained on the next successful connection.
+
+This is the body of the hook; langfuse_hook.py is the script Claude Code runs.
+Being imported rather than run as a script, this module is compiled once and
+loaded from __pycache__ afterwards, which keeps it off the no-op path's cost.
+"""
+
+import atexit
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import queue
+import signal
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from importlib.util import find_spec
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Iterable, Iterator
+
+if TYPE_CHECKING:
+    import logging
+    import sqlite3
+
+    import requests
+    from langfuse import Langfuse
+    from opentelemetry import trace as otel_trace
+
+# Backend packages (and heavier stdlib modules such as urllib.request, sqlite3,
+# logging) are imported where they are used, so a run with nothing to export
+# never loads them. Availability is checked only once a backend is enabled.
+OTEL_MODULES = ("opentelemetry.sdk", "opentelemetry.exporter.otlp.proto.http", "requests")
+
+
+def _module_available(name: str) -> bool:
+    """Whether a module can be imported, without importing it (parent packages excepted)."""
+    if name in sys.modules:
+        return True
+    try:
+        return find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+# Configuration
+LOG_FILE = Path.home() / ".claude" / "state" / "langfuse_hook.log"
+LOG_BUFFER_BYTES = 64 * 1024  # buffered log lines are written out past this size (and at exit)
+LOG_ROTATE_BYTES = 50 * 1024 * 1024  # the log is renamed to langfuse_hook.log.1 past this size
+LOG_KEEP_ROTATED = 2  # rotated segments kept (langfuse_hook.log.1, .2)
+STATE_FILE = Path.home() / ".claude" / "state" / "langfuse_state.json"
+QUEUE_FILE = Path.home() / ".claude" / "state" / "pending_traces.jsonl"  # legacy single-file queue
+QUEUE_DIR = Path.home() / ".claude" / "state" / "pending_traces"
+INDEX_FILE = Path.home() / ".claude" / "state" / "transcript_index.json"
+STATE_DB = Path.home() / ".claude" / "state" / "langfuse_state.db"
+LOCK_FILE = Path.home() / ".claude" / "state" / "langfuse_hook.lock"
+DIRTY_FILE = Path.home() / ".claude" / "state" / "dirty_transcripts.jsonl"
+METRICS_FILE = Path.home() / ".claude" / "state" / "hook_metrics.jsonl"  # one JSON record per run
+DAEMON_SOCKET = Path.home() / ".claude" / "state" / "langfuse_hook.sock"
+DAEMON_CLIENT_TIMEOUT = 0.5  # seconds the Stop hook waits for the daemon before running in-process
+# Record the payload and export from a detached background process instead of inside the Stop hook
+DETACH = os.environ.get("CC_LANGFUSE_DETACH", "").lower() == "true"
+PROJECTS_DIR = Path.home() / ".claude" / "projects"
+DEBUG = os.environ.get("CC_LANGFUSE_DEBUG", "").lower() == "true"
+# "json" keeps session state in langfuse_state.json and the queue in segment files; "sqlite" keeps both in STATE_DB
+STATE_BACKEND = os.environ.get("CC_LANGFUSE_STATE_BACKEND", "json").lower()
+HEALTH_CHECK_TIMEOUT = 2  # seconds
+# Circuit breaker: after a failed health check the backend isn't probed again for
+# BREAKER_BASE_SECONDS, doubling per consecutive failure up to BREAKER_MAX_SECONDS
+BREAKER_BASE_SECONDS = 30
+BREAKER_MAX_SECONDS = 15 * 60
+# "sdk" exports through the Langfuse SDK, "ingestion" posts batches to the public ingestion API
+LANGFUSE_EXPORTER = os.environ.get("CC_LANGFUSE_EXPORTER", "sdk").lower()
+INGESTION_BATCH_BYTES = 3 * 1024 * 1024  # stay under the ingestion API's 3.5 MB request limit
+# OTLP batching: hold everything for the run and ship it in large gzip'd requests at the final flush
+OTLP_MAX_QUEUE_SIZE = 65536
+OTLP_MAX_EXPORT_BATCH_SIZE = 512
+OTLP_SCHEDULE_DELAY_MS = 60_000
+QUEUE_SEGMENT_BYTES = 8 * 1024 * 1024  # a new queue segment is started past this size
+QUEUE_ACK_EVERY = 500  # queued traces drained between read-offset commits
+BACKEND_QUEUE_SIZE = 256  # turns buffered per backend worker before the producer waits
+# Full discovery sweep cadence when the Stop payload names the transcript
+SWEEP_EVERY_RUNS = int(os.environ.get("CC_LANGFUSE_SWEEP_EVERY_RUNS", "20"))
+SWEEP_INTERVAL_MINUTES = float(os.environ.get("CC_LANGFUSE_SWEEP_MINUTES", "10"))
+RUN_BUDGET_SECONDS = float(os.environ.get("CC_LANGFUSE_BUDGET_SECONDS", "30"))  # wall clock per run, 0 = no limit
+FLUSH_GRACE_SECONDS = 5.0  # past the run budget, time the backends get to send the turns they were handed
+CHECKPOINT_SECONDS = 1.0  # seconds between session state checkpoints while a transcript is exported
+BACKFILL_RATE = float(os.environ.get("CC_LANGFUSE_BACKFILL_RATE", "200"))  # turns/s across all backfill workers, 0 = no limit
+BACKFILL_SHARD_BYTES = 16 * 1024 * 1024  # unexported transcript bytes handed to a backfill worker at a time
+FINGERPRINT_BYTES = 64  # bytes before the resume offset hashed to detect rewritten transcripts
+TURN_IDLE_SECONDS = 60  # a transcript untouched this long has no response still streaming
+END_STOP_REASONS = ("end_turn", "stop_sequence", "max_tokens")
+
+
+_log_buffer: list[str] = []
+_log_buffer_bytes = 0
+_log_lock = threading.Lock()
+_log_timestamp = (0, "")  # (second, formatted) of the last timestamp, formatted once per second
+
+
+def log(level: str, message: str) -> None:
+    """Log a message to the log file.
+
+    Lines are buffered in memory and written by flush_log(): at exit, once the
+    buffer reaches LOG_BUFFER_BYTES, and after each run of a long-lived process.
+    """
+    global _log_buffer_bytes, _log_timestamp
+    second = int(time.time())
+    if second != _log_timestamp[0]:
+        _log_timestamp = (second, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second)))
+    line = f"{_log_timestamp[1]} [{level}] {message}\n"
+    with _log_lock:
+        _log_buffer.append(line)
+        _log_buffer_bytes += len(line)
+        full = _log_buffer_bytes >= LOG_BUFFER_BYTES
+    if full:
+        flush_log()
+
+
+def flush_log() -> None:
+    """Append the buffered log lines to LOG_FILE in one write, rotating it first if it is full.
+
+    Rotation renames langfuse_hook.log to .log.1 (and .1 to .2, ...), keeping
+    LOG_KEEP_ROTATED old segments, so nothing is ever read back in.
+    """
+    global _log_buffer_bytes
+    with _log_lock:
+        if not _log_buffer:
+            return
+        data = "".join(_log_buffer)
+        _log_buffer.clear()
+        _log_buffer_bytes = 0
+        try:
+            try:
+                size = LOG_FILE.stat().st_size
+            except FileNotFoundError:
+                LOG_FILE.parent.mkdir(parents=True, exist_ok=True)
+                size = 0
+            if size and size + len(data) > LOG_ROTATE_BYTES:
+                for n in range(LOG_KEEP_ROTATED - 1, 0, -1):
+                    older = LOG_FILE.with_name(f"{LOG_FILE.name}.{n}")
+                    if older.exists():
+                        older.replace(LOG_FILE.with_name(f"{LOG_FILE.name}.{n + 1}"))
+                LOG_FILE.replace(LOG_FILE.with_name(f"{LOG_FILE.name}.1"))
+            with open(LOG_FILE, "a") as f:
+                f.write(data)
+        except OSError:
+            pass  # never block hook execution
+
+
+def _reset_log_after_fork() -> None:
+    # The child starts with an empty buffer (the parent flushed before forking) and a fresh lock
+    global _log_lock, _log_buffer_bytes
+    _log_lock = threading.Lock()
+    _log_buffer.clear()
+    _log_buffer_bytes = 0
+
+
+atexit.register(flush_log)
+os.register_at_fork(before=flush_log, after_in_child=_reset_log_after_fork)
+
+
+def debug(message: str) -> None:
+    """Log a debug message (only if DEBUG is enabled)."""
+    if DEBUG:
+        log("DEBUG", message)
+
+
+def check_langfuse_health(host: str) -> bool:
+    """Quick health check to see if Langfuse is reachable.
+
+    Uses socket connection to avoid slow HTTP timeouts.
+    """
+    try:
+        # Parse host to get hostname and port
+        if host.startswith("http://"):
+            host_part = host[7:]
+            default_port = 80
+        elif host.startswith("https://"):
+            host_part = host[8:]
+            default_port = 443
+        else:
+            host_part = host
+            default_port = 443
+
+        # Strip path component (e.g. /otlp from gateway URLs)
+        host_part = host_part.split("/")[0]
+
+        if ":" in host_part:
+            hostname, port_str = host_part.split(":", 1)
+            port = int(port_str)
+        else:
+            hostname = host_part
+            port = default_port
+
+        import socket
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(HEALTH_CHECK_TIMEOUT)
+        result = sock.connect_ex((hostname, port))
+        sock.close()
+
+        is_healthy = result == 0
+        debug(f"Health check for {hostname}:{port} - {'OK' if is_healthy else 'FAILED'}")
+        return is_healthy
+    except Exception as e:
+        debug(f"Health check error: {e}")
+        return False
+
+
+def backend_reachable(index: dict, backend: str, url: str) -> bool:
+    """Health check behind a circuit breaker persisted in the transcript index.
+
+    While the breaker is open (a recent probe failed) the backend is reported down
+    without probing, so an outage costs nothing per run. Once retry_at passes, one
+    half-open probe decides: success closes the breaker, failure reopens it with
+    the backoff doubled.
+    """
+    breakers = index.setdefault("backends", {})
+    breaker = breakers.get(backend)
+    now = time.time()
+    if breaker and now < breaker.get("retry_at", 0):
+        debug(f"{backend} circuit open, next probe in {breaker['retry_at'] - now:.0f}s")
+        return False
+
+    if check_langfuse_health(url):
+        if breaker:
+            log("INFO", f"{backend} reachable again after {breaker.get('failures', 0)} failed probes")
+        breakers.pop(backend, None)
+        return True
+
+    failures = (breaker or {}).get("failures", 0) + 1
+    delay = min(BREAKER_BASE_SECONDS * 2 ** (failures - 1), BREAKER_MAX_SECONDS)
+    breakers[backend] = {"failures": failures, "retry_at": now + delay}
+    log("WARN", f"{backend} unavailable at {url}, skipping health checks for {delay:.0f}s")
+    return False
+
+
+class SegmentedQueue:
+    """Append-only on-disk queue: fixed-size JSONL segment files plus committed read offsets.
+
+    Entries are appended to the newest segment (00000001.jsonl, ...); once it
+    reaches segment_bytes the next append starts a new one. Each consumer (backend)
+    has its own ack-<backend>.json holding the {segment, offset} up to which
+    entries have been delivered to it; ack.json is the shared offset of older
+    versions and the starting point of a consumer without a file of its own. A
+    drain streams entries from the earliest offset and commits offsets in batches,
+    so an interrupted drain resumes where it stopped. Nothing is rewritten:
+    segments entirely behind every consumer's offset are deleted, and the rest are
+    left untouched.
+    """
+
+    def __init__(self, directory: Path, segment_bytes: int = QUEUE_SEGMENT_BYTES, consumers: Iterable[str] = ("all",)):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.consumers = tuple(consumers)
+
+    def _segment_path(self, number: int) -> Path:
+        return self.directory / f"{number:08d}.jsonl"
+
+    def _ack_file(self, consumer: str) -> Path:
+        return self.directory / ("ack.json" if consumer == "all" else f"ack-{consumer}.json")
+
+    def segments(self) -> list[int]:
+        """Segment numbers present on disk, oldest first."""
+        if not self.directory.exists():
+            return []
+        return sorted(int(p.stem) for p in self.directory.glob("*.jsonl") if p.stem.isdigit())
+
+    def committed(self, consumer: str = "all") -> tuple[int, int]:
+        """The (segment, offset) position everything before which has been delivered to consumer."""
+        try:
+            ack = json.loads(self._ack_file(consumer).read_text())
+            return int(ack["segment"]), int(ack["offset"])
+        except FileNotFoundError:
+            return self.committed("all") if consumer != "all" else (0, 0)
+        except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+            return 0, 0
+
+    def tail(self) -> tuple[int, int]:
+        """The position just past the last entry appended so far."""
+        segments = self.segments()
+        if not segments:
+            return 0, 0
+        try:
+            return segments[-1], self._segment_path(segments[-1]).stat().st_size
+        except FileNotFoundError:
+            return 0, 0
+
+    def append(self, entry: dict) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        segments = self.segments()
+        number = segments[-1] if segments else 1
+        path = self._segment_path(number)
+        if path.exists() and path.stat().st_size >= self.segment_bytes:
+            path = self._segment_path(number + 1)
+        data = (json.dumps(entry) + "\n").encode()
+        with open(path, "a+b") as f:
+            size = f.seek(0, os.SEEK_END)
+            if size:
+                # A crash mid-append leaves a torn last line; don't glue this entry onto it
+                f.seek(size - 1)
+                if f.read(1) != b"\n":
+                    data = b"\n" + data
+            f.write(data)
+
+    def entries(self) -> Iterator[tuple[dict, tuple[int, int]]]:
+        """Stream entries not yet delivered to every consumer, with the position just past each one."""
+        ack_segment, ack_offset = min(self.committed(consumer) for consumer in self.consumers)
+        for number in self.segments():
+            if number < ack_segment:
+                continue
+            offset = ack_offset if number == ack_segment else 0
+            try:
+                f = open(self._segment_path(number), "rb")
+            except FileNotFoundError:
+                continue
+            with f:
+                f.seek(offset)
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # torn or still being written
+                    offset += len(line)
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError as e:
+                        log("ERROR", f"Skipping corrupt queue entry in segment {number}: {e}")
+                        continue
+                    yield entry, (number, offset)
+
+    def ack(self, position: tuple[int, int], consumers: Iterable[str] | None = None) -> None:
+        """Commit position for consumers (default: all of them) and delete segments every consumer is past."""
+        for consumer in consumers or self.consumers:
+            if self.committed(consumer) >= tuple(position):
+                continue
+            ack_file = self._ack_file(consumer)
+            tmp = ack_file.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"segment": position[0], "offset": position[1]}))
+            tmp.replace(ack_file)
+
+        segment, offset = min(self.committed(consumer) for consumer in self.consumers)
+        segments = self.segments()
+        if segments and segment == segments[-1] and offset >= self._segment_path(segment).stat().st_size:
+            # Everything delivered: drop the whole queue rather than keep an empty tail segment
+            for number in segments:
+                self._segment_path(number).unlink(missing_ok=True)
+            for ack_file in self.directory.glob("ack*.json"):
+                ack_file.unlink(missing_ok=True)
+            return
+        for number in segments:
+            if number < segment:
+                self._segment_path(number).unlink(missing_ok=True)
+
+
+class SqliteQueue:
+    """The pending turn queue in the SQLite state store, with the same interface as SegmentedQueue.
+
+    Entries are rows of pending_turns; a position is a row id. Each consumer's
+    committed position is its row in deliveries (the "all" row is the starting
+    point of a consumer without one), and rows every consumer has acknowledged
+    are deleted.
+    """
+
+    def __init__(self, conn: "sqlite3.Connection", consumers: Iterable[str] = ("all",), page_size: int = QUEUE_ACK_EVERY):
+        self.conn = conn
+        self.consumers = tuple(consumers)
+        self.page_size = page_size
+
+    def committed(self, consumer: str = "all") -> int:
+        row = self.conn.execute("SELECT acked_id FROM deliveries WHERE backend = ?", (consumer,)).fetchone()
+        if row:
+            return row[0]
+        return self.committed("all") if consumer != "all" else 0
+
+    def tail(self) -> int:
+        return self.conn.execute("SELECT COALESCE(MAX(id), 0) FROM pending_turns").fetchone()[0]
+
+    def append(self, entry: dict) -> None:
+        self.conn.execute(
+            "INSERT INTO pending_turns (session_id, entry, queued_at) VALUES (?, ?, ?)",
+            (entry.get("session_id"), json.dumps(entry), entry.get("queued_at") or datetime.now(timezone.utc).isoformat()),
+        )
+
+    def entries(self) -> Iterator[tuple[dict, int]]:
+        """Stream entries not yet delivered to every consumer a page at a time, each with its row id."""
+        last_id = min(self.committed(consumer) for consumer in self.consumers)
+        while True:
+            rows = self.conn.execute(
+                "SELECT id, entry FROM pending_turns WHERE id > ? ORDER BY id LIMIT ?", (last_id, self.page_size),
+            ).fetchall()
+            if not rows:
+                return
+            for last_id, entry in rows:
+                yield json.loads(entry), last_id
+
+    def ack(self, position: int, consumers: Iterable[str] | None = None) -> None:
+        """Commit position for consumers (default: all of them) and delete rows every consumer has acknowledged."""
+        with self.conn:
+            self.conn.execute("BEGIN")
+            for consumer in consumers or self.consumers:
+                self.conn.execute(
+                    "INSERT INTO deliveries (backend, acked_id, updated) VALUES (?, ?, ?) "
+                    "ON CONFLICT (backend) DO UPDATE SET acked_id = MAX(acked_id, excluded.acked_id), updated = excluded.updated",
+                    (consumer, position, datetime.now(timezone.utc).isoformat()),
+                )
+            low = min(self.committed(consumer) for consumer in self.consumers)
+            self.conn.execute("DELETE FROM pending_turns WHERE id <= ?", (low,))
+
+
+def pending_queue(consumers: Iterable[str] = ("all",)) -> SegmentedQueue | SqliteQueue:
+    """The local queue of turns waiting for the consumer backends, migrating any older queue into it."""
+    if STATE_BACKEND == "sqlite":
+        pending = SqliteQueue(state_db(), consumers)
+        segmented = SegmentedQueue(QUEUE_DIR, consumers=consumers)
+        if segmented.segments():
+            position = None
+            for entry, position in segmented.entries():
+                pending.append(entry)
+            if position:
+                segmented.ack(position)
+                log("INFO", f"Migrated queued traces from {QUEUE_DIR.name}/ to {STATE_DB.name}")
+    else:
+        pending = SegmentedQueue(QUEUE_DIR, consumers=consumers)
+    if QUEUE_FILE.exists():
+        migrated = 0
+        with open(QUEUE_FILE, "rb") as f:
+            for line in f:
+                try:
+                    pending.append(json.loads(line))
+                    migrated += 1
+                except json.JSONDecodeError:
+                    continue
+        QUEUE_FILE.unlink()
+        log("INFO", f"Migrated {migrated} queued traces from {QUEUE_FILE.name} to {QUEUE_DIR.name}/")
+    return pending
+
+
+def queue_trace(trace_data: dict) -> None:
+    """Append a trace to the local queue."""
+    trace_data["queued_at"] = datetime.now(timezone.utc).isoformat()
+    pending_queue().append(trace_data)
+    debug(f"Queued trace for session {trace_data.get('session_id', 'unknown')}, turn {trace_data.get('turn_num', '?')}")
+
+
+def owed_to(entry: dict, backend: str) -> bool:
+    """Whether a queue entry still has to be delivered to backend (older entries are owed to all)."""
+    return backend in entry.get("backends", [backend])
+
+
+def drain_queue(trace_creators: list, sync=None, budget: "RunBudget | None" = None, consumers: Iterable[str] | None = None) -> int:
+    """Stream queued traces to the backends that are owed them. Returns count of drained traces.
+
+    trace_creators are (backend, fn) pairs for the backends available now; each
+    has its own committed read offset, so an entry goes only to the backends it
+    is owed to that haven't acknowledged it yet, and the offsets of backends that
+    are down stay where they are. consumers are all enabled backends (default:
+    the creators); the queue is trimmed only past what every one of them has.
+
+    Offsets are committed every QUEUE_ACK_EVERY entries and at the end, after
+    sync() (if given) has flushed the backends, so a drain interrupted midway resumes
+    from the last commit instead of starting over. Entries queued while draining
+    are left for the next drain. Draining stops when the run budget is spent; the
+    rest stays queued for the next run.
+    """
+    backends = [name for name, _ in trace_creators]
+    if not backends:
+        return 0
+    pending = pending_queue(consumers or backends)
+    committed = {name: pending.committed(name) for name in backends}
+    tail = pending.tail()
+    drained = 0
+    position = None
+    for trace_data, next_position in pending.entries():
+        if next_position > tail:
+            break
+        if budget is not None and budget.expired():
+            log("INFO", "Run budget spent, leaving the rest of the queue for the next run")
+            break
+        position = next_position
+        targets = [(name, fn) for name, fn in trace_creators
+                   if position > committed[name] and owed_to(trace_data, name)]
+        if not targets:
+            continue
+        if drained == 0:
+            log("INFO", "Draining queued traces")
+        try:
+            turn = turn_from_queue_entry(trace_data)
+        except Exception as e:
+            log("ERROR", f"Skipping queued trace: {e}")
+            continue
+        for creator_name, creator_fn in targets:
+            try:
+                creator_fn(turn)
+            except Exception as e:
+                log("ERROR", f"Failed to drain trace to {creator_name}: {e}")
+        drained += 1
+        if drained % QUEUE_ACK_EVERY == 0:
+            if sync:
+                sync()
+            pending.ack(position, backends)
+
+    if position is None:
+        return 0
+    if sync:
+        sync()
+    pending.ack(position, backends)
+    if drained:
+        log("INFO", f"Successfully drained {drained} traces")
+    return drained
+
+
+STATE_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    data TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated);
+CREATE TABLE IF NOT EXISTS pending_turns (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT,
+    entry TEXT NOT NULL,
+    queued_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pending_turns_queued_at ON pending_turns (queued_at);
+CREATE TABLE IF NOT EXISTS deliveries (
+    backend TEXT PRIMARY KEY,
+    acked_id INTEGER NOT NULL,
+    updated TEXT NOT NULL
+);
+"""
+
+_state_db_connections: dict = {}  # STATE_DB path -> sqlite3.Connection
+
+
+def state_db() -> "sqlite3.Connection":
+    """Open (once per process) the SQLite state store in WAL mode, migrating langfuse_state.json into it."""
+    conn = _state_db_connections.get(STATE_DB)
+    if conn is not None:
+        return conn
+    import sqlite3
+
+    STATE_DB.parent.mkdir(parents=True, exist_ok=True)
+    # Autocommit; multi-statement updates use explicit transactions
+    conn = sqlite3.connect(STATE_DB, timeout=10, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(STATE_DB_SCHEMA)
+    _state_db_connections[STATE_DB] = conn
+
+    if STATE_FILE.exists() and not conn.execute("SELECT 1 FROM sessions LIMIT 1").fetchone():
+        try:
+            legacy = json.loads(STATE_FILE.read_text())
+        except (json.JSONDecodeError, IOError):
+            legacy = {}
+        with conn:
+            conn.execute("BEGIN")
+            for session_id, session_state in legacy.items():
+                upsert_session(conn, session_id, session_state)
+        log("INFO", f"Migrated {len(legacy)} sessions from {STATE_FILE.name} to {STATE_DB.name}")
+    return conn
+
+
+def upsert_session(conn: "sqlite3.Connection", session_id: str, session_state: dict) -> None:
+    conn.execute(
+        "INSERT INTO sessions (session_id, data, updated) VALUES (?, ?, ?) "
+        "ON CONFLICT (session_id) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+        (session_id, json.dumps(session_state), session_state.get("updated") or datetime.now(timezone.utc).isoformat()),
+    )
+
+
+def load_state() -> dict:
+    """Load the state file containing session tracking info."""
+    if STATE_BACKEND == "sqlite":
+        rows = state_db().execute("SELECT session_id, data FROM sessions")
+        return {session_id: json.loads(data) for session_id, data in rows}
+    if not STATE_FILE.exists():
+        return {}
+    try:
+        return json.loads(STATE_FILE.read_text())
+    except (json.JSONDecodeError, IOError):
+        return {}
+
+
+def save_state(state: dict) -> None:
+    """Save the state file."""
+    if STATE_BACKEND == "sqlite":
+        conn = state_db()
+        with conn:
+            conn.execute("BEGIN")
+            for session_id, session_state in state.items():
+                upsert_session(conn, session_id, session_state)
+        return
+    # Written aside and renamed over the old file, so a run killed mid-write keeps every session's offset
+    STATE_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = STATE_FILE.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(state, indent=2))
+    tmp_file.replace(STATE_FILE)
+
+
+def save_session(state: dict, session_id: str) -> None:
+    """Persist one session's state: a single-row upsert with SQLite, a full state file rewrite otherwise."""
+    if STATE_BACKEND == "sqlite":
+        upsert_session(state_db(), session_id, state[session_id])
+        return
+    save_state(state)
+
+
+def save_sessions(state: dict, session_ids: Iterable[str]) -> None:
+    """Persist several sessions' state: upserts in one transaction with SQLite, a single state file rewrite otherwise."""
+    if STATE_BACKEND == "sqlite":
+        conn = state_db()
+        with conn:
+            conn.execute("BEGIN")
+            for session_id in session_ids:
+                upsert_session(conn, session_id, state[session_id])
+        return
+    save_state(state)
+
+
+def load_index() -> dict:
+    """Load the transcript index (path -> cached stat signature and session ID).
+
+    Each entry under "files" holds the inode, session_id, and the size/mtime_ns
+    signature and byte offset recorded the last time the transcript was processed.
+    "sweep" schedules the full discovery sweep; "backends" holds circuit breaker state.
+    """
+    if not INDEX_FILE.exists():
+        return {"files": {}}
+    try:
+        index = json.loads(INDEX_FILE.read_text())
+    except (json.JSONDecodeError, IOError):
+        return {"files": {}}
+    if not isinstance(index, dict) or not isinstance(index.get("files"), dict):
+        return {"files": {}}
+    return index
+
+
+def save_index(index: dict) -> None:
+    """Save the transcript index (compact, it grows with the number of transcripts)."""
+    INDEX_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = INDEX_FILE.with_suffix(".tmp")
+    tmp_file.write_text(json.dumps(index, separators=(",", ":")))
+    tmp_file.replace(INDEX_FILE)
+
+
+def read_session_id(transcript_file: Path) -> str:
+    """Read the session ID from the first line of a transcript without loading the rest."""
+    with open(transcript_file, "rb") as f:
+        first_line = f.readline()
+    first_msg = json.loads(first_line)
+    return first_msg.get("sessionId", transcript_file.stem)
+
+
+def mark_transcript_processed(index: dict, transcript_file: Path, offset: int | None = None) -> None:
+    """Record that a transcript has been processed up to the signature seen at discovery.
+
+    The signature is the one stat'ed before the transcript was read, so bytes appended
+    while it was being processed still show up as a change on the next run.
+    """
+    entry = index["files"].get(str(transcript_file))
+    if not entry or "seen" not in entry:
+        return
+    entry["size"], entry["mtime_ns"] = entry.pop("seen")
+    entry["offset"] = entry["size"] if offset is None else offset
+    entry.pop("pending_since", None)
+
+
+def transcript_fingerprint(f, offset: int) -> str:
+    """Hash the FINGERPRINT_BYTES bytes just before offset in an open binary file."""
+    start = max(0, offset - FINGERPRINT_BYTES)
+    f.seek(start)
+    return hashlib.sha1(f.read(offset - start)).hexdigest()
+
+
+def resume_offset(f, session_state: dict) -> int:
+    """Find the byte offset to resume reading an open transcript from.
+
+    Verifies the stored fingerprint so a transcript that was truncated or rewritten
+    is re-read from the start instead of resuming mid-line. State written before
+    byte offsets existed only has "last_line"; it is converted once by counting lines.
+    """
+    if "offset" in session_state:
+        offset = session_state["offset"]
+        size = f.seek(0, os.SEEK_END)
+        if offset > size or transcript_fingerprint(f, offset) != session_state.get("fingerprint"):
+            log("WARN", f"Transcript changed before offset {offset}, re-reading from start")
+            return 0
+        return offset
+
+    last_line = session_state.get("last_line", 0)
+    f.seek(0)
+    for _ in range(last_line):
+        if not f.readline():
+            break
+    return f.tell()
+
+
+class TranscriptReader:
+    """Streams the complete lines appended to an open transcript since the stored offset.
+
+    Reading starts at the resume offset, so only appended bytes are touched. An
+    incomplete trailing line (still being written) is held back for the next run.
+    `offset` always points just past the last line handed out, `line_start` at its
+    beginning.
+    """
+
+    def __init__(self, f, session_state: dict):
+        self._f = f
+        self.start_offset = resume_offset(f, session_state)
+        self.offset = self.start_offset
+        self.line_start = self.start_offset
+
+    def lines(self) -> Iterator[bytes]:
+        """Yield complete lines one at a time (buffered reads, never the whole file)."""
+        self._f.seek(self.offset)
+        for line in self._f:
+            if not line.endswith(b"\n"):
+                break
+            self.line_start = self.offset
+            self.offset += len(line)
+            yield line
+
+    def fingerprint(self) -> str:
+        """Fingerprint at the current offset; safe to call between lines."""
+        position = self._f.tell()
+        fingerprint = transcript_fingerprint(self._f, self.offset)
+        self._f.seek(position)
+        return fingerprint
+
+
+def decode_message(line: bytes) -> dict | None:
+    """Decode one transcript line into a message dict; None for a blank or malformed line."""
+    if not line.strip():
+        return None
+    try:
+        return json.loads(line)
+    except json.JSONDecodeError:
+        return None
+
+
+def decode_messages(lines: Iterable[bytes]) -> Iterator[dict]:
+    """Decode transcript lines into message dicts, skipping blank and malformed lines."""
+    for line in lines:
+        msg = decode_message(line)
+        if msg is not None:
+            yield msg
+
+
+def get_content(msg: dict) -> Any:
+    """Extract content from a message."""
+    if isinstance(msg, dict):
+        if "message" in msg:
+            return msg["message"].get("content")
+        return msg.get("content")
+    return None
+
+
+def is_tool_result(msg: dict) -> bool:
+    """Check if a message contains tool results."""
+    content = get_content(msg)
+    if isinstance(content, list):
+        return any(
+            isinstance(item, dict) and item.get("type") == "tool_result"
+            for item in content
+        )
+    return False
+
+
+def get_tool_calls(msg: dict) -> list:
+    """Extract tool use blocks from a message."""
+    content = get_content(msg)
+    if isinstance(content, list):
+        return [
+            item for item in content
+            if isinstance(item, dict) and item.get("type") == "tool_use"
+        ]
+    return []
+
+
+def get_text_content(msg: dict) -> str:
+    """Extract text content from a message."""
+    content = get_content(msg)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        text_parts = []
+        for item in content:
+            if isinstance(item, dict) and item.get("type") == "text":
+                text_parts.append(item.get("text", ""))
+            elif isinstance(item, str):
+                text_parts.append(item)
+        return "\n".join(text_parts)
+    return ""
+
+
+def merge_assistant_parts(parts: list) -> dict:
+    """Merge multiple assistant message parts into one."""
+    if not parts:
+        return {}
+
+    merged_content = []
+    for part in parts:
+        content = get_content(part)
+        if isinstance(content, list):
+            merged_content.extend(content)
+        elif content:
+            merged_content.append({"type": "text", "text": str(content)})
+
+    # Use the structure from the first part
+    result = parts[0].copy()
+    if "message" in result:
+        result["message"] = result["message"].copy()
+        result["message"]["content"] = merged_content
+    else:
+        result["content"] = merged_content
+
+    return result
+
+
+def extract_project_name(project_dir: Path) -> str:
+    """Extract a human-readable project name from the Claude projects directory name.
+
+    Directory names look like: -Users-doneyli-djg-family-office
+    We extract the last segment as the project name.
+    """
+    dir_name = project_dir.name
+    # Split on the path-encoded dashes and take the last non-empty segment
+    parts = dir_name.split("-")
+    # Rebuild: find the last meaningful project name
+    # Pattern: -Users-<user>-<project-name> or -Users-<user>-<path>-<project-name>
+    # Take everything after the username (3rd segment onward)
+    if len(parts) > 3:
+        # parts[0] is empty (leading dash), parts[1] is "Users", parts[2] is username
+        project_parts = parts[3:]
+        return "-".join(project_parts)
+    return dir_name
+
+
+def find_latest_transcript() -> tuple[str, Path, str] | None:
+    """Find the most recently modified transcript file.
+
+    Claude Code stores transcripts as *.jsonl files directly in the project directory.
+    Main conversation files have UUID names, agent files have agent-*.jsonl names.
+    The session ID is stored inside each JSON line.
+
+    Returns: (session_id, transcript_path, project_name) or None
+    """
+    projects_dir = PROJECTS_DIR
+
+    if not projects_dir.exists():
+        debug(f"Projects directory not found: {projects_dir}")
+        return None
+
+    latest_file = None
+    latest_mtime = 0
+    latest_project_dir = None
+
+    for project_dir in projects_dir.iterdir():
+        if not project_dir.is_dir():
+            continue
+
+        # Look for all .jsonl files directly in the project directory
+        for transcript_file in project_dir.glob("*.jsonl"):
+            mtime = transcript_file.stat().st_mtime
+            if mtime > latest_mtime:
+                latest_mtime = mtime
+                latest_file = transcript_file
+                latest_project_dir = project_dir
+
+    if latest_file and latest_project_dir:
+        # Extract session ID from the first line of the file
+        try:
+            first_line = latest_file.read_text().split("\n")[0]
+            first_msg = json.loads(first_line)
+            session_id = first_msg.get("sessionId", latest_file.stem)
+            project_name = extract_project_name(latest_project_dir)
+            debug(f"Found transcript: {latest_file}, session: {session_id}, project: {project_name}")
+            return (session_id, latest_file, project_name)
+        except (json.JSONDecodeError, IOError, IndexError) as e:
+            debug(f"Error reading transcript {latest_file}: {e}")
+            return None
+
+    debug("No transcript files found")
+    return None
+
+
+def check_transcript(index: dict, transcript_file: Path, state: dict) -> os.stat_result | None:
+    """Check a transcript against the index. Returns its stat if it changed, else None.
+
+    Only files not yet indexed (or replaced under the same path) have their first
+    line read to learn the session ID. The stat signature of a changed file is kept
+    as "seen" so mark_transcript_processed() can record it once the file is processed,
+    and "pending_since" records when its backlog was first noticed.
+    Raises OSError/JSONDecodeError if the transcript can't be read.
+    """
+    files = index["files"]
+    key = str(transcript_file)
+    st = transcript_file.stat()
+    entry = files.get(key)
+
+    if entry is None or entry.get("ino") != st.st_ino:
+        # New (or replaced) file: read its session ID once and cache it
+        session_id = read_session_id(transcript_file)
+        entry = {"ino": st.st_ino, "session_id": session_id, "size": None, "mtime_ns": None, "offset": 0}
+        files[key] = entry
+
+        # Files processed before the index existed: trust the state timestamp
+        session_state = state.get(session_id, {})
+        if "updated" in session_state:
+            last_update_timestamp = datetime.fromisoformat(session_state["updated"]).timestamp()
+            if st.st_mtime <= last_update_timestamp:
+                entry["size"], entry["mtime_ns"], entry["offset"] = st.st_size, st.st_mtime_ns, st.st_size
+
+    # Unchanged since it was last processed: nothing to read
+    if entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+        return None
+
+    entry["seen"] = [st.st_size, st.st_mtime_ns]
+    entry.setdefault("pending_since", time.time())
+    return st
+
+
+def find_modified_transcripts(state: dict, index: dict | None = None) -> list[tuple[str, Path, str]]:
+    """Find all transcripts that have been modified since they were last processed.
+
+    Uses the transcript index to avoid reading unchanged files: each transcript is
+    stat'ed, and only files whose (inode, size, mtime) signature differs from the
+    indexed one are considered. The first line is read only for files not yet indexed
+    (or replaced under the same path) to learn their session ID.
+
+    Returns every modified transcript, most recently modified first; rank_backlog()
+    decides the order they are worked off in.
+
+    Returns: list of (session_id, transcript_path, project_name) tuples
+    """
+    if index is None:
+        index = {"files": {}}
+    files = index["files"]
+    projects_dir = PROJECTS_DIR
+
+    if not projects_dir.exists():
+        debug(f"Projects directory not found: {projects_dir}")
+        return []
+
+    modified_transcripts = []
+    seen_paths = set()
+
+    for project_dir in projects_dir.iterdir():
+        if not project_dir.is_dir():
+            continue
+
+        project_name = extract_project_name(project_dir)
+
+        # Look for all .jsonl files directly in the project directory
+        for transcript_file in project_dir.glob("*.jsonl"):
+            # Skip subagent transcripts (they're in subdirectories and caught by glob **)
+            if "subagents" in str(transcript_file):
+                continue
+
+            seen_paths.add(str(transcript_file))
+            try:
+                st = check_transcript(index, transcript_file, state)
+                if st is None:
+                    continue
+                session_id = files[str(transcript_file)]["session_id"]
+                modified_transcripts.append({
+                    "session_id": session_id,
+                    "transcript_file": transcript_file,
+                    "project_name": project_name,
+                    "mtime": st.st_mtime,
+                })
+                debug(f"Found modified session: {session_id} (project: {project_name})")
+            except (json.JSONDecodeError, IOError, IndexError) as e:
+                debug(f"Error reading transcript {transcript_file}: {e}")
+                continue
+
+    # Forget transcripts that no longer exist
+    for key in [k for k in files if k not in seen_paths]:
+        del files[key]
+
+    # Sort by modification time (most recent first)
+    modified_transcripts.sort(key=lambda x: x["mtime"], reverse=True)
+    result = [(t["session_id"], t["transcript_file"], t["project_name"]) for t in modified_transcripts]
+
+    debug(f"Found {len(result)} modified transcripts")
+    return result
+
+
+def backlog_lag(index: dict, state: dict, session_id: str, transcript_file: Path) -> tuple[int, float]:
+    """How far a changed transcript is behind: (bytes not yet exported, seconds since its backlog began)."""
+    entry = index["files"].get(str(transcript_file), {})
+    size = entry.get("seen", [entry.get("size") or 0])[0]
+    pending = max(0, size - state.get(session_id, {}).get("offset", 0))
+    return pending, time.time() - entry.get("pending_since", time.time())
+
+
+def rank_backlog(transcripts: list[tuple[str, Path, str]], state: dict, index: dict) -> list[tuple[str, Path, str]]:
+    """Order changed transcripts by lag (bytes pending × seconds waiting), largest first.
+
+    A transcript's lag keeps growing for as long as it waits, so a session that
+    keeps losing to busier ones eventually moves to the front.
+    """
+    def lag(transcript: tuple[str, Path, str]) -> float:
+        pending, waiting = backlog_lag(index, state, transcript[0], transcript[1])
+        return pending * max(waiting, 1.0)
+
+    return sorted(transcripts, key=lag, reverse=True)
+
+
+def format_lag(transcripts: list[tuple[str, Path, str]], state: dict, index: dict, limit: int = 3) -> str:
+    """Per-session lag for the run summary, e.g. "1a2b3c4d 2.1 MB for 14m"."""
+    parts = []
+    for session_id, transcript_file, _ in transcripts[:limit]:
+        pending, waiting = backlog_lag(index, state, session_id, transcript_file)
+        waited = f"{waiting:.0f}s" if waiting < 60 else f"{waiting / 60:.0f}m"
+        parts.append(f"{session_id[:8]} {pending / (1024 * 1024):.1f} MB for {waited}")
+    if len(transcripts) > limit:
+        parts.append(f"+{len(transcripts) - limit} more")
+    return ", ".join(parts)
+
+
+def read_hook_payload() -> dict:
+    """Read the JSON payload Claude Code passes to hooks on stdin.
+
+    Stop hooks receive session_id and transcript_path (among others). Returns an
+    empty dict when run manually from a terminal or when stdin holds no valid JSON.
+    """
+    if sys.stdin is None or sys.stdin.isatty():
+        return {}
+    try:
+        raw = sys.stdin.read()
+    except (OSError, ValueError):
+        return {}
+    if not raw.strip():
+        return {}
+    try:
+        payload = json.loads(raw)
+    except json.JSONDecodeError as e:
+        debug(f"Ignoring malformed hook payload: {e}")
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+
+def find_payload_transcript(payload: dict, state: dict, index: dict) -> tuple[str, Path, str] | None:
+    """Resolve the transcript named by the Stop hook payload, if it has new data.
+
+    Returns: (session_id, transcript_path, project_name) or None
+    """
+    transcript_path = payload.get("transcript_path")
+    if not transcript_path:
+        return None
+
+    transcript_file = Path(transcript_path).expanduser()
+    try:
+        if check_transcript(index, transcript_file, state) is None:
+            debug(f"Payload transcript unchanged: {transcript_file}")
+            return None
+    except (json.JSONDecodeError, IOError) as e:
+        debug(f"Error reading payload transcript {transcript_file}: {e}")
+        return None
+
+    session_id = index["files"][str(transcript_file)]["session_id"]
+    project_name = extract_project_name(transcript_file.parent)
+    debug(f"Payload transcript: {transcript_file}, session: {session_id}, project: {project_name}")
+    return (session_id, transcript_file, project_name)
+
+
+def sweep_due(index: dict) -> bool:
+    """Decide whether this run should do a full discovery sweep, and record the run.
+
+    With a Stop payload the named transcript is handled directly; the full sweep only
+    runs every SWEEP_EVERY_RUNS runs or SWEEP_INTERVAL_MINUTES to catch stragglers.
+    The run count is kept in the index, which a run with nothing to do doesn't save,
+    so only runs that find work (or sweep) count towards SWEEP_EVERY_RUNS.
+    """
+    sweep = index.setdefault("sweep", {"last": 0, "runs": 0})
+    sweep["runs"] = sweep.get("runs", 0) + 1
+    now = time.time()
+    if sweep["runs"] >= SWEEP_EVERY_RUNS or now - sweep.get("last", 0) >= SWEEP_INTERVAL_MINUTES * 60:
+        sweep["last"] = now
+        sweep["runs"] = 0
+        return True
+    return False
+
+
+def acquire_run_lock():
+    """Take the cross-process run lock without waiting.
+
+    Returns the open lock file (pass it to release_run_lock), or None if another
+    hook run holds the lock.
+    """
+    LOCK_FILE.parent.mkdir(parents=True, exist_ok=True)
+    lock = open(LOCK_FILE, "a")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock.close()
+        return None
+    return lock
+
+
+def release_run_lock(lock) -> None:
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+
+def mark_dirty(payload: dict) -> None:
+    """Record a payload for the active run to pick up (an empty payload asks for a full sweep).
+
+    Payloads flagged "backlog" are transcripts an earlier run didn't finish, not Stop events.
+    """
+    entry = {key: payload[key] for key in ("session_id", "transcript_path", "backlog") if key in payload}
+    DIRTY_FILE.parent.mkdir(parents=True, exist_ok=True)
+    with open(DIRTY_FILE, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.write(json.dumps(entry) + "\n")
+
+
+def take_dirty() -> list[dict]:
+    """Claim every payload recorded by runs that found the lock busy."""
+    try:
+        f = open(DIRTY_FILE, "r+")
+    except FileNotFoundError:
+        return []
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        lines = f.read().splitlines()
+        f.truncate(0)
+    payloads = []
+    for line in lines:
+        try:
+            payloads.append(json.loads(line))
+        except json.JSONDecodeError:
+            continue
+    return payloads
+
+
+def dirty_pending() -> bool:
+    try:
+        return DIRTY_FILE.stat().st_size > 0
+    except FileNotFoundError:
+        return False
+
+
+def payload_transcripts(payloads: list[dict], state: dict, index: dict) -> list[tuple[str, Path, str]]:
+    """Resolve the transcripts named by Stop payloads, once each."""
+    found = {}
+    for payload in payloads:
+        transcript = find_payload_transcript(payload, state, index)
+        if transcript:
+            found[transcript[1]] = transcript
+    return list(found.values())
+
+
+class TurnAssembler:
+    """Groups a stream of messages into turns (user -> assistant(s) -> tool_results).
+
+    Tool results are indexed by tool_use_id as they arrive, so joining calls to
+    results later is a dict lookup per call.
+
+    Resumable across hook runs: the partial turn — open user message, merged
+    assistant messages, pending parts of the current assistant message keyed by
+    message.id, tool results, and tool_use ids still waiting for a result — is
+    captured by checkpoint() and restored from session state, so old lines are never
+    re-read to rebuild context. A turn is emitted when the next user prompt starts,
+    or by finish() once it is complete; half-finished turns stay in the checkpoint.
+
+    When fed byte offsets, the assembler also tracks where each turn lives in the
+    transcript: `span` is the (start, end) byte range of the turn last emitted, which
+    lets a turn be queued by reference and re-read later.
+    """
+
+    def __init__(self, checkpoint: dict | None = None):
+        checkpoint = checkpoint or {}
+        self.user_msg = checkpoint.get("user_msg")
+        self.assistant_msgs = checkpoint.get("assistant_msgs", [])
+        self.msg_id, self.assistant_parts = next(iter(checkpoint.get("pending_parts", {}).items()), (None, []))
+        self.msg_id = self.msg_id or None
+        self.tool_outputs = checkpoint.get("tool_outputs", {})
+        self.pending_tool_ids = set(checkpoint.get("pending_tool_ids", []))
+        self.awaiting_assistant = checkpoint.get("awaiting_assistant", False)
+        self.start = checkpoint.get("start")
+        self.span = (None, None)
+
+    def feed(self, msg: dict, offset: int | None = None) -> tuple[dict, list, dict] | None:
+        """Add one message. Returns the previous turn if this message closed it.
+
+        offset is the byte offset of the message's line in the transcript, if known.
+        """
+        role = msg.get("type") or (msg.get("message", {}).get("role"))
+
+        if role == "user":
+            # Check if this is a tool result
+            if is_tool_result(msg):
+                for item in get_content(msg):
+                    if isinstance(item, dict) and item.get("type") == "tool_result":
+                        self.tool_outputs[item.get("tool_use_id")] = item.get("content")
+                        self.pending_tool_ids.discard(item.get("tool_use_id"))
+                self.awaiting_assistant = True
+                return None
+
+            # New user message - finalize previous turn and start a new one
+            turn = self._take_turn(offset)
+            self.user_msg = msg
+            self.start = offset
+            return turn
+
+        if role == "assistant":
+            msg_id = None
+            if isinstance(msg, dict) and "message" in msg:
+                msg_id = msg["message"].get("id")
+
+            if msg_id and msg_id != self.msg_id:
+                # New message ID - finalize previous message
+                self._merge_parts()
+                self.msg_id = msg_id
+            # No message ID is treated as a continuation of the current message
+            self.assistant_parts.append(msg)
+            self.pending_tool_ids.update(call.get("id") for call in get_tool_calls(msg))
+            self.awaiting_assistant = False
+        return None
+
+    def turns(self, messages: Iterable[dict]) -> Iterator[tuple[dict, list, dict]]:
+        """Feed a stream of messages, yielding each turn as soon as it closes."""
+        for msg in messages:
+            turn = self.feed(msg)
+            if turn:
+                yield turn
+
+    def is_complete(self, stop_event: bool = False) -> bool:
+        """Whether the open turn is finished and can be emitted without waiting for the next prompt.
+
+        Every tool_use must have its result and an assistant message must come after
+        the last tool result. Unless the Stop event for this session fired (or the
+        transcript has gone idle), the last assistant message must also carry an
+        end-of-turn stop_reason, so a response still streaming is never cut short.
+        """
+        if not self.user_msg or not (self.assistant_msgs or self.assistant_parts):
+            return False
+        if self.pending_tool_ids or self.awaiting_assistant:
+            return False
+        last = self.assistant_parts[-1] if self.assistant_parts else self.assistant_msgs[-1]
+        stop_reason = last.get("message", {}).get("stop_reason") if isinstance(last, dict) else None
+        if stop_reason == "tool_use":
+            return False
+        return stop_event or stop_reason in END_STOP_REASONS
+
+    def finish(self, stop_event: bool = False, end: int | None = None) -> tuple[dict, list, dict] | None:
+        """At the end of the available data (byte offset end), emit the open turn only if it is complete."""
+        if not self.is_complete(stop_event):
+            return None
+        return self.close(end)
+
+    def close(self, end: int | None = None) -> tuple[dict, list, dict] | None:
+        """Emit the open turn as it stands, complete or not."""
+        turn = self._take_turn(end)
+        self.user_msg = None
+        self.start = None
+        return turn
+
+    def checkpoint(self) -> dict | None:
+        """Partial state to persist between runs, or None if no turn is open."""
+        if not self.user_msg:
+            return None
+        return {
+            "user_msg": self.user_msg,
+            "assistant_msgs": self.assistant_msgs,
+            "pending_parts": {self.msg_id or "": self.assistant_parts} if self.assistant_parts else {},
+            "tool_outputs": self.tool_outputs,
+            "pending_tool_ids": sorted(self.pending_tool_ids),
+            "awaiting_assistant": self.awaiting_assistant,
+            "start": self.start,
+        }
+
+    def _merge_parts(self) -> None:
+        if self.assistant_parts:
+            self.assistant_msgs.append(merge_assistant_parts(self.assistant_parts))
+        self.assistant_parts = []
+        self.msg_id = None
+
+    def _take_turn(self, end: int | None = None) -> tuple[dict, list, dict] | None:
+        """Close the open turn and reset; returns it if it has a user prompt and a response."""
+        self._merge_parts()
+        turn = None
+        if self.user_msg and self.assistant_msgs:
+            turn = (self.user_msg, self.assistant_msgs, self.tool_outputs)
+            self.span = (self.start, end)
+        self.assistant_msgs = []
+        self.tool_outputs = {}
+        self.pending_tool_ids = set()
+        self.awaiting_assistant = False
+        return turn
+
+
+def stable_id(*parts: Any, bits: int = 128) -> str:
+    """Hex ID of `bits` bits derived from parts, the same on every run and every machine."""
+    digest = hashlib.sha256("\x1f".join(str(part) for part in parts).encode()).hexdigest()
+    return digest[:bits // 4]
+
+
+class ToolCall:
+    """A tool invocation within a turn, joined with its result."""
+
+    __slots__ = ("id", "name", "input", "output")
+
+    def __init__(self, id: str, name: str, input: Any, output: Any = None):
+        self.id = id
+        self.name = name
+        self.input = input
+        self.output = output
+
+
+class Turn:
+    """Canonical representation of one turn, shared by every backend.
+
+    Built once per turn by build_turn() from the raw transcript messages, so user
+    text, final output, model and the tool call/result join are derived a single
+    time no matter how many backends are enabled. `source` is the (transcript,
+    start, end) byte range the turn was read from, when known. `replay` is set on
+    turns rebuilt from the queue, which a backend may have received before.
+    """
+
+    __slots__ = (
+        "session_id", "turn_num", "project_name", "user_text", "final_output", "model", "tool_calls", "source",
+        "replay",
+    )
+
+    def __init__(
+        self,
+        session_id: str,
+        turn_num: int,
+        project_name: str,
+        user_text: str,
+        final_output: str,
+        model: str,
+        tool_calls: list[ToolCall],
+        source: tuple[Path, int, int] | None = None,
+    ):
+        self.session_id = session_id
+        self.turn_num = turn_num
+        self.project_name = project_name
+        self.user_text = user_text
+        self.final_output = final_output
+        self.model = model
+        self.tool_calls = tool_calls
+        self.source = source
+        self.replay = False
+
+    @property
+    def tags(self) -> list[str]:
+        tags = ["claude-code"]
+        if self.project_name:
+            tags.append(self.project_name)
+        return tags
+
+    @property
+    def trace_id(self) -> str:
+        """32-hex trace ID from (session_id, turn_num), so a re-export of the turn lands on the same trace."""
+        return stable_id(self.session_id, self.turn_num)
+
+    def span_id(self, part: str) -> str:
+        """16-hex span ID for one part of the turn: "turn", "response" or a tool_use_id."""
+        return stable_id(self.session_id, self.turn_num, part, bits=64)
+
+    def tool_span_ids(self) -> list[str]:
+        """Span ID per tool call, keyed by tool_use_id (by position for calls without one)."""
+        return [self.span_id(tc.id or f"#{i}") for i, tc in enumerate(self.tool_calls)]
+
+    def to_dict(self) -> dict:
+        """Serialize for the local queue."""
+        return {
+            "session_id": self.session_id,
+            "turn_num": self.turn_num,
+            "project_name": self.project_name,
+            "user_text": self.user_text,
+            "final_output": self.final_output,
+            "model": self.model,
+            "tool_calls": [
+                {"id": tc.id, "name": tc.name, "input": tc.input, "output": tc.output}
+                for tc in self.tool_calls
+            ],
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Turn":
+        return cls(
+            session_id=data["session_id"],
+            turn_num=data["turn_num"],
+            project_name=data.get("project_name", ""),
+            user_text=data.get("user_text", ""),
+            final_output=data.get("final_output", ""),
+            model=data.get("model", "claude"),
+            tool_calls=[
+                ToolCall(tc.get("id", ""), tc.get("name", "unknown"), tc.get("input", {}), tc.get("output"))
+                for tc in data.get("tool_calls", [])
+            ],
+        )
+
+
+def index_tool_results(tool_results: list) -> dict:
+    """Index tool_result contents by tool_use_id in one pass over the result messages."""
+    tool_outputs = {}
+    for tr in tool_results:
+        tr_content = get_content(tr)
+        if isinstance(tr_content, list):
+            for item in tr_content:
+                if isinstance(item, dict) and "tool_use_id" in item:
+                    tool_outputs[item["tool_use_id"]] = item.get("content")
+    return tool_outputs
+
+
+def build_turn(
+    session_id: str,
+    turn_num: int,
+    user_msg: dict,
+    assistant_msgs: list,
+    tool_outputs: dict,
+    project_name: str = "",
+) -> Turn:
+    """Build the canonical Turn from the raw messages of one turn.
+
+    tool_outputs maps tool_use_id to result content (see TurnAssembler and
+    index_tool_results), so the call/result join is linear in the number of calls.
+    """
+    # Extract user text
+    user_text = get_text_content(user_msg)
+
+    # Extract final assistant text
+    final_output = ""
+    if assistant_msgs:
+        final_output = get_text_content(assistant_msgs[-1])
+
+    # Get model info from first assistant message
+    model = "claude"
+    if assistant_msgs and isinstance(assistant_msgs[0], dict) and "message" in assistant_msgs[0]:
+        model = assistant_msgs[0]["message"].get("model", "claude")
+
+    # Collect all tool calls joined with their results
+    tool_calls = []
+    for assistant_msg in assistant_msgs:
+        for tool_call in get_tool_calls(assistant_msg):
+            tool_id = tool_call.get("id", "")
+            tool_calls.append(ToolCall(
+                tool_id, tool_call.get("name", "unknown"), tool_call.get("input", {}), tool_outputs.get(tool_id),
+            ))
+
+    return Turn(session_id, turn_num, project_name, user_text, final_output, model, tool_calls)
+
+
+def read_turn(transcript: Path, start: int, end: int, fingerprint: str) -> tuple[dict, list, dict]:
+    """Re-read one turn's messages from its byte range in the transcript.
+
+    Raises ValueError if the transcript was rewritten since the range was recorded.
+    """
+    with open(transcript, "rb") as f:
+        if transcript_fingerprint(f, end) != fingerprint:
+            raise ValueError(f"{transcript.name} changed since the turn was queued")
+        f.seek(start)
+        assembler = TurnAssembler()
+        offset = start
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            for msg in decode_messages([line]):
+                assembler.feed(msg)
+        turn = assembler.close()
+    if not turn:
+        raise ValueError(f"no turn at bytes {start}-{end} of {transcript.name}")
+    return turn
+
+
+def turn_from_queue_entry(entry: dict) -> Turn:
+    """Rebuild a Turn from a queue entry.
+
+    Entries normally reference a byte range of the transcript, which is re-read
+    here. Entries queued by older versions hold the turn itself or raw messages.
+    The turn is marked as a replay.
+    """
+    if "transcript" in entry:
+        messages = read_turn(Path(entry["transcript"]), entry["start"], entry["end"], entry["fingerprint"])
+        turn = build_turn(entry["session_id"], entry["turn_num"], *messages, entry.get("project_name", ""))
+    elif "user_msg" in entry:
+        turn = build_turn(
+            entry["session_id"], entry["turn_num"], entry["user_msg"], entry["assistant_msgs"],
+            index_tool_results(entry["tool_results"]), entry.get("project_name", ""),
+        )
+    else:
+        turn = Turn.from_dict(entry)
+    turn.replay = True
+    return turn
+
+
+def queue_entry(turn: Turn, backends: Iterable[str] | None = None) -> dict:
+    """The queue entry for a turn, owed to backends (default: every backend).
+
+    Turns read from a transcript are queued by reference (path and byte range)
+    since the transcript already holds their content; others are queued in full.
+    """
+    if turn.source and None not in turn.source:
+        transcript, start, end = turn.source
+        with open(transcript, "rb") as f:
+            fingerprint = transcript_fingerprint(f, end)
+        entry = {
+            "session_id": turn.session_id,
+            "transcript": str(transcript),
+            "start": start,
+            "end": end,
+            "fingerprint": fingerprint,
+            "turn_num": turn.turn_num,
+            "project_name": turn.project_name,
+        }
+    else:
+        entry = turn.to_dict()
+    if backends is not None:
+        entry["backends"] = sorted(backends)
+    return entry
+
+
+def queue_turn(turn: Turn, backends: Iterable[str] | None = None) -> None:
+    """Trace creator that queues the turn locally for backends instead of exporting it."""
+    queue_trace(queue_entry(turn, backends))
+
+
+def create_trace(langfuse: "Langfuse", turn: Turn) -> None:
+    """Create a Langfuse trace for a single turn using the new SDK API.
+
+    The trace ID comes from the turn, so an export retried from the queue updates
+    the same trace. Observation IDs stay random: the SDK's tracer provider owns them.
+    """
+    # Create root span (implicitly creates a trace), then set trace-level attributes
+    with langfuse.start_as_current_span(
+        trace_context={"trace_id": turn.trace_id},
+        name=f"Turn {turn.turn_num}",
+        input={"role": "user", "content": turn.user_text},
+        metadata={
+            "source": "claude-code",
+            "turn_number": turn.turn_num,
+            "project": turn.project_name,
+        },
+    ) as trace_span:
+        # Set session_id and tags on the underlying trace
+        langfuse.update_current_trace(
+            session_id=turn.session_id,
+            tags=turn.tags,
+            metadata={
+                "source": "claude-code",
+                "turn_number": turn.turn_num,
+                "session_id": turn.session_id,
+                "project": turn.project_name,
+            },
+        )
+
+        # Create generation for the LLM response
+        with langfuse.start_as_current_observation(
+            name="Claude Response",
+            as_type="generation",
+            model=turn.model,
+            input={"role": "user", "content": turn.user_text},
+            output={"role": "assistant", "content": turn.final_output},
+            metadata={
+                "tool_count": len(turn.tool_calls),
+            },
+        ):
+            pass
+
+        # Create spans for tool calls
+        for tool_call in turn.tool_calls:
+            with langfuse.start_as_current_span(
+                name=f"Tool: {tool_call.name}",
+                input=tool_call.input,
+                metadata={
+                    "tool_name": tool_call.name,
+                    "tool_id": tool_call.id,
+                },
+            ) as tool_span:
+                tool_span.update(output=tool_call.output)
+            debug(f"Created span for tool: {tool_call.name}")
+
+        # Update trace with output
+        trace_span.update(output={"role": "assistant", "content": turn.final_output})
+
+    debug(f"Created trace for turn {turn.turn_num}")
+
+
+class LangfuseSdkExporter:
+    """Exports turns through a Langfuse SDK client, with the interface of LangfuseIngestionExporter.
+
+    The SDK assigns random observation IDs, so a turn it exported twice would show
+    up twice in its trace. Replayed turns (drained from the queue) therefore go
+    through `ingestion`, whose IDs derive from the turn, and only fresh turns
+    through the SDK. The SDK doesn't report which spans it failed to send; if its
+    flush raises, every turn it exported since the previous flush is handed back
+    by take_undelivered(), to be replayed through the ingestion API. Turns re-read
+    from a transcript (a run killed before saving its progress) are fresh to this
+    exporter and are duplicated; only CC_LANGFUSE_EXPORTER=ingestion avoids that.
+    """
+
+    def __init__(self, client: "Langfuse", ingestion: "LangfuseIngestionExporter"):
+        self._client = client
+        self._ingestion = ingestion
+        self._pending: list[Turn] = []
+        self._undelivered: list[Turn] = []
+
+    def export(self, turn: Turn) -> None:
+        if turn.replay:
+            self._ingestion.export(turn)
+            return
+        create_trace(self._client, turn)
+        self._pending.append(turn)
+
+    def flush(self) -> bool:
+        pending, self._pending = self._pending, []
+        flushed = self._ingestion.flush()
+        try:
+            self._client.flush()
+        except Exception as e:
+            log("ERROR", f"Langfuse SDK flush failed, {len(pending)} turns not confirmed: {e}")
+            self._undelivered.extend(pending)
+            return False
+        return flushed
+
+    def take_undelivered(self) -> list[Turn]:
+        turns, self._undelivered = self._undelivered, []
+        return turns + self._ingestion.take_undelivered()
+
+
+class LangfuseIngestionExporter:
+    """Exports turns straight to the Langfuse public ingestion API in batches.
+
+    Each turn becomes trace-create, span-create and generation-create events with
+    the same structure create_trace() builds through the SDK. Events are serialized
+    once and POSTed to /api/public/ingestion in batches capped at max_batch_bytes, so
+    draining thousands of queued turns takes a few HTTP round trips and the SDK is
+    never imported. Exposes flush()/shutdown() like the SDK client.
+    """
+
+    def __init__(self, host: str, public_key: str, secret_key: str,
+                 max_batch_bytes: int = INGESTION_BATCH_BYTES, timeout: float = 10):
+        self._url = host.rstrip("/") + "/api/public/ingestion"
+        credentials = base64.b64encode(f"{public_key}:{secret_key}".encode()).decode()
+        self._headers = {"Authorization": f"Basic {credentials}", "Content-Type": "application/json"}
+        self._max_batch_bytes = max_batch_bytes
+        self._timeout = timeout
+        self._batch: list[bytes] = []
+        self._batch_bytes = 0
+        self._batch_turns: list[Turn] = []
+        self._undelivered: list[Turn] = []
+        self.requests = 0
+        self.events = 0
+        self.bytes_sent = 0
+
+    def export(self, turn: Turn) -> None:
+        """Add a turn's events to the current batch, sending it first if it would overflow."""
+        for event in self._turn_events(turn):
+            data = json.dumps(event, default=str).encode()
+            if len(data) > self._max_batch_bytes:
+                data = self._shrink(event, len(data))
+                if data is None:
+                    continue
+            if self._batch and self._batch_bytes + len(data) > self._max_batch_bytes:
+                self.flush()
+            self._batch.append(data)
+            self._batch_bytes += len(data) + 1
+            if not self._batch_turns or self._batch_turns[-1] is not turn:
+                self._batch_turns.append(turn)
+        debug(f"Batched ingestion events for turn {turn.turn_num}")
+
+    def flush(self) -> bool:
+        """Send the pending batch. Returns False (and logs) if the request failed.
+
+        The turns of a failed batch are kept for take_undelivered().
+        """
+        if not self._batch:
+            return True
+        body = b'{"batch":[' + b",".join(self._batch) + b"]}"
+        events = len(self._batch)
+        turns = self._batch_turns
+        self._batch = []
+        self._batch_bytes = 0
+        self._batch_turns = []
+
+        import urllib.error
+        import urllib.request
+
+        request = urllib.request.Request(self._url, data=body, headers=self._headers, method="POST")
+        try:
+            with urllib.request.urlopen(request, timeout=self._timeout) as response:
+                result = json.loads(response.read() or b"{}")
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            log("ERROR", f"Langfuse ingestion request with {events} events failed: {e}")
+            self._undelivered.extend(turns)
+            return False
+        self.requests += 1
+        self.events += events
+        self.bytes_sent += len(body)
+
+        # 207 Multi-Status: individual events can be rejected while the request succeeds
+        errors = result.get("errors") or []
+        if errors:
+            log("ERROR", f"Langfuse ingestion rejected {len(errors)}/{events} events: {errors[0]}")
+        debug(f"Sent {events} ingestion events ({len(body)} bytes)")
+        return True
+
+    def _shrink(self, event: dict, size: int) -> bytes | None:
+        """Serialize an event too big for any batch with its input and output truncated.
+
+        The API would reject it on every retry. Returns None (and logs) if even the
+        truncated event doesn't fit, so it is dropped.
+        """
+        body = event["body"]
+        for key in ("input", "output"):
+            # Half the batch for input and output together leaves the rest for IDs and metadata
+            body[key] = _truncate_json(body.get(key), self._max_batch_bytes // 4)
+        data = json.dumps(event, default=str).encode()
+        if len(data) > self._max_batch_bytes:
+            log("ERROR", f"Dropping {event['type']} {body['id']}: {len(data)} bytes even truncated")
+            return None
+        log("WARN", f"Truncated input/output of {event['type']} {body['id']} ({size} bytes) to fit an ingestion batch")
+        return data
+
+    def take_undelivered(self) -> list[Turn]:
+        """Turns whose batch failed to send since the last call."""
+        turns, self._undelivered = self._undelivered, []
+        return turns
+
+    def shutdown(self) -> None:
+        self.flush()
+
+    @staticmethod
+    def _turn_events(turn: Turn) -> list[dict]:
+        # Trace, observation and event IDs derive from the turn, so a retried or
+        # replayed batch upserts the same objects instead of duplicating them
+        now = datetime.now(timezone.utc).isoformat()
+        trace_id = turn.trace_id
+        root_id = turn.span_id("turn")
+        user_input = {"role": "user", "content": turn.user_text}
+        output = {"role": "assistant", "content": turn.final_output}
+
+        def event(event_type: str, body: dict) -> dict:
+            return {"id": stable_id(event_type, body["id"]), "timestamp": now, "type": event_type, "body": body}
+
+        events = [
+            event("trace-create", {
+                "id": trace_id,
+                "timestamp": now,
+                "name": f"Turn {turn.turn_num}",
+                "sessionId": turn.session_id,
+                "tags": turn.tags,
+                "input": user_input,
+                "output": output,
+                "metadata": {
+                    "source": "claude-code",
+                    "turn_number": turn.turn_num,
+                    "session_id": turn.session_id,
+                    "project": turn.project_name,
+                },
+            }),
+            event("span-create", {
+                "id": root_id,
+                "traceId": trace_id,
+                "name": f"Turn {turn.turn_num}",
+                "startTime": now,
+                "endTime": now,
+                "input": user_input,
+                "output": output,
+                "metadata": {
+                    "source": "claude-code",
+                    "turn_number": turn.turn_num,
+                    "project": turn.project_name,
+                },
+            }),
+            event("generation-create", {
+                "id": turn.span_id("response"),
+                "traceId": trace_id,
+                "parentObservationId": root_id,
+                "name": "Claude Response",
+                "startTime": now,
+                "endTime": now,
+                "model": turn.model,
+                "input": user_input,
+                "output": output,
+                "metadata": {"tool_count": len(turn.tool_calls)},
+            }),
+        ]
+        for tool_call, span_id in zip(turn.tool_calls, turn.tool_span_ids()):
+            events.append(event("span-create", {
+                "id": span_id,
+                "traceId": trace_id,
+                "parentObservationId": root_id,
+                "name": f"Tool: {tool_call.name}",
+                "startTime": now,
+                "endTime": now,
+                "input": tool_call.input,
+                "output": tool_call.output,
+                "metadata": {"tool_name": tool_call.name, "tool_id": tool_call.id},
+            }))
+        return events
+
+
+def _truncate_for_attr(value: str, max_len: int = 32000) -> str:
+    """Truncate a string value for use as an OTEL span attribute."""
+    if len(value) <= max_len:
+        return value
+    return value[:max_len] + f"... [truncated, {len(value)} chars total]"
+
+
+def _truncate_json(value: Any, max_bytes: int) -> Any:
+    """Truncate a JSON value to about max_bytes serialized, as text, like _truncate_for_attr()."""
+    text = value if isinstance(value, str) else json.dumps(value, default=str)
+    size = len(json.dumps(text))
+    if size <= max_bytes:
+        return value
+    # Escaping makes serialized size per character vary; scale the character count to match
+    return _truncate_for_attr(text, len(text) * max_bytes // size)
+
+
+class _LoggingExporter:
+    """Wraps an OTLP exporter to log export results (works for spans and log records).
+
+    A failed batch is also handed to on_failure, if given.
+    """
+
+    def __init__(self, wrapped, signal_name: str = "spans", on_failure=None):
+        self._wrapped = wrapped
+        self._signal_name = signal_name
+        self._on_failure = on_failure
+
+    def export(self, items):
+        result = self._wrapped.export(items)
+        if result.value != 0:  # Works for both SpanExportResult and LogExportResult
+            names = []
+            for item in items:
+                if hasattr(item, "name"):
+                    names.append(item.name)
+                elif hasattr(item, "log_record"):
+                    names.append(str(item.log_record.body)[:80])
+                elif hasattr(item, "body"):
+                    names.append(str(item.body)[:80])
+                else:
+                    names.append("?")
+            log("ERROR", f"OTLP export FAILED for {self._signal_name} {names}: {result}")
+            if self._on_failure:
+                self._on_failure(items)
+        return result
+
+    def shutdown(self):
+        self._wrapped.shutdown()
+
+    def force_flush(self, timeout_millis=None):
+        return self._wrapped.force_flush(timeout_millis)
+
+
+class _ExportStats:
+    """Counts OTLP HTTP requests and request body bytes (after compression).
+
+    Hooks into the requests.Session handed to the OTLP exporters, so it sees every
+    request actually sent, including retries. Also collects the trace IDs of span
+    and log batches that failed to export, for OtelTurnExporter.
+    """
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes_sent = 0
+        self._failed_traces: set[int] = set()
+        self._failed_lock = threading.Lock()
+
+    def export_failed(self, items) -> None:
+        """Record the traces of a batch of spans or log records the exporter failed to send."""
+        trace_ids = set()
+        for item in items:
+            # Spans carry their context, log records their trace correlation
+            context = getattr(item, "context", None) or getattr(item, "log_record", None)
+            trace_id = getattr(context, "trace_id", None)
+            if trace_id:
+                trace_ids.add(trace_id)
+        with self._failed_lock:
+            self._failed_traces |= trace_ids
+
+    def take_failed(self) -> set[int]:
+        """Trace IDs of the batches that failed since the last call."""
+        with self._failed_lock:
+            failed, self._failed_traces = self._failed_traces, set()
+        return failed
+
+    def session(self) -> "requests.Session":
+        import requests
+
+        session = requests.Session()
+        session.hooks["response"].append(self._on_response)
+        return session
+
+    def _on_response(self, response, *args, **kwargs):
+        self.requests += 1
+        body = response.request.body
+        self.bytes_sent += len(body) if body else 0
+
+
+# IDs for the next span create_otel_trace() starts on this thread, read (once) by
+# the id generator init_otel_providers() installs on its tracer provider
+_otel_next_ids = threading.local()
+
+
+def init_otel_providers(
+    endpoint: str,
+    instance_id: str,
+    api_token: str,
+) -> tuple:
+    """Initialize OpenTelemetry trace and log providers for Grafana Cloud OTLP.
+
+    Spans and log records are batched for the whole run and sent as gzip-compressed
+    protobuf when the providers are flushed at the end of main(), rather than one
+    blocking request per span or log record.
+
+    Returns (tracer, trace_provider, otel_logger, log_provider, export_stats).
+    The otel_logger is a Python logging.Logger bridged to the OTEL log provider;
+    log records emitted inside an active span automatically inherit trace_id/span_id.
+    """
+    import logging
+
+    from opentelemetry.exporter.otlp.proto.http import Compression
+    from opentelemetry.exporter.otlp.proto.http._log_exporter import OTLPLogExporter
+    from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+    from opentelemetry.sdk._logs import LoggerProvider, LoggingHandler
+    from opentelemetry.sdk._logs.export import BatchLogRecordProcessor
+    from opentelemetry.sdk.resources import Resource
+    from opentelemetry.sdk.trace import TracerProvider
+    from opentelemetry.sdk.trace.export import BatchSpanProcessor
+    from opentelemetry.sdk.trace.id_generator import IdGenerator, RandomIdGenerator
+
+    class _TurnIdGenerator(IdGenerator):
+        """Hand out the IDs create_otel_trace() derived from the turn, random ones otherwise."""
+
+        _random = RandomIdGenerator()
+
+        def generate_trace_id(self) -> int:
+            trace_id = getattr(_otel_next_ids, "trace_id", None)
+            _otel_next_ids.trace_id = None
+            return trace_id or self._random.generate_trace_id()
+
+        def generate_span_id(self) -> int:
+            span_id = getattr(_otel_next_ids, "span_id", None)
+            _otel_next_ids.span_id = None
+            return span_id or self._random.generate_span_id()
+
+    class _HookLogHandler(logging.Handler):
+        """Route Python logging messages to the hook's log file."""
+
+        def emit(self, record: logging.LogRecord) -> None:
+            level = record.levelname
+            log(f"OTEL-{level}", f"{record.name}: {record.getMessage()}")
+
+    # Capture OTEL SDK logs (export failures, auth errors, etc.), once per process
+    sdk_logger = logging.getLogger("opentelemetry")
+    if not any(h.get_name() == "claude-code-hook" for h in sdk_logger.handlers):
+        handler = _HookLogHandler()
+        handler.set_name("claude-code-hook")
+        sdk_logger.addHandler(handler)
+    sdk_logger.setLevel(logging.DEBUG if DEBUG else logging.WARNING)
+
+    credentials = base64.b64encode(f"{instance_id}:{api_token}".encode()).decode()
+    auth_headers = {"Authorization": f"Basic {credentials}"}
+
+    resource = Resource.create({
+        "service.name": "claude-code-hook",
+        "service.version": "1.0.0",
+    })
+
+    # --- Trace provider ---
+    traces_endpoint = endpoint.rstrip("/") + "/v1/traces"
+    debug(f"OTLP traces endpoint: {traces_endpoint}")
+
+    export_stats = _ExportStats()
+    span_exporter = OTLPSpanExporter(
+        endpoint=traces_endpoint,
+        headers=auth_headers,
+        timeout=5,
+        compression=Compression.Gzip,
+        session=export_stats.session(),
+    )
+
+    # shutdown_on_exit=False: HookResources.shutdown() flushes, and a provider dropped
+    # because its export hung mustn't hold up the exit
+    trace_provider = TracerProvider(resource=resource, id_generator=_TurnIdGenerator(), shutdown_on_exit=False)
+    trace_provider.add_span_processor(
+        BatchSpanProcessor(
+            _LoggingExporter(span_exporter, signal_name="spans", on_failure=export_stats.export_failed),
+            max_queue_size=OTLP_MAX_QUEUE_SIZE,
+            max_export_batch_size=OTLP_MAX_EXPORT_BATCH_SIZE,
+            schedule_delay_millis=OTLP_SCHEDULE_DELAY_MS,
+        )
+    )
+    # Don't call set_tracer_provider() — Langfuse SDK may have already claimed it.
+
+    # --- Log provider ---
+    logs_endpoint = endpoint.rstrip("/") + "/v1/logs"
+    debug(f"OTLP logs endpoint: {logs_endpoint}")
+
+    log_exporter = OTLPLogExporter(
+        endpoint=logs_endpoint,
+        headers=auth_headers,
+        timeout=5,
+        compression=Compression.Gzip,
+        session=export_stats.session(),
+    )
+
+    log_provider = LoggerProvider(resource=resource, shutdown_on_exit=False)
+    log_provider.add_log_record_processor(
+        BatchLogRecordProcessor(
+            _LoggingExporter(log_exporter, signal_name="logs", on_failure=export_stats.export_failed),
+            max_queue_size=OTLP_MAX_QUEUE_SIZE,
+            max_export_batch_size=OTLP_MAX_EXPORT_BATCH_SIZE,
+            schedule_delay_millis=OTLP_SCHEDULE_DELAY_MS,
+        )
+    )
+    # Don't call set_logger_provider() — same isolation reason as traces.
+
+    # Bridge a Python logger to the OTEL log provider
+    otel_log_handler = LoggingHandler(logger_provider=log_provider)
+    otel_logger = logging.getLogger("claude-code-hook.otel")
+    otel_logger.addHandler(otel_log_handler)
+    otel_logger.setLevel(logging.INFO)
+
+    tracer = trace_provider.get_tracer("claude-code-hook", "1.0.0")
+    return tracer, trace_provider, otel_logger, log_provider, export_stats
+
+
+def create_otel_trace(
+    tracer: "otel_trace.Tracer",
+    turn: Turn,
+    otel_logger: "logging.Logger | None" = None,
+) -> None:
+    """Create an OpenTelemetry trace for a single turn, mirroring the Langfuse structure.
+
+    If otel_logger is provided, structured log records are emitted within each span
+    context so the OTEL SDK automatically attaches trace_id and span_id for
+    bidirectional log-trace correlation in Grafana Cloud.
+
+    Trace and span IDs are derived from the turn (the same trace ID Langfuse gets),
+    so a turn drained from the queue again replaces its spans rather than adding a
+    second trace.
+    """
+    from opentelemetry import trace as otel_trace
+
+    def next_span(span_id: str, trace_id: str | None = None) -> None:
+        _otel_next_ids.trace_id = int(trace_id, 16) if trace_id else None
+        _otel_next_ids.span_id = int(span_id, 16)
+
+    session_id = turn.session_id
+    turn_num = turn.turn_num
+    project_name = turn.project_name
+    user_text = turn.user_text
+    final_output = turn.final_output
+    model = turn.model
+    all_tool_calls = turn.tool_calls
+
+    # Root span: "Turn {n}"
+    next_span(turn.span_id("turn"), turn.trace_id)
+    with tracer.start_as_current_span(
+        name=f"Turn {turn_num}",
+        attributes={
+            "session.id": session_id,
+            "turn.number": turn_num,
+            "project.name": project_name,
+            "source": "claude-code",
+            "tags": json.dumps(turn.tags),
+            "input": _truncate_for_attr(user_text),
+            "output": _truncate_for_attr(final_output),
+        },
+    ):
+        if otel_logger:
+            span_ctx = otel_trace.get_current_span().get_span_context()
+            tid = format(span_ctx.trace_id, "032x")
+            user_preview = _truncate_for_attr(user_text, 500)
+            output_preview = _truncate_for_attr(final_output, 500)
+            otel_logger.info(
+                "trace_id=%s Turn %d | user: %s", tid, turn_num, user_preview,
+                extra={"session.id": session_id, "project.name": project_name,
+                       "tool_count": len(all_tool_calls),
+                       "user.message": user_preview,
+                       "assistant.response": output_preview},
+            )
+
+        # Child span: "Claude Response"
+        next_span(turn.span_id("response"))
+        with tracer.start_as_current_span(
+            name="Claude Response",
+            attributes={
+                "session.id": session_id,
+                "llm.model": model,
+                "llm.input": _truncate_for_attr(user_text),
+                "llm.output": _truncate_for_attr(final_output),
+                "llm.tool_count": len(all_tool_calls),
+                "gen_ai.system": "anthropic",
+                "gen_ai.request.model": model,
+            },
+        ):
+            if otel_logger:
+                span_ctx = otel_trace.get_current_span().get_span_context()
+                tid = format(span_ctx.trace_id, "032x")
+                otel_logger.info(
+                    "trace_id=%s LLM response | model=%s tools=%d | %s", tid, model, len(all_tool_calls),
+                    _truncate_for_attr(final_output, 500),
+                    extra={"model": model, "tool_count": len(all_tool_calls),
+                           "response.preview": _truncate_for_attr(final_output, 500)},
+                )
+
+        # Child spans: "Tool: {name}"
+        for tool_call, span_id in zip(all_tool_calls, turn.tool_span_ids()):
+            tool_input_str = json.dumps(tool_call.input) if isinstance(tool_call.input, dict) else str(tool_call.input)
+            tool_output_str = str(tool_call.output) if tool_call.output else ""
+            next_span(span_id)
+            with tracer.start_as_current_span(
+                name=f"Tool: {tool_call.name}",
+                attributes={
+                    "session.id": session_id,
+                    "tool.name": tool_call.name,
+                    "tool.id": tool_call.id,
+                    "tool.input": _truncate_for_attr(tool_input_str),
+                    "tool.output": _truncate_for_attr(tool_output_str),
+                },
+            ):
+                if otel_logger:
+                    span_ctx = otel_trace.get_current_span().get_span_context()
+                    tid = format(span_ctx.trace_id, "032x")
+                    input_preview = _truncate_for_attr(tool_input_str, 500)
+                    output_preview = _truncate_for_attr(tool_output_str, 300)
+                    otel_logger.info(
+                        "trace_id=%s Tool: %s | input: %s | output: %s",
+                        tid, tool_call.name, input_preview, output_preview,
+                        extra={"tool.name": tool_call.name, "tool.id": tool_call.id,
+                               "tool.input": input_preview, "tool.output": output_preview},
+                    )
+
+    debug(f"Created OTEL trace for turn {turn_num}")
+
+
+class OtelTurnExporter:
+    """Exports turns to Grafana through the providers init_otel_providers() returned.
+
+    The batch processors send spans and log records in the background and at
+    flush(). Batches that fail are reported by trace ID through export_stats, so
+    the turns behind them (or every turn since the last flush, if the flush itself
+    doesn't complete) are handed back by take_undelivered(), like
+    LangfuseIngestionExporter does.
+    """
+
+    def __init__(self, otel: tuple):
+        self._tracer, self._trace_provider, self._logger, self._log_provider, self._stats = otel
+        self._pending: dict[int, Turn] = {}  # turns exported since the last flush, by trace ID
+        self._undelivered: list[Turn] = []
+
+    def export(self, turn: Turn) -> None:
+        create_otel_trace(self._tracer, turn, otel_logger=self._logger)
+        self._pending[int(turn.trace_id, 16)] = turn
+
+    def flush(self) -> bool:
+        """Send everything batched so far. Returns False (and logs) if anything wasn't delivered."""
+        pending, self._pending = self._pending, {}
+        try:
+            # The OTLP batch processors send everything for the run here
+            flushed = self._trace_provider.force_flush()
+            flushed = self._log_provider.force_flush() and flushed
+        except Exception as e:
+            log("ERROR", f"OTLP flush failed: {e}")
+            flushed = False
+        failed = self._stats.take_failed()
+        if not flushed:
+            log("ERROR", f"OTLP flush didn't complete, {len(pending)} turns not confirmed")
+            self._undelivered.extend(pending.values())
+        else:
+            self._undelivered.extend(turn for trace_id, turn in pending.items() if trace_id in failed)
+        return flushed and not failed
+
+    def take_undelivered(self) -> list[Turn]:
+        """Turns whose spans or log records failed to send since the last call."""
+        turns, self._undelivered = self._undelivered, []
+        return turns
+
+
+class BackendWorker(threading.Thread):
+    """Exports turns to one backend on its own thread, fed through a bounded queue.
+
+    Export errors are logged per turn and never stop the worker, so a slow or
+    failing backend only ever holds up its own queue. The backend's flush runs on
+    the worker thread too, once the queue is closed.
+
+    A turn that fails to export (or whose batch fails to send, as reported by
+    undelivered_fn after a flush) becomes a queue entry owed to this backend
+    only; the caller queues them from take_undelivered() once the worker is idle.
+
+    With a deadline (a time.monotonic() value), submit(), sync() and close() never
+    wait past it: a worker still busy by then is abandoned, and every turn it
+    hadn't flushed is handed back for the queue instead.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self, backend: str, export_fn, flush_fn=None, undelivered_fn=None, maxsize: int = BACKEND_QUEUE_SIZE,
+                 deadline: float | None = None):
+        super().__init__(name=f"export-{backend}", daemon=True)
+        self.backend = backend
+        self.deadline = deadline
+        self.abandoned = False
+        self._export_fn = export_fn
+        self._flush_fn = flush_fn
+        self._undelivered_fn = undelivered_fn
+        self._queue = queue.Queue(maxsize)
+        self._lock = threading.Lock()
+        self._unflushed: list[Turn] = []  # submitted and not yet covered by a flush, oldest first
+        self._taken = 0  # how many of _unflushed the worker has taken off its queue
+        # Turns taken since the last flush that exported, and that failed to
+        self._exported: list[Turn] = []
+        self._export_failed: list[Turn] = []
+        self._undelivered: list[dict] = []
+        self.exported = 0
+        self.failed = 0
+        self.spans = 0  # root span, response and one per tool call of each exported turn
+        self.busy_seconds = 0.0
+        self.flush_seconds = 0.0
+
+    def time_left(self) -> float | None:
+        """Seconds until the deadline (None without one)."""
+        return None if self.deadline is None else max(0.0, self.deadline - time.monotonic())
+
+    def submit(self, turn: Turn) -> None:
+        with self._lock:
+            abandoned = self.abandoned
+            if not abandoned:
+                self._unflushed.append(turn)
+        if abandoned:
+            self._hand_back([turn])
+            with self._lock:
+                self.failed += 1
+            return
+        try:
+            self._queue.put(turn, timeout=self.time_left())
+        except queue.Full:
+            self.abandon()
+
+    def close(self) -> None:
+        """Stop accepting turns; the worker flushes and exits once its queue is empty."""
+        try:
+            self._queue.put(self._CLOSE, timeout=self.time_left())
+        except queue.Full:
+            self.abandon()
+
+    def sync(self) -> threading.Event:
+        """Ask the worker to flush everything submitted so far; the event is set once it has."""
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=self.time_left())
+        except queue.Full:
+            self.abandon()
+        if self.abandoned:
+            done.set()
+        return done
+
+    def abandon(self) -> None:
+        """Give up on a worker that missed its deadline: hand back every turn it hasn't flushed.
+
+        The thread is left to finish (or hang) on its own; whatever it does later is ignored.
+        A worker with nothing unflushed has nothing to hand back and is just left to exit.
+        """
+        with self._lock:
+            if self.abandoned or not self._unflushed:
+                return
+            self.abandoned = True
+            turns, self._unflushed = self._unflushed, []
+            # Exported but never flushed counts as failed, like the rest
+            self.exported -= len(self._exported)
+            self.spans -= sum(2 + len(turn.tool_calls) for turn in self._exported)
+            self.failed += len(turns) - len(self._export_failed)
+            self._exported, self._export_failed = [], []
+        log("WARN", f"{self.backend} export still busy at the run deadline, queuing {len(turns)} turns for it")
+        self._hand_back(turns)
+
+    def take_undelivered(self) -> list[dict]:
+        """Queue entries for the turns this backend failed to receive since the last call."""
+        with self._lock:
+            entries, self._undelivered = self._undelivered, []
+        return entries
+
+    def _queue_entries(self, turns: list[Turn]) -> list[dict]:
+        entries = []
+        for turn in turns:
+            try:
+                entries.append(queue_entry(turn, [self.backend]))
+            except OSError as e:
+                log("ERROR", f"Can't queue turn {turn.turn_num} for {self.backend}: {e}")
+        return entries
+
+    def _hand_back(self, turns: list[Turn]) -> None:
+        entries = self._queue_entries(turns)
+        with self._lock:
+            self._undelivered += entries
+
+    def _flush(self) -> None:
+        start = time.perf_counter()
+        if self._flush_fn:
+            try:
+                self._flush_fn()
+            except Exception as e:
+                log("ERROR", f"Failed to flush {self.backend}: {e}")
+        undelivered = self._undelivered_fn() if self._undelivered_fn else []
+        entries = self._queue_entries(self._export_failed + undelivered)
+        with self._lock:
+            if self.abandoned:
+                return  # abandon() already handed back everything unflushed
+            # The turns taken before this flush are now delivered or handed back
+            self._undelivered += entries
+            self._exported, self._export_failed = [], []
+            del self._unflushed[:self._taken]
+            self._taken = 0
+            for turn in undelivered:
+                self.failed += 1
+                self.exported -= 1
+                self.spans -= 2 + len(turn.tool_calls)
+        self.flush_seconds += time.perf_counter() - start
+
+    def run(self) -> None:
+        while not self.abandoned:
+            turn = self._queue.get()
+            start = time.perf_counter()
+            if turn is self._CLOSE:
+                self._flush()
+                self.busy_seconds += time.perf_counter() - start
+                return
+            if isinstance(turn, threading.Event):
+                self._flush()
+                turn.set()
+                self.busy_seconds += time.perf_counter() - start
+                continue
+            with self._lock:
+                self._taken += 1
+            try:
+                self._export_fn(turn)
+                ok = True
+            except Exception as e:
+                ok = False
+                log("ERROR", f"Failed to create {self.backend} trace for turn {turn.turn_num}: {e}")
+            with self._lock:
+                if self.abandoned:
+                    return  # the turn was handed back with the rest
+                if ok:
+                    self.exported += 1
+                    self.spans += 2 + len(turn.tool_calls)
+                    self._exported.append(turn)
+                else:
+                    self.failed += 1
+                    self._export_failed.append(turn)
+            self.busy_seconds += time.perf_counter() - start
+
+
+class ExportFanout:
+    """Hands each canonical turn to every backend worker so backends export in parallel.
+
+    Used as the single trace creator for process_transcript/drain_queue; wall time
+    approaches the slowest backend instead of the sum of all of them. A deadline
+    applies to every worker (see BackendWorker).
+    """
+
+    def __init__(self, workers: list[BackendWorker], deadline: float | None = None):
+        self.workers = workers
+        self._closed = False
+        for worker in workers:
+            if deadline is not None:
+                worker.deadline = deadline
+            worker.start()
+
+    def submit(self, turn: Turn) -> None:
+        for worker in self.workers:
+            worker.submit(turn)
+
+    def sync(self) -> None:
+        """Block until every worker has exported and flushed the turns submitted so far (or is abandoned)."""
+        for worker, done in [(worker, worker.sync()) for worker in self.workers]:
+            if not done.wait(worker.time_left()):
+                worker.abandon()
+
+    def close(self) -> None:
+        """Wait for every worker to export its queue and flush (or be abandoned). Safe to call twice."""
+        if self._closed:
+            return
+        self._closed = True
+        for worker in self.workers:
+            worker.close()
+        for worker in self.workers:
+            worker.join(worker.time_left())
+            if worker.is_alive():
+                worker.abandon()
+
+    def summary(self) -> str:
+        return ", ".join(
+            f"{w.backend} {w.busy_seconds:.1f}s ({w.exported} ok, {w.failed} failed{', abandoned' if w.abandoned else ''})"
+            for w in self.workers
+        )
+
+
+class RunBudget:
+    """Wall-clock budget for one hook invocation (RUN_BUDGET_SECONDS, 0 for no limit).
+
+    Work checks expired() between turns and stops once it returns True; whatever is
+    left is handed to the next run. `exhausted` stays set after the first expiry.
+    """
+
+    def __init__(self, seconds: float = RUN_BUDGET_SECONDS):
+        self.deadline = time.monotonic() + seconds if seconds > 0 else None
+        self.exhausted = False
+
+    def expired(self) -> bool:
+        if not self.exhausted and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.exhausted = True
+        return self.exhausted
+
+    def flush_deadline(self) -> float | None:
+        """When the backends must be done sending what the run handed them (None without a limit).
+
+        Dispatching stops at the deadline; the final flush gets FLUSH_GRACE_SECONDS
+        on top, so a healthy backend still delivers the turns of a run cut short.
+        """
+        return None if self.deadline is None else self.deadline + FLUSH_GRACE_SECONDS
+
+    def share(self, ways: int) -> "RunBudget":
+        """An equal share of the time left, split `ways` ways; spending it doesn't exhaust this budget."""
+        share = RunBudget(0)
+        if self.deadline is not None:
+            now = time.monotonic()
+            share.deadline = now + max(0.0, self.deadline - now) / max(1, ways)
+        return share
+
+
+class RunMetrics:
+    """Per-phase wall time and counters of one hook run, appended as a JSON line to METRICS_FILE.
+
+    Phases (seconds) and counters add up over everything the run does. Backend
+    phases are per backend ("export.langfuse", "flush.grafana") and measured on
+    the export worker threads, so they overlap the phases of the main thread.
+    """
+
+    def __init__(self, kind: str = "hook"):
+        self.kind = kind
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.phases: dict[str, float] = {}
+        self.counters: dict[str, int] = {}
+
+    def add(self, phase: str, seconds: float) -> None:
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def count(self, counter: str, n: int = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + n
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def record(self) -> dict:
+        return {
+            "time": datetime.fromtimestamp(self.started, timezone.utc).isoformat(),
+            "kind": self.kind,
+            "pid": os.getpid(),
+            "duration": round(time.perf_counter() - self._start, 4),
+            "phases": {name: round(seconds, 4) for name, seconds in sorted(self.phases.items())},
+            "counters": dict(sorted(self.counters.items())),
+        }
+
+    def write(self) -> None:
+        """Append this run's record to METRICS_FILE; a failed write is only logged."""
+        try:
+            METRICS_FILE.parent.mkdir(parents=True, exist_ok=True)
+            with open(METRICS_FILE, "a") as f:
+                f.write(json.dumps(self.record(), separators=(",", ":")) + "\n")
+        except OSError as e:
+            debug(f"Could not write run metrics: {e}")
+
+
+def process_transcript(
+    session_id: str,
+    transcript_file: Path,
+    state: dict,
+    project_name: str = "",
+    trace_creators: list = None,
+    stop_event: bool = False,
+    budget: RunBudget | None = None,
+    persist: bool = True,
+    metrics: RunMetrics | None = None,
+    sync=None,
+) -> int:
+    """Process a transcript file and create traces for new turns via all enabled backends.
+
+    Runs as a streaming pipeline: appended lines are read one at a time, decoded,
+    assembled into turns, and each completed turn is handed to the trace creators
+    and released before the next one is read, so memory stays flat regardless of
+    transcript size. A turn still in flight is checkpointed to state and resumed on
+    the next run. stop_event marks the session whose Stop hook triggered this run.
+
+    Progress is checkpointed to state after exported turns (at most every
+    CHECKPOINT_SECONDS), so a run that is killed resumes close to where it stopped.
+    Trace creators may only buffer a turn; sync(), if given, is called before a
+    checkpoint is saved so that it never covers a turn no backend has. When the
+    budget runs out the transcript is left after the last exported turn and
+    budget.exhausted tells the caller it was cut short. With persist=False progress
+    is only kept in state, for a caller that saves it itself. Time spent reading,
+    decoding, assembling, dispatching turns and saving state goes to metrics.
+    """
+    if trace_creators is None:
+        trace_creators = []
+    if metrics is None:
+        metrics = RunMetrics()
+    # Get previous state for this session
+    session_state = state.get(session_id, {})
+
+    def export(messages: tuple[dict, list, dict], turn_num: int) -> None:
+        # Build the canonical turn once; every backend shares it
+        start = clock()
+        turn = build_turn(session_id, turn_num, *messages, project_name)
+        turn.source = (transcript_file, *assembler.span)
+        built = clock()
+        for creator_name, creator_fn in trace_creators:
+            try:
+                creator_fn(turn)
+            except Exception as e:
+                log("ERROR", f"Failed to create {creator_name} trace for turn {turn_num}: {e}")
+        seconds["assemble"] += built - start
+        seconds["dispatch"] += clock() - built
+
+    def save_progress() -> None:
+        nonlocal synced
+        if persist and sync is not None and synced < turns:
+            with metrics.phase("backend_wait"):
+                sync()
+            synced = turns
+        with metrics.phase("state_save"):
+            # Everything up to reader.offset is exported or held by the assembler checkpoint
+            state[session_id] = {
+                "offset": reader.offset,
+                "fingerprint": reader.fingerprint(),
+                "turn_count": turn_count + turns,
+                "updated": datetime.now(timezone.utc).isoformat(),
+            }
+            checkpoint = assembler.checkpoint()
+            if checkpoint:
+                state[session_id]["assembler"] = checkpoint
+            if persist:
+                save_session(state, session_id)
+
+    # Phase times are summed locally (a context manager per line or turn would cost more than
+    # the work it times) and added to metrics once
+    clock = time.perf_counter
+    seconds = {"read": 0.0, "decode": 0.0, "assemble": 0.0, "dispatch": 0.0}
+    turns = synced = 0
+    with open(transcript_file, "rb") as f:
+        reader = TranscriptReader(f, session_state)
+        # Turn numbering (and any open turn) restarts if the transcript is re-read from the start
+        resumed = reader.start_offset > 0
+        turn_count = session_state.get("turn_count", 0) if resumed else 0
+        assembler = TurnAssembler(session_state.get("assembler") if resumed else None)
+
+        cut_short = False
+        last_save = time.monotonic()
+        read_seconds = decode_seconds = feed_seconds = 0.0
+        lines = 0
+        mark = clock()
+        for line in reader.lines():
+            read = clock()
+            msg = decode_message(line)
+            decoded = clock()
+            turn = assembler.feed(msg, reader.line_start) if msg is not None else None
+            assembled = clock()
+            read_seconds += read - mark
+            decode_seconds += decoded - read
+            feed_seconds += assembled - decoded
+            lines += 1
+            mark = assembled
+            if turn:
+                turns += 1
+                export(turn, turn_count + turns)
+                if budget is not None and budget.expired():
+                    cut_short = True
+                    break
+                if time.monotonic() - last_save >= CHECKPOINT_SECONDS:
+                    save_progress()
+                    last_save = time.monotonic()
+                mark = clock()
+
+        if not cut_short:
+            idle = time.time() - transcript_file.stat().st_mtime >= TURN_IDLE_SECONDS
+            final_turn = assembler.finish(stop_event=stop_event or idle, end=reader.offset)
+            if final_turn:
+                turns += 1
+                export(final_turn, turn_count + turns)
+
+        seconds["read"] += read_seconds
+        seconds["decode"] += decode_seconds
+        seconds["assemble"] += feed_seconds
+        for phase, phase_seconds in seconds.items():
+            metrics.add(phase, phase_seconds)
+        metrics.count("lines", lines)
+        metrics.count("bytes_read", reader.offset - reader.start_offset)
+
+        if reader.offset == reader.start_offset and not turns:
+            debug(f"No new lines to process (offset: {reader.start_offset})")
+            return 0
+        save_progress()
+
+    debug(f"Processed {reader.offset - reader.start_offset} new bytes" + (" (run budget spent)" if cut_short else ""))
+    return turns
+
+
+def has_open_turn(state: dict, session_id: str) -> bool:
+    """Whether a session has a turn still in flight (kept out of the index until it closes)."""
+    return "assembler" in state.get(session_id, {})
+
+
+def enabled_backends() -> tuple[bool, bool]:
+    """Which backends are switched on: (langfuse, grafana)."""
+    return (
+        os.environ.get("TRACE_TO_LANGFUSE", "").lower() == "true",
+        os.environ.get("TRACE_TO_GRAFANA", "").lower() == "true",
+    )
+
+
+class HookResources:
+    """Backend clients plus the loaded state and transcript index.
+
+    A one-shot hook run builds these, uses them once and shuts them down. The
+    daemon keeps one instance for its whole lifetime, so the Langfuse client, the
+    OTLP providers and their connection pools stay warm. State and index stay in
+    memory and are re-read only when another process has changed the files.
+
+    langfuse_exporter overrides CC_LANGFUSE_EXPORTER. The ingestion exporter is
+    built either way: with the SDK it exports replayed turns.
+    """
+
+    def __init__(self, langfuse_exporter: str | None = None):
+        self.langfuse_exporter = langfuse_exporter
+        self.langfuse_client = None
+        self.ingestion = None
+        self.otel = None  # (tracer, trace_provider, logger, log_provider, export_stats)
+        self._state = None
+        self._index = None
+        self._signature = None
+
+    def langfuse(self, host: str, public_key: str, secret_key: str):
+        if self.langfuse_client is None:
+            self.ingestion = LangfuseIngestionExporter(host, public_key, secret_key)
+            if (self.langfuse_exporter or LANGFUSE_EXPORTER) == "ingestion":
+                # Batched events straight to the ingestion API; same flush()/shutdown() as the SDK
+                self.langfuse_client = self.ingestion
+            else:
+                from langfuse import Langfuse
+
+                self.langfuse_client = Langfuse(public_key=public_key, secret_key=secret_key, host=host)
+        return self.langfuse_client
+
+    def otel_providers(self, endpoint: str, instance_id: str, api_token: str) -> tuple:
+        if self.otel is None:
+            self.otel = init_otel_providers(endpoint, instance_id, api_token)
+        return self.otel
+
+    def load(self) -> tuple[dict, dict]:
+        """State and transcript index, from memory unless the files changed since the last run."""
+        if self._index is None or self._files_signature() != self._signature:
+            self._state = load_state()
+            self._index = load_index()
+        return self._state, self._index
+
+    def saved(self) -> None:
+        """Remember the files as this process left them."""
+        self._signature = self._files_signature()
+
+    def _files_signature(self) -> list:
+        if STATE_BACKEND == "sqlite":
+            paths = [STATE_DB, STATE_DB.with_name(STATE_DB.name + "-wal"), INDEX_FILE]
+        else:
+            paths = [STATE_FILE, INDEX_FILE]
+        signature = []
+        for path in paths:
+            try:
+                stat = path.stat()
+                signature.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append(None)
+        return signature
+
+    def discard(self, backend: str) -> None:
+        """Drop a backend's client without flushing it, e.g. when its worker was abandoned mid-export.
+
+        The next run builds a new one.
+        """
+        if backend == "langfuse":
+            self.langfuse_client = self.ingestion = None
+        elif backend == "grafana":
+            self.otel = None
+
+    def shutdown(self) -> None:
+        if self.langfuse_client:
+            self.langfuse_client.shutdown()
+            if self.ingestion is not self.langfuse_client:
+                self.ingestion.shutdown()
+        if self.otel:
+            _, otel_provider, _, otel_log_provider, _ = self.otel
+            if hasattr(otel_provider, "shutdown"):
+                otel_provider.shutdown()
+            if hasattr(otel_log_provider, "shutdown"):
+                otel_log_provider.shutdown()
+        self.langfuse_client = self.ingestion = self.otel = None
+
+
+def backend_settings() -> dict[str, tuple[str, str, str]]:
+    """Connection settings of each enabled backend whose configuration is valid.
+
+    Maps "langfuse" to (host, public_key, secret_key) and "grafana" to
+    (endpoint, instance_id, api_token); the first item is what health checks probe.
+    Misconfigured backends are logged and left out.
+    """
+    langfuse_enabled, grafana_enabled = enabled_backends()
+    settings = {}
+
+    # Validate Langfuse config
+    if langfuse_enabled:
+        if LANGFUSE_EXPORTER != "ingestion" and not _module_available("langfuse"):
+            log("ERROR", "TRACE_TO_LANGFUSE=true but langfuse package not installed")
+        else:
+            public_key = os.environ.get("CC_LANGFUSE_PUBLIC_KEY") or os.environ.get("LANGFUSE_PUBLIC_KEY")
+            secret_key = os.environ.get("CC_LANGFUSE_SECRET_KEY") or os.environ.get("LANGFUSE_SECRET_KEY")
+            langfuse_host = os.environ.get("CC_LANGFUSE_HOST") or os.environ.get("LANGFUSE_HOST", "https://cloud.langfuse.com")
+            if not public_key or not secret_key:
+                log("ERROR", "Langfuse API keys not set")
+            else:
+                settings["langfuse"] = (langfuse_host, public_key, secret_key)
+
+    # Validate Grafana config
+    if grafana_enabled:
+        if not all(_module_available(name) for name in OTEL_MODULES):
+            log("ERROR", "TRACE_TO_GRAFANA=true but opentelemetry packages not installed")
+        else:
+            grafana_endpoint = os.environ.get("GRAFANA_OTLP_ENDPOINT")
+            grafana_instance_id = os.environ.get("GRAFANA_INSTANCE_ID")
+            grafana_api_token = os.environ.get("GRAFANA_WRITE_TOKEN") or os.environ.get("GRAFANA_API_TOKEN")
+            if not grafana_endpoint or not grafana_instance_id or not grafana_api_token:
+                log("ERROR", "Grafana OTLP credentials not set (GRAFANA_OTLP_ENDPOINT, GRAFANA_INSTANCE_ID, GRAFANA_WRITE_TOKEN)")
+            else:
+                settings["grafana"] = (grafana_endpoint, grafana_instance_id, grafana_api_token)
+
+    return settings
+
+
+def backend_workers(resources: HookResources, settings: dict[str, tuple[str, str, str]]) -> list[BackendWorker]:
+    """An export worker (not yet started) for each backend in settings, using resources' clients."""
+    workers = []
+
+    if "langfuse" in settings:
+        try:
+            exporter = resources.langfuse(*settings["langfuse"])
+            if not isinstance(exporter, LangfuseIngestionExporter):
+                exporter = LangfuseSdkExporter(exporter, resources.ingestion)
+            workers.append(BackendWorker(
+                "langfuse", exporter.export, flush_fn=exporter.flush, undelivered_fn=exporter.take_undelivered,
+            ))
+        except Exception as e:
+            log("ERROR", f"Failed to initialize Langfuse: {e}")
+
+    if "grafana" in settings:
+        try:
+            exporter = OtelTurnExporter(resources.otel_providers(*settings["grafana"]))
+            workers.append(BackendWorker(
+                "grafana", exporter.export, flush_fn=exporter.flush, undelivered_fn=exporter.take_undelivered,
+            ))
+        except Exception as e:
+            log("ERROR", f"Failed to initialize OTEL providers: {e}")
+
+    return workers
+
+
+def run_hook(
+    payloads: list[dict],
+    resources: HookResources | None = None,
+    budget: RunBudget | None = None,
+    metrics: RunMetrics | None = None,
+) -> None:
+    """One hook run for the given Stop payloads; the caller holds the run lock.
+
+    Payloads recorded by invocations that found the lock busy are picked up before
+    the run finishes. Without resources, clients are built for this run only.
+
+    Work is done in priority order until the budget runs out: the transcripts named
+    by the Stop payloads, then the offline queue, then the backlog (transcripts an
+    earlier run left unfinished and stale ones found by the sweep) ranked by lag,
+    then payloads recorded while the run was working. Each transcript, and the
+    queue, gets an equal share of the time left, so no single one can use up
+    every run. Transcripts left over go back to the dirty file as backlog.
+
+    Phase timings and counters are added to metrics; the caller writes them out.
+    """
+    script_start = datetime.now()
+    if budget is None:
+        budget = RunBudget()
+    if metrics is None:
+        metrics = RunMetrics()
+    owns_resources = resources is None
+    if owns_resources:
+        resources = HookResources()
+
+    settings = backend_settings()
+    if not settings:
+        log("ERROR", "All tracing backends failed configuration validation")
+        return
+
+    # Load state and the transcript index
+    with metrics.phase("state_load"):
+        state, index = resources.load()
+
+    stop_transcripts = set()
+
+    def resolve(payloads: list[dict]) -> tuple[list, list]:
+        """Split payloads into transcripts whose Stop hook fired and backlog handed over by earlier runs."""
+        current = payload_transcripts([p for p in payloads if not p.get("backlog")], state, index)
+        stop_transcripts.update(transcript_file for _, transcript_file, _ in current)
+        backlog = payload_transcripts([p for p in payloads if p.get("backlog")], state, index)
+        return current, [found for found in backlog if found[1] not in stop_transcripts]
+
+    def payload_entries() -> list:
+        # Index entries of the payload transcripts; discovery replaces one when it (re)reads a file
+        return [index["files"].get(str(Path(payload["transcript_path"]).expanduser()))
+                for payload in payloads if payload.get("transcript_path")]
+
+    with metrics.phase("discovery"):
+        # Fast path: the Stop payloads name the transcripts that just changed
+        entries_before = payload_entries()
+        current_transcripts, backlog = resolve(payloads)
+
+        # Full sweep when run without a payload, or periodically
+        swept = any(not payload.get("transcript_path") for payload in payloads) or sweep_due(index)
+        if swept:
+            known = stop_transcripts | {transcript_file for _, transcript_file, _ in backlog}
+            backlog += [found for found in find_modified_transcripts(state, index=index) if found[1] not in known]
+        backlog = rank_backlog(backlog, state, index)
+    backlog_note = f", backlog lag [{format_lag(backlog, state, index)}]" if backlog else ""
+
+    def dirty_transcripts() -> list[tuple[str, Path, str]]:
+        # Transcripts recorded by invocations that found the lock busy while this run was working
+        if budget.expired():
+            return []
+        with metrics.phase("discovery"):
+            current, handed_over = resolve(take_dirty())
+            return current + rank_backlog(handed_over, state, index)
+
+    leftover = []
+    started = False
+
+    def process_batch(batch: list[tuple[str, Path, str]], trace_creators: list, later: int = 0, sync=None) -> tuple[int, int]:
+        """Process transcripts in order until the budget runs out. Returns (turns, sessions).
+
+        Each transcript gets an equal share of the time left, counting the `later`
+        shares still to come after this batch; one that runs out of its share is
+        left over and the next one starts. The first transcript of the run always
+        exports at least one turn, so a run whose budget went on health checks
+        still makes progress. sync flushes the export workers before a checkpoint.
+        """
+        nonlocal started
+        turns = sessions = 0
+        for i, (session_id, transcript_file, project_name) in enumerate(batch):
+            if started and budget.expired():
+                leftover.extend(batch[i:])
+                break
+            started = True
+            share = budget.share(len(batch) - i + later)
+            try:
+                session_turns = process_transcript(
+                    session_id, transcript_file, state, project_name,
+                    trace_creators=trace_creators,
+                    stop_event=transcript_file in stop_transcripts,
+                    budget=share,
+                    metrics=metrics,
+                    sync=sync,
+                )
+            except Exception as e:
+                log("ERROR", f"Failed to process session {session_id}: {e}")
+                import traceback
+                debug(traceback.format_exc())
+                continue
+            turns += session_turns
+            sessions += 1
+            debug(f"Processed {session_turns} turns from session {session_id}")
+            if share.exhausted:
+                # Cut short mid-transcript; its state checkpoint says where to resume
+                leftover.append((session_id, transcript_file, project_name))
+            elif not has_open_turn(state, session_id):
+                mark_transcript_processed(index, transcript_file, state.get(session_id, {}).get("offset"))
+        return turns, sessions
+
+    def hand_over_leftover() -> str:
+        """Record unfinished transcripts as backlog for the next run; returns a note for the summary."""
+        for session_id, transcript_file, _ in leftover:
+            mark_dirty({"session_id": session_id, "transcript_path": str(transcript_file), "backlog": True})
+        if not leftover:
+            return ""
+        spent = f"run budget of {RUN_BUDGET_SECONDS:g}s spent, " if budget.exhausted else ""
+        return f", {spent}behind [{format_lag(rank_backlog(leftover, state, index), state, index)}]"
+
+    if not current_transcripts and not backlog:
+        debug("No modified transcripts found")
+        # A no-op Stop event leaves the index file alone unless it swept or indexed a new transcript
+        if swept or any(before is not after for before, after in zip(entries_before, payload_entries())):
+            with metrics.phase("state_save"):
+                save_index(index)
+        return
+
+    debug(f"Found {len(current_transcripts) + len(backlog)} modified session(s) to process")
+
+    # Health-check each backend independently, then start an export worker for each one that is up
+    with metrics.phase("health_check"):
+        reachable = {name: config for name, config in settings.items() if backend_reachable(index, name, config[0])}
+    with metrics.phase("backend_setup"):
+        workers = backend_workers(resources, reachable)
+    # HTTP counters are cumulative when the clients outlive the run
+    otel_export_stats = resources.otel[4] if any(worker.backend == "grafana" for worker in workers) else None
+    if otel_export_stats:
+        otlp_requests_before, otlp_bytes_before = otel_export_stats.requests, otel_export_stats.bytes_sent
+    ingestion = resources.ingestion if "langfuse" in reachable else None
+    if ingestion:
+        ingestion_requests_before, ingestion_bytes_before = ingestion.requests, ingestion.bytes_sent
+
+    def record_backends() -> None:
+        # Worker thread time per backend, and what went over the wire this run
+        for worker in workers:
+            metrics.add(f"export.{worker.backend}", worker.busy_seconds - worker.flush_seconds)
+            metrics.add(f"flush.{worker.backend}", worker.flush_seconds)
+            metrics.count(f"turns.{worker.backend}", worker.exported)
+            metrics.count(f"failed.{worker.backend}", worker.failed)
+            metrics.count(f"spans.{worker.backend}", worker.spans)
+        if otel_export_stats:
+            metrics.count("http_requests.grafana", otel_export_stats.requests - otlp_requests_before)
+            metrics.count("bytes_sent.grafana", otel_export_stats.bytes_sent - otlp_bytes_before)
+        if ingestion:
+            metrics.count("http_requests.langfuse", ingestion.requests - ingestion_requests_before)
+            metrics.count("bytes_sent.langfuse", ingestion.bytes_sent - ingestion_bytes_before)
+
+    # Turns for enabled backends that are down (or failed to start) are queued for those backends only
+    enabled = list(settings)
+    down = [name for name in enabled if name not in {worker.backend for worker in workers}]
+
+    # If no backends available, queue everything
+    if not workers:
+        log("WARN", "No backends reachable, queuing traces locally")
+
+        total_turns_queued = 0
+        total_sessions = 0
+        batch = current_transcripts + backlog
+        while batch:
+            turns, sessions = process_batch(batch, [("queue", lambda turn: queue_turn(turn, down))])
+            total_turns_queued += turns
+            total_sessions += sessions
+            batch = dirty_transcripts()
+
+        with metrics.phase("state_save"):
+            save_index(index)
+        budget_note = hand_over_leftover()
+        metrics.count("turns_queued", total_turns_queued)
+        metrics.count("sessions", total_sessions)
+        metrics.count("sessions_left", len(leftover))
+        duration = (datetime.now() - script_start).total_seconds()
+        log("INFO", f"Queued {total_turns_queued} turns from {total_sessions} sessions in {duration:.1f}s{backlog_note}{budget_note}")
+        if owns_resources:
+            resources.shutdown()
+        return
+
+    # Every turn is built once and handed to each backend worker, which export in parallel
+    fanout = ExportFanout(workers, deadline=budget.flush_deadline())
+    backend_creators = [(worker.backend, worker.submit) for worker in workers]
+    trace_creators = list(backend_creators)
+    if down:
+        log("WARN", f"{', '.join(down)} not reachable, queuing its traces locally")
+        trace_creators.append(("queue", lambda turn: queue_turn(turn, down)))
+    requeued = {}
+
+    def requeue_undelivered() -> None:
+        # Turns a backend failed to receive go back in the queue for that backend alone
+        for worker in workers:
+            for entry in worker.take_undelivered():
+                queue_trace(entry)
+                requeued[worker.backend] = requeued.get(worker.backend, 0) + 1
+
+    def sync() -> None:
+        fanout.sync()
+        requeue_undelivered()
+
+    try:
+        # The sessions that just stopped come first; the queue and each backlog session get a share of the rest
+        total_turns, total_sessions = process_batch(current_transcripts, trace_creators, later=1 + len(backlog), sync=sync)
+        # A backend that just failed to take turns (now queued for it) isn't retried in the same run
+        retry_creators = [(worker.backend, worker.submit) for worker in workers if not worker.failed]
+        with metrics.phase("queue_drain"):
+            drained = drain_queue(retry_creators, sync=sync, budget=budget.share(1 + len(backlog)), consumers=enabled)
+
+        # Then the backlog by lag, and any transcripts recorded by runs that found the lock busy
+        batch = backlog
+        while batch:
+            turns, sessions = process_batch(batch, trace_creators, sync=sync)
+            total_turns += turns
+            total_sessions += sessions
+            batch = dirty_transcripts()
+        with metrics.phase("state_save"):
+            save_index(index)
+        budget_note = hand_over_leftover()
+
+        # Wait for all backends to finish exporting and flushing
+        with metrics.phase("backend_wait"):
+            fanout.close()
+        requeue_undelivered()
+        metrics.count("turns", total_turns)
+        metrics.count("sessions", total_sessions)
+        metrics.count("sessions_left", len(leftover))
+        metrics.count("queue_drained", drained)
+        metrics.count("requeued", sum(requeued.values()))
+
+        # Log execution time
+        duration = (datetime.now() - script_start).total_seconds()
+        export_summary = ""
+        if otel_export_stats:
+            otlp_requests = otel_export_stats.requests - otlp_requests_before
+            otlp_kb = (otel_export_stats.bytes_sent - otlp_bytes_before) / 1024
+            export_summary = f", otlp {otlp_requests} requests / {otlp_kb:.1f} KB"
+        if requeued:
+            export_summary += ", requeued " + ", ".join(f"{count} for {backend}" for backend, count in requeued.items())
+        log("INFO", f"Processed {total_turns} turns to [{fanout.summary()}] from {total_sessions} sessions "
+                    f"(drained {drained} from queue) in {duration:.1f}s{export_summary}{backlog_note}{budget_note}")
+
+    except Exception as e:
+        log("ERROR", f"Failed to process transcripts: {e}")
+        import traceback
+        debug(traceback.format_exc())
+    finally:
+        fanout.close()
+        requeue_undelivered()
+        record_backends()
+        for worker in workers:
+            if worker.abandoned:
+                resources.discard(worker.backend)
+        if owns_resources:
+            resources.shutdown()
+
+
+def run_single_flight(payloads: list[dict], resources: HookResources | None = None) -> bool:
+    """Run the hook under the run lock, or hand the payloads to the run holding it.
+
+    All runs of one invocation share a single RunBudget; each run appends its
+    RunMetrics record to METRICS_FILE. Returns False if another run was active and
+    got the payloads instead.
+    """
+    lock = acquire_run_lock()
+    if lock is None:
+        for payload in payloads:
+            mark_dirty(payload)
+        return False
+
+    budget = RunBudget()
+    while lock:
+        metrics = RunMetrics()
+        try:
+            run_hook(payloads + take_dirty(), resources, budget=budget, metrics=metrics)
+        finally:
+            metrics.write()
+            if resources:
+                resources.saved()
+            release_run_lock(lock)
+        # An invocation that found the lock busy after the run's last check has exited; take over its work.
+        # Once the budget is spent, what's left in the dirty file waits for the next invocation.
+        lock = acquire_run_lock() if dirty_pending() and not budget.expired() else None
+        payloads = []
+    return True
+
+
+def send_to_daemon(payload: dict) -> bool:
+    """Hand the Stop payload to a running export daemon. Returns False if none answers."""
+    if not DAEMON_SOCKET.exists():
+        return False
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(DAEMON_CLIENT_TIMEOUT)
+            sock.connect(str(DAEMON_SOCKET))
+            sock.sendall(json.dumps(payload).encode() + b"\n")
+            return sock.recv(16).startswith(b"ok")
+    except OSError as e:
+        debug(f"Export daemon not reachable ({e}), running in-process")
+        return False
+
+
+def spawn_detached(target) -> bool:
+    """Run target() in a double-forked process detached from the hook.
+
+    The worker gets its own session and /dev/null for stdio, so Claude Code, which
+    waits for the hook's output pipes to close, is not held up by it. Returns
+    False if forking failed.
+    """
+    try:
+        pid = os.fork()
+    except OSError as e:
+        log("WARN", f"Could not fork export worker: {e}")
+        return False
+    if pid:
+        os.waitpid(pid, 0)  # the intermediate child exits right after the second fork
+        return True
+
+    try:
+        os.setsid()
+        if os.fork():
+            os._exit(0)
+        devnull = os.open(os.devnull, os.O_RDWR)
+        for fd in (0, 1, 2):
+            os.dup2(devnull, fd)
+        target()
+    except BaseException as e:
+        log("ERROR", f"Detached export worker failed: {e}")
+    finally:
+        flush_log()  # os._exit() skips atexit
+        os._exit(0)
+
+
+def serve_daemon() -> None:
+    """Long-lived export daemon listening on DAEMON_SOCKET.
+
+    Stop hooks connect, send their payload and get "ok" back as soon as it is
+    recorded in the dirty file, so the file doubles as a durable inbox that any
+    run (daemon or in-process fallback) can pick up. The main thread runs the hook
+    with warm HookResources whenever payloads arrive, and at least every
+    SWEEP_INTERVAL_MINUTES so queued turns drain without new activity.
+    """
+    import socket
+
+    DAEMON_SOCKET.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        DAEMON_SOCKET.unlink()  # stale socket from a daemon that didn't exit cleanly
+    except FileNotFoundError:
+        pass
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(str(DAEMON_SOCKET))
+    server.listen(64)
+    wakeup = threading.Event()
+    stopping = threading.Event()
+
+    def accept_loop() -> None:
+        while not stopping.is_set():
+            try:
+                conn, _ = server.accept()
+            except OSError:
+                return  # listener closed
+            with conn:
+                try:
+                    conn.settimeout(DAEMON_CLIENT_TIMEOUT)
+                    data = b""
+                    while not data.endswith(b"\n"):
+                        chunk = conn.recv(65536)
+                        if not chunk:
+                            break
+                        data += chunk
+                    payload = json.loads(data) if data.strip() else {}
+                    mark_dirty(payload if isinstance(payload, dict) else {})
+                    conn.sendall(b"ok\n")
+                    wakeup.set()
+                except (OSError, json.JSONDecodeError) as e:
+                    debug(f"Dropped daemon client: {e}")
+
+    def stop(signum, frame) -> None:
+        stopping.set()
+        wakeup.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    threading.Thread(target=accept_loop, name="daemon-accept", daemon=True).start()
+    log("INFO", f"Export daemon listening on {DAEMON_SOCKET} (pid {os.getpid()})")
+
+    resources = HookResources()
+    try:
+        while not stopping.is_set():
+            wakeup.wait(timeout=SWEEP_INTERVAL_MINUTES * 60)
+            wakeup.clear()
+            if stopping.is_set():
+                break
+            try:
+                if run_single_flight([], resources) and dirty_pending():
+                    wakeup.set()  # work left over when the run budget ran out
+            except Exception as e:
+                log("ERROR", f"Daemon run failed: {e}")
+                import traceback
+                debug(traceback.format_exc())
+            flush_log()
+    finally:
+        server.close()
+        DAEMON_SOCKET.unlink(missing_ok=True)
+        resources.shutdown()
+        log("INFO", "Export daemon stopped")
+
+
+class RateLimiter:
+    """Token bucket shared by every process of a backfill: at most `rate` turns per second overall.
+
+    The bucket (tokens, time of last refill) lives in shared memory, so all parse
+    workers draw from one budget however many there are. It holds at most a
+    second's worth of tokens, which bounds bursts. A rate of 0 disables it.
+    """
+
+    def __init__(self, rate: float):
+        import multiprocessing
+
+        self.rate = rate
+        self._capacity = max(rate, 1.0)
+        self._bucket = multiprocessing.Array("d", [self._capacity, time.monotonic()])
+
+    def acquire(self, tokens: float = 1.0) -> None:
+        """Block until `tokens` are available, then take them."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._bucket.get_lock():
+                now = time.monotonic()
+                available = min(self._capacity, self._bucket[0] + (now - self._bucket[1]) * self.rate)
+                self._bucket[1] = now
+                if available >= tokens:
+                    self._bucket[0] = available - tokens
+                    return
+                self._bucket[0] = available
+            time.sleep((tokens - available) / self.rate)
+
+
+def backfill_shards(
+    transcripts: list[tuple[str, Path, str]], state: dict, index: dict, shard_bytes: int = BACKFILL_SHARD_BYTES,
+) -> list[dict]:
+    """Pack transcripts into shards of about shard_bytes unexported bytes, biggest sessions first.
+
+    A session's transcripts stay together in one shard since they share its state.
+    Each shard carries that state, so a worker resumes where the Stop hook (or an
+    earlier backfill) left off. Handing out the biggest shards first keeps every
+    worker busy until the end.
+    """
+    sessions: dict[str, list[tuple[str, str, str]]] = {}
+    for session_id, transcript_file, project_name in transcripts:
+        sessions.setdefault(session_id, []).append((session_id, str(transcript_file), project_name))
+    pending = {
+        session_id: sum(backlog_lag(index, state, session_id, Path(path))[0] for _, path, _ in group)
+        for session_id, group in sessions.items()
+    }
+
+    shards, current, current_bytes = [], [], 0
+    for session_id in sorted(sessions, key=lambda session_id: -pending[session_id]):
+        current.append(session_id)
+        current_bytes += pending[session_id]
+        if current_bytes >= shard_bytes:
+            shards.append(current)
+            current, current_bytes = [], 0
+    if current:
+        shards.append(current)
+    return [
+        {
+            "transcripts": [transcript for session_id in shard for transcript in sessions[session_id]],
+            "state": {session_id: state[session_id] for session_id in shard if session_id in state},
+        }
+        for shard in shards
+    ]
+
+
+# Set in each backfill parse worker by _backfill_init(): backend settings and clients, the shared rate limiter
+_backfill_worker: dict = {}
+
+
+def _backfill_init(settings: dict, limiter: RateLimiter) -> None:
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl-C is the parent's to handle
+    # Always the ingestion API for Langfuse: its IDs derive from the turn, so a shard exported twice upserts
+    _backfill_worker.update(settings=settings, limiter=limiter, resources=HookResources(langfuse_exporter="ingestion"))
+
+
+def _backfill_shard(shard: dict) -> dict:
+    """Parse and export one shard in a pool worker; the parent saves the progress it returns.
+
+    Each turn waits for the shared rate limiter, then goes to this worker's backend
+    exporters, which batch across the whole shard and flush once at the end.
+    Returns the shard's session state, the transcripts finished (with their
+    offset), the number of turns, queue entries for turns a backend didn't take,
+    and the shard's phase timings and counters.
+    """
+    metrics = RunMetrics("backfill")
+    limiter = _backfill_worker["limiter"]
+    workers = backend_workers(_backfill_worker["resources"], _backfill_worker["settings"])
+    missing = [name for name in _backfill_worker["settings"] if name not in {worker.backend for worker in workers}]
+    fanout = ExportFanout(workers)
+    state = shard["state"]
+    undelivered, finished = [], []
+    turns = 0
+
+    def submit(turn: Turn) -> None:
+        with metrics.phase("rate_wait"):
+            limiter.acquire()
+        fanout.submit(turn)
+        if missing:
+            undelivered.append(queue_entry(turn, missing))
+
+    try:
+        for session_id, path, project_name in shard["transcripts"]:
+            try:
+                turns += process_transcript(
+                    session_id, Path(path), state, project_name, trace_creators=[("backfill", submit)],
+                    persist=False, metrics=metrics,
+                )
+            except Exception as e:
+                log("ERROR", f"Backfill failed on session {session_id} ({path}): {e}")
+                continue
+            if not has_open_turn(state, session_id):
+                finished.append((path, state.get(session_id, {}).get("offset")))
+    finally:
+        with metrics.phase("backend_wait"):
+            fanout.close()
+        flush_log()  # pool workers exit without running atexit
+    for worker in workers:
+        metrics.add(f"export.{worker.backend}", worker.busy_seconds - worker.flush_seconds)
+        metrics.add(f"flush.{worker.backend}", worker.flush_seconds)
+        metrics.count(f"spans.{worker.backend}", worker.spans)
+        undelivered += worker.take_undelivered()
+    return {
+        "state": state, "finished": finished, "turns": turns, "undelivered": undelivered,
+        "phases": metrics.phases, "counters": metrics.counters,
+    }
+
+
+def run_backfill(processes: int | None = None, rate: float = BACKFILL_RATE, shard_bytes: int = BACKFILL_SHARD_BYTES) -> int:
+    """Export every transcript the hook hasn't exported yet, parsed in parallel. Returns an exit status.
+
+    Transcripts are found by the same scan as the hook's sweep, packed into shards
+    by backfill_shards() and spread over a pool of `processes` parse workers (one
+    per CPU by default), all paced by one RateLimiter. The run lock is held
+    throughout, so Stop hooks firing meanwhile only record their transcript; they
+    are exported once the backfill is done.
+
+    Session state and the transcript index are saved as each shard finishes, so an
+    interrupted backfill resumes with the shards that hadn't. A shard that is
+    exported twice lands on the same trace IDs, so the second pass is an upsert.
+    One RunMetrics record covers the whole backfill, its phases summed over workers.
+    """
+    settings = backend_settings()
+    if not settings:
+        print("No tracing backend is enabled and configured (see the hook log)", file=sys.stderr)
+        return 1
+    lock = acquire_run_lock()
+    if lock is None:
+        print("Another hook run is active; try again once it has finished", file=sys.stderr)
+        return 1
+
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+
+    start = time.monotonic()
+    metrics = RunMetrics("backfill")
+    turns = finished = failed = requeued = 0
+    try:
+        with metrics.phase("state_load"):
+            state, index = load_state(), load_index()
+        with metrics.phase("health_check"):
+            down = [name for name, config in settings.items() if not backend_reachable(index, name, config[0])]
+        if down:
+            save_index(index)
+            print(f"{', '.join(down)} not reachable; backfill needs every enabled backend up", file=sys.stderr)
+            return 1
+
+        with metrics.phase("discovery"):
+            transcripts = find_modified_transcripts(state, index)
+            shards = backfill_shards(transcripts, state, index, shard_bytes)
+        metrics.count("shards", len(shards))
+        pending_mb = sum(backlog_lag(index, state, t[0], t[1])[0] for t in transcripts) / (1024 * 1024)
+        print(f"Backfilling {len(transcripts)} transcripts ({pending_mb:.1f} MB) in {len(shards)} shards", flush=True)
+
+        with ProcessPoolExecutor(processes, initializer=_backfill_init, initargs=(settings, RateLimiter(rate))) as pool:
+            futures = [pool.submit(_backfill_shard, shard) for shard in shards]
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        failed += 1
+                        log("ERROR", f"Backfill shard failed: {e}")
+                        continue
+                    # Checkpoint: what this shard exported is never read again
+                    with metrics.phase("state_save"):
+                        state.update(result["state"])
+                        save_sessions(state, result["state"])
+                        for path, offset in result["finished"]:
+                            mark_transcript_processed(index, Path(path), offset)
+                        for entry in result["undelivered"]:
+                            queue_trace(entry)
+                        save_index(index)
+                    for phase, seconds in result["phases"].items():
+                        metrics.add(phase, seconds)
+                    for counter, n in result["counters"].items():
+                        metrics.count(counter, n)
+
+                    turns += result["turns"]
+                    finished += len(result["finished"])
+                    requeued += len(result["undelivered"])
+                    elapsed = time.monotonic() - start
+                    print(f"  [{done}/{len(shards)} shards] {finished} transcripts, {turns} turns, "
+                          f"{turns / elapsed:.0f} turns/s", flush=True)
+            except KeyboardInterrupt:
+                pool.shutdown(cancel_futures=True)
+                print("Interrupted; run the backfill again to resume", file=sys.stderr)
+                return 130
+    finally:
+        release_run_lock(lock)
+        metrics.count("turns", turns)
+        metrics.count("transcripts", finished)
+        metrics.count("failed_shards", failed)
+        metrics.count("requeued", requeued)
+        metrics.write()
+
+    elapsed = time.monotonic() - start
+    summary = f"Backfilled {turns} turns from {finished} transcripts in {elapsed:.1f}s ({turns / elapsed:.0f} turns/s)"
+    if requeued:
+        summary += f", queued {requeued} a backend didn't take"
+    if failed:
+        summary += f", {failed} shards failed (run the backfill again to retry them)"
+    log("INFO", summary)
+    print(summary)
+
+    # Stop hooks that fired during the backfill left their transcripts in the dirty file
+    if dirty_pending():
+        run_single_flight([])
+    return 1 if failed else 0
+
+
+def backfill_command(argv: list[str]) -> int:
+    """Command line of `langfuse_hook.py --backfill`."""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog="langfuse_hook.py --backfill",
+        description="Export every Claude Code transcript not yet exported, parsed in parallel.",
+    )
+    parser.add_argument("--workers", type=int, default=None, help="parse worker processes (default: one per CPU)")
+    parser.add_argument("--rate", type=float, default=BACKFILL_RATE,
+                        help="turns/s across all workers, 0 for no limit (default: %(default)g, CC_LANGFUSE_BACKFILL_RATE)")
+    args = parser.parse_args(argv)
+    return run_backfill(args.workers, args.rate)
+
+
+def main():
+    if "--daemon" in sys.argv[1:]:
+        serve_daemon()
+        sys.exit(0)
+    if sys.argv[1:2] == ["--backfill"]:
+        sys.exit(backfill_command(sys.argv[2:]))
+
+    debug("Hook started")
+    payload = read_hook_payload()
+
+    if not any(enabled_backends()):
+        debug("No tracing backends enabled")
+        sys.exit(0)
+
+    # Thin client: a running daemon does the work with warm clients
+    if send_to_daemon(payload):
+        debug("Handed payload to export daemon")
+        sys.exit(0)
+
+    if DETACH:
+        # Durable first: whichever run next holds the lock exports this transcript from its
+        # stored offset, even if the worker below never gets to it
+        mark_dirty(payload)
+        if spawn_detached(lambda: run_single_flight([])):
+            debug("Recorded transcript and started a detached export worker")
+            sys.exit(0)
+        run_single_flight([])
+        sys.exit(0)
+
+    # Single flight: if another run is active, hand it this payload and exit right away
+    if not run_single_flight([payload]):
+        debug("Another hook run is active, recorded transcript for it")
+
+    sys.exit(0)
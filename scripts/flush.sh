@@ -9,7 +9,8 @@ NC='\033[0m' # No Color
 
 REPO_ROOT="$(cd "$(dirname "$0")/.." && pwd)"
 STATE_DIR="$HOME/.claude/state"
-STATE_FILES=("langfuse_hook.log" "langfuse_state.json" "pending_traces.jsonl")
+STATE_FILES=("langfuse_hook.log" "langfuse_hook.log.1" "langfuse_hook.log.2" "hook_metrics.jsonl" "langfuse_state.json" "pending_traces.jsonl" "transcript_index.json" "langfuse_state.db" "langfuse_state.db-wal" "langfuse_state.db-shm" "langfuse_hook.lock" "dirty_transcripts.jsonl")
+STATE_DIRS=("pending_traces")
 
 AUTO_YES=false
 KEEP_STATE=false
@@ -54,6 +55,15 @@ if [ "$KEEP_STATE" = false ]; then
             echo "  $filepath  (not found)"
         fi
     done
+    for d in "${STATE_DIRS[@]}"; do
+        dirpath="$STATE_DIR/$d"
+        if [ -d "$dirpath" ]; then
+            size=$(du -sk "$dirpath" 2>/dev/null | cut -f1 || echo "?")
+            echo "  $dirpath/  (${size} KB)"
+        else
+            echo "  $dirpath/  (not found)"
+        fi
+    done
     echo ""
 fi
 
@@ -91,6 +101,13 @@ if [ "$KEEP_STATE" = false ]; then
             echo -e "${GREEN}✓ Removed $filepath${NC}"
         fi
     done
+    for d in "${STATE_DIRS[@]}"; do
+        dirpath="$STATE_DIR/$d"
+        if [ -d "$dirpath" ]; then
+            rm -r "$dirpath"
+            echo -e "${GREEN}✓ Removed $dirpath/${NC}"
+        fi
+    done
 fi
 
 # --- Restart ---
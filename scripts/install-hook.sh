@@ -84,19 +84,26 @@ else
     exit 1
 fi
 
-# Copy hook script
+# Copy hook script (a thin entry point) and the module holding the hook itself
 HOOK_SOURCE="hooks/langfuse_hook.py"
 HOOK_DEST="$HOOKS_DIR/langfuse_hook.py"
-
-if [ ! -f "$HOOK_SOURCE" ]; then
-    echo -e "${RED}Error: Hook source file not found: $HOOK_SOURCE${NC}"
-    echo "Please run this script from the repository root"
-    exit 1
-fi
+HOOK_MODULE_SOURCE="hooks/langfuse_hook_core.py"
+HOOK_MODULE_DEST="$HOOKS_DIR/langfuse_hook_core.py"
+
+for source in "$HOOK_SOURCE" "$HOOK_MODULE_SOURCE"; do
+    if [ ! -f "$source" ]; then
+        echo -e "${RED}Error: Hook source file not found: $source${NC}"
+        echo "Please run this script from the repository root"
+        exit 1
+    fi
+done
 
 cp "$HOOK_SOURCE" "$HOOK_DEST"
+cp "$HOOK_MODULE_SOURCE" "$HOOK_MODULE_DEST"
 chmod +x "$HOOK_DEST"
-echo -e "${GREEN}✓ Installed hook script: $HOOK_DEST${NC}"
+# Compile the module now so no Stop hook pays for it, even with PYTHONDONTWRITEBYTECODE set
+"$VENV_PYTHON" -m py_compile "$HOOK_MODULE_DEST"
+echo -e "${GREEN}✓ Installed hook script: $HOOK_DEST (and $HOOK_MODULE_DEST)${NC}"
 
 # Update settings.json
 SETTINGS_FILE="$HOME/.claude/settings.json"
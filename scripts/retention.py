@@ -3,7 +3,7 @@
 Data retention for Claude Code observability.
 
 Handles what Langfuse's built-in retention does NOT: local state files,
-hook logs, and on-demand trace pruning via the Langfuse API.
+hook logs and run metrics, and on-demand trace pruning via the Langfuse API.
 
 Usage:
     python3 scripts/retention.py                # Prune traces older than 30 days
@@ -26,6 +26,7 @@ Cron example (weekly, Sunday 3am):
 import argparse
 import json
 import os
+import sqlite3
 import sys
 from datetime import datetime, timezone, timedelta
 from pathlib import Path
@@ -38,7 +39,10 @@ except ImportError:
 STATE_DIR = Path.home() / ".claude" / "state"
 LOG_FILE = STATE_DIR / "langfuse_hook.log"
 STATE_FILE = STATE_DIR / "langfuse_state.json"
-QUEUE_FILE = STATE_DIR / "pending_traces.jsonl"
+QUEUE_FILE = STATE_DIR / "pending_traces.jsonl"  # legacy single-file queue
+QUEUE_DIR = STATE_DIR / "pending_traces"
+STATE_DB = STATE_DIR / "langfuse_state.db"  # used instead of the files above with CC_LANGFUSE_STATE_BACKEND=sqlite
+METRICS_FILE = STATE_DIR / "hook_metrics.jsonl"  # one JSON record per hook run
 
 
 def parse_args():
@@ -107,6 +111,62 @@ def rotate_log(max_mb: float, dry_run: bool) -> int:
     return max(reclaimed, 0)
 
 
+def prune_metrics(cutoff: datetime, dry_run: bool) -> int:
+    """Drop run records older than cutoff from hook_metrics.jsonl. Returns count removed.
+
+    Records are appended in time order, so the old ones are a prefix of the file;
+    the rest is copied to a new file that replaces it.
+    """
+    if not METRICS_FILE.exists():
+        return 0
+    removed = 0
+    try:
+        with open(METRICS_FILE, "rb") as f:
+            for line in f:
+                try:
+                    ts = datetime.fromisoformat(json.loads(line)["time"])
+                except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+                    ts = None
+                if ts is not None and ts >= cutoff:
+                    break
+                removed += 1
+            else:
+                line = b""
+            if dry_run or not removed:
+                return removed
+            tmp = METRICS_FILE.with_suffix(".tmp")
+            with open(tmp, "wb") as out:
+                out.write(line)
+                out.writelines(f)
+        tmp.replace(METRICS_FILE)
+    except OSError as e:
+        print(f"  Warning: failed to prune {METRICS_FILE}: {e}", file=sys.stderr)
+        return 0
+    return removed
+
+
+def prune_state_db(cutoff: datetime, dry_run: bool) -> tuple[int, int]:
+    """Delete stale sessions and old queued turns from the SQLite store. Returns (sessions, queue entries)."""
+    if not STATE_DB.exists():
+        return 0, 0
+    conn = sqlite3.connect(STATE_DB, timeout=10)
+    try:
+        cutoff_iso = cutoff.isoformat()
+        if dry_run:
+            sessions = conn.execute("SELECT COUNT(*) FROM sessions WHERE updated < ?", (cutoff_iso,)).fetchone()[0]
+            queued = conn.execute("SELECT COUNT(*) FROM pending_turns WHERE queued_at < ?", (cutoff_iso,)).fetchone()[0]
+            return sessions, queued
+        with conn:
+            sessions = conn.execute("DELETE FROM sessions WHERE updated < ?", (cutoff_iso,)).rowcount
+            queued = conn.execute("DELETE FROM pending_turns WHERE queued_at < ?", (cutoff_iso,)).rowcount
+        return sessions, queued
+    except sqlite3.Error as e:
+        print(f"  Warning: failed to prune {STATE_DB}: {e}", file=sys.stderr)
+        return 0, 0
+    finally:
+        conn.close()
+
+
 def prune_state_file(cutoff: datetime, dry_run: bool) -> int:
     """Remove stale sessions from langfuse_state.json. Returns count pruned."""
     if not STATE_FILE.exists():
@@ -137,8 +197,104 @@ def prune_state_file(cutoff: datetime, dry_run: bool) -> int:
     return len(to_remove)
 
 
+def _queued_before(line: bytes, cutoff: datetime) -> bool:
+    try:
+        queued_at = json.loads(line).get("queued_at")
+        return bool(queued_at) and datetime.fromisoformat(queued_at.replace("Z", "+00:00")) < cutoff
+    except (json.JSONDecodeError, ValueError, AttributeError):
+        return False
+
+
+def _read_ack(ack_file: Path) -> tuple[int, int]:
+    try:
+        ack = json.loads(ack_file.read_text())
+        return int(ack["segment"]), int(ack["offset"])
+    except FileNotFoundError:
+        # Like the hook: a backend that has never acked reads from the shared offset
+        return _read_ack(QUEUE_DIR / "ack.json") if ack_file.name != "ack.json" else (0, 0)
+    except (OSError, json.JSONDecodeError, KeyError, TypeError, ValueError):
+        return 0, 0
+
+
+def _queue_backends(segments: list[int]) -> set[str]:
+    """Backends the queue owes entries to: those enabled here and those named in any entry."""
+    backends = {name for name, env in (("langfuse", "TRACE_TO_LANGFUSE"), ("grafana", "TRACE_TO_GRAFANA"))
+                if os.environ.get(env, "").lower() == "true"}
+    for number in segments:
+        with open(QUEUE_DIR / f"{number:08d}.jsonl", "rb") as f:
+            for line in f:
+                if b'"backends"' not in line:
+                    continue
+                try:
+                    backends.update(json.loads(line).get("backends") or [])
+                except (json.JSONDecodeError, AttributeError, TypeError):
+                    continue
+    return backends
+
+
+def prune_segmented_queue(cutoff: datetime, dry_run: bool) -> int:
+    """Skip old entries at the head of the pending_traces/ queue. Returns count pruned.
+
+    Entries are appended in queue order, so old ones are always at the head: every
+    backend's committed read offset (ack-<backend>.json, and the shared ack.json)
+    is moved past them and fully skipped segments are deleted, the same way a
+    drain acknowledges entries. Nothing is rewritten. A backend that is owed
+    entries but has never acked (it was down all along) gets its ack file here,
+    starting from where the hook would read it.
+    """
+    segments = sorted(int(p.stem) for p in QUEUE_DIR.glob("*.jsonl") if p.stem.isdigit()) if QUEUE_DIR.exists() else []
+    if not segments:
+        return 0
+    ack_files = set(QUEUE_DIR.glob("ack*.json"))
+    ack_files.update(QUEUE_DIR / f"ack-{backend}.json" for backend in _queue_backends(segments))
+    cursors = {ack_file: _read_ack(ack_file) for ack_file in sorted(ack_files) or [QUEUE_DIR / "ack.json"]}
+    ack_segment, ack_offset = min(cursors.values())
+
+    pruned = 0
+    position = None
+    for number in segments:
+        if number < ack_segment:
+            continue
+        offset = ack_offset if number == ack_segment else 0
+        with open(QUEUE_DIR / f"{number:08d}.jsonl", "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                if line.strip() and not _queued_before(line, cutoff):
+                    break
+                offset += len(line)
+                pruned += 1 if line.strip() else 0
+                position = (number, offset)
+            else:
+                continue
+        break
+
+    if not dry_run and position:
+        for ack_file, cursor in cursors.items():
+            if cursor >= position and ack_file.exists():
+                continue
+            cursors[ack_file] = max(cursor, position)
+            tmp = ack_file.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"segment": cursors[ack_file][0], "offset": cursors[ack_file][1]}))
+            tmp.replace(ack_file)
+        segment = min(cursors.values())[0]
+        for number in segments:
+            if number < segment:
+                (QUEUE_DIR / f"{number:08d}.jsonl").unlink(missing_ok=True)
+    return pruned
+
+
 def prune_queue(cutoff: datetime, dry_run: bool) -> int:
-    """Remove old entries from pending_traces.jsonl. Returns count pruned."""
+    """Remove old entries from the pending queue. Returns count pruned."""
+    pruned = prune_segmented_queue(cutoff, dry_run)
+    if not QUEUE_FILE.exists():
+        return pruned
+    return pruned + prune_legacy_queue(cutoff, dry_run)
+
+
+def prune_legacy_queue(cutoff: datetime, dry_run: bool) -> int:
+    """Remove old entries from a pending_traces.jsonl not yet migrated by the hook. Returns count pruned."""
     if not QUEUE_FILE.exists():
         return 0
     try:
@@ -178,6 +334,7 @@ def main():
         "log_bytes_reclaimed": 0,
         "sessions_pruned": 0,
         "queue_entries_removed": 0,
+        "metrics_records_removed": 0,
     }
 
     if not args.json:
@@ -216,13 +373,20 @@ def main():
     if not args.json:
         print("  Checking state file...")
     summary["sessions_pruned"] = prune_state_file(cutoff, args.dry_run)
+    db_sessions, db_queued = prune_state_db(cutoff, args.dry_run)
+    summary["sessions_pruned"] += db_sessions
 
     # 4. Clean pending queue
     if not args.json:
         print("  Checking pending queue...")
-    summary["queue_entries_removed"] = prune_queue(cutoff, args.dry_run)
+    summary["queue_entries_removed"] = prune_queue(cutoff, args.dry_run) + db_queued
+
+    # 5. Drop old run metrics
+    if not args.json:
+        print("  Checking run metrics...")
+    summary["metrics_records_removed"] = prune_metrics(cutoff, args.dry_run)
 
-    # 5. Print summary
+    # 6. Print summary
     if args.json:
         print(json.dumps(summary, indent=2, default=str))
     else:
@@ -232,6 +396,7 @@ def main():
         print(f"    Log bytes reclaimed:   {summary['log_bytes_reclaimed']}")
         print(f"    Sessions pruned:       {summary['sessions_pruned']}")
         print(f"    Queue entries removed: {summary['queue_entries_removed']}")
+        print(f"    Run records removed:   {summary['metrics_records_removed']}")
         print()
 
 
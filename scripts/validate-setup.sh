@@ -229,6 +229,10 @@ if [ "$POST_MODE" = true ]; then
         check_fail "Hook file not found"
         echo "    Run: ./scripts/install-hook.sh"
     fi
+    if [ ! -f "$HOME/.claude/hooks/langfuse_hook_core.py" ]; then
+        check_fail "Hook module not found (langfuse_hook_core.py, installed next to the hook)"
+        echo "    Run: ./scripts/install-hook.sh"
+    fi
 
     # Check settings.json
     SETTINGS_FILE="$HOME/.claude/settings.json"
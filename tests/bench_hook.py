@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""Benchmarks for langfuse_hook.py
+
+Not part of the unit test run. Each benchmark runs the hook's own code against
+synthetic transcripts without any backend (langfuse is mocked, exporters are no-ops).
+
+Usage:
+    python3 tests/bench_hook.py rss                 # peak RSS on a 500 MB transcript
+    python3 tests/bench_hook.py rss --size-mb 100   # smaller transcript
+    python3 tests/bench_hook.py join                # tool_use/tool_result join, 10-1000 calls per turn
+    python3 tests/bench_hook.py startup             # no-op hook run: wall time and -X importtime breakdown
+    python3 tests/bench_hook.py log                 # logging cost as a share of a debug-logging run
+"""
+import argparse
+import json
+import os
+import py_compile
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from unittest.mock import MagicMock
+
+HOOKS_DIR = Path(__file__).parent.parent / "hooks"
+
+
+def import_hook():
+    """Import the hook with the langfuse package mocked out."""
+    sys.modules.setdefault("langfuse", MagicMock())
+    sys.path.insert(0, str(HOOKS_DIR))
+    import langfuse_hook_core
+    return langfuse_hook_core
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of this process in MB (ru_maxrss is KB on Linux, bytes on macOS)."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / (1024 * 1024) if sys.platform == "darwin" else maxrss / 1024
+
+
+def write_synthetic_transcript(path: Path, size_mb: float, tool_output_kb: int = 8) -> int:
+    """Write a transcript of roughly size_mb made of tool-heavy turns. Returns turns written."""
+    target = int(size_mb * 1024 * 1024)
+    tool_output = "x" * (tool_output_kb * 1024)
+    written = 0
+    turn = 0
+    with open(path, "w") as f:
+        while written < target:
+            turn += 1
+            lines = [
+                {"sessionId": "bench", "type": "user", "message": {"role": "user", "content": f"prompt {turn}"}},
+                {"type": "assistant", "message": {"id": f"m{turn}a", "model": "claude-bench", "stop_reason": "tool_use", "content": [
+                    {"type": "tool_use", "id": f"t{turn}", "name": "Bash", "input": {"command": "ls -la"}}]}},
+                {"type": "user", "message": {"role": "user", "content": [
+                    {"type": "tool_result", "tool_use_id": f"t{turn}", "content": tool_output}]}},
+                {"type": "assistant", "message": {"id": f"m{turn}b", "model": "claude-bench", "stop_reason": "end_turn", "content": [
+                    {"type": "text", "text": f"answer {turn}"}]}},
+            ]
+            chunk = "".join(json.dumps(line) + "\n" for line in lines)
+            f.write(chunk)
+            written += len(chunk)
+    return turn
+
+
+def _rss_child(transcript: str) -> None:
+    """Process one transcript in a fresh interpreter and print peak RSS as JSON."""
+    hook = import_hook()
+    baseline = peak_rss_mb()
+    creators = [("bench", lambda *args: None)]
+    start = time.perf_counter()
+    turns = hook.process_transcript("bench", Path(transcript), {}, "bench", trace_creators=creators)
+    elapsed = time.perf_counter() - start
+    print(json.dumps({
+        "turns": turns,
+        "seconds": elapsed,
+        "baseline_rss_mb": baseline,
+        "peak_rss_mb": peak_rss_mb(),
+    }))
+
+
+def bench_rss(size_mb: float) -> int:
+    """Show that peak RSS stays flat as the transcript grows."""
+    print(f"=== Peak RSS: streaming process_transcript (up to {size_mb:.0f} MB) ===")
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, HOME=tmp)
+        for size in (size_mb / 10, size_mb):
+            transcript = Path(tmp) / f"bench-{size:.0f}.jsonl"
+            write_synthetic_transcript(transcript, size)
+            out = subprocess.run(
+                [sys.executable, __file__, "_rss-child", str(transcript)],
+                env=env, check=True, capture_output=True, text=True,
+            ).stdout
+            result = json.loads(out)
+            result["size_mb"] = transcript.stat().st_size / (1024 * 1024)
+            transcript.unlink()
+            results.append(result)
+            print(f"  {result['size_mb']:8.1f} MB transcript: {result['turns']:7d} turns in {result['seconds']:6.1f}s, "
+                  f"peak RSS {result['peak_rss_mb']:6.1f} MB (interpreter baseline {result['baseline_rss_mb']:.1f} MB)")
+
+    growth = results[-1]["peak_rss_mb"] - results[0]["peak_rss_mb"]
+    bounded = growth < 32
+    print(f"  RSS growth for {results[-1]['size_mb'] / results[0]['size_mb']:.0f}x input: {growth:+.1f} MB "
+          f"-> {'bounded' if bounded else 'NOT bounded'}")
+    return 0 if bounded else 1
+
+
+def synthetic_turn_messages(tool_calls: int) -> list[dict]:
+    """Messages of one agentic turn: each tool call and each result in its own line."""
+    messages = [{"type": "user", "message": {"role": "user", "content": "do the thing"}}]
+    for i in range(tool_calls):
+        messages.append({"type": "assistant", "message": {"id": f"m{i}", "model": "claude-bench", "content": [
+            {"type": "tool_use", "id": f"toolu_{i:06d}", "name": "Read", "input": {"file_path": f"/src/{i}.py"}}]}})
+        messages.append({"type": "user", "message": {"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": f"toolu_{i:06d}", "content": f"contents of {i}.py"}]}})
+    messages.append({"type": "assistant", "message": {"id": "final", "stop_reason": "end_turn", "content": [
+        {"type": "text", "text": "done"}]}})
+    return messages
+
+
+def bench_join() -> int:
+    """Show that assembling and joining a turn costs the same per tool call at 10, 100 and 1000 calls."""
+    hook = import_hook()
+    print("=== Tool call/result join: TurnAssembler + build_turn ===")
+    per_call = []
+    for tool_calls in (10, 100, 1000):
+        messages = synthetic_turn_messages(tool_calls)
+        repeats = max(1, 20000 // tool_calls)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            assembler = hook.TurnAssembler()
+            list(assembler.turns(messages))
+            user_msg, assistant_msgs, tool_outputs = assembler.finish()
+            turn = hook.build_turn("bench", 1, user_msg, assistant_msgs, tool_outputs)
+        elapsed = (time.perf_counter() - start) / repeats
+        assert all(tc.output is not None for tc in turn.tool_calls)
+        per_call.append(elapsed / tool_calls)
+        print(f"  {tool_calls:5d} tool calls: {elapsed * 1000:8.3f} ms/turn, {per_call[-1] * 1e6:6.2f} us/call")
+
+    ratio = per_call[-1] / per_call[0]
+    linear = ratio < 3
+    print(f"  per-call cost at 1000 vs 10 calls: {ratio:.1f}x -> {'linear' if linear else 'NOT linear'}")
+    return 0 if linear else 1
+
+
+# Modules a run with nothing to export must not import
+DEFERRED_MODULES = ("langfuse", "opentelemetry", "requests", "urllib.request", "sqlite3", "logging")
+
+
+def _hook_env(home: str) -> dict:
+    """Environment for a real hook process: Langfuse enabled via the ingestion exporter, nothing listening."""
+    return dict(
+        os.environ, HOME=home, TRACE_TO_LANGFUSE="true", TRACE_TO_GRAFANA="false",
+        LANGFUSE_PUBLIC_KEY="pk", LANGFUSE_SECRET_KEY="sk", LANGFUSE_HOST="http://127.0.0.1:9",
+        CC_LANGFUSE_EXPORTER="ingestion",
+    )
+
+
+def _time_commands(commands: list[tuple[list[str], bytes]], env: dict, runs: int) -> list[float]:
+    """Best-of-runs wall time in ms per command, run interleaved so machine noise hits all of them alike."""
+    times = [[] for _ in commands]
+    for _ in range(runs):
+        for i, (cmd, stdin) in enumerate(commands):
+            start = time.perf_counter()
+            subprocess.run(cmd, input=stdin, env=env, check=True, capture_output=True)
+            times[i].append((time.perf_counter() - start) * 1000)
+    return [min(t) for t in times]
+
+
+def bench_startup(runs: int) -> int:
+    """Time the no-op path (payload transcript unchanged) and show which imports it pays for."""
+    print("=== Startup: no-op Stop hook run (nothing new to export) ===")
+    hook = str(HOOKS_DIR / "langfuse_hook.py")
+    # As install-hook.sh does: the hook module's bytecode is cached, whatever PYTHONDONTWRITEBYTECODE says
+    py_compile.compile(str(HOOKS_DIR / "langfuse_hook_core.py"), doraise=True)
+    with tempfile.TemporaryDirectory() as tmp:
+        env = _hook_env(tmp)
+        transcript = Path(tmp) / ".claude" / "projects" / "-bench" / "bench.jsonl"
+        transcript.parent.mkdir(parents=True)
+        write_synthetic_transcript(transcript, 0.01)
+        payload = json.dumps({"session_id": "bench", "transcript_path": str(transcript)}).encode()
+        # First run reads the transcript (and queues it, nothing is listening); later runs find it unchanged
+        subprocess.run([sys.executable, hook], input=payload, env=env, check=True)
+
+        interpreter_ms, hook_ms = _time_commands([([sys.executable, "-c", "pass"], b""), ([sys.executable, hook], payload)], env, runs)
+        importtime = subprocess.run(
+            [sys.executable, "-X", "importtime", hook], input=payload, env=env, check=True, capture_output=True,
+        ).stderr.decode()
+        baseline = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "pass"], env=env, check=True, capture_output=True,
+        ).stderr.decode()
+
+    def top_level_imports(report: str) -> dict[str, int]:
+        """Cumulative microseconds per top-level import from an -X importtime report."""
+        imports = {}
+        for line in report.splitlines():
+            if not line.startswith("import time:") or "|" not in line:
+                continue
+            _, cumulative, name = line[len("import time:"):].split("|")
+            if name.strip() and not name.startswith("  ") and cumulative.strip().isdigit():
+                imports[name.strip()] = int(cumulative)
+        return imports
+
+    extra = {name: us for name, us in top_level_imports(importtime).items()
+             if name not in top_level_imports(baseline)}
+    print(f"  bare interpreter:   {interpreter_ms:6.1f} ms")
+    print(f"  no-op hook run:     {hook_ms:6.1f} ms  (hook overhead {hook_ms - interpreter_ms:.1f} ms, "
+          f"best of {runs})")
+    print("  imports beyond the bare interpreter:")
+    for name, us in sorted(extra.items(), key=lambda item: -item[1])[:10]:
+        print(f"    {us / 1000:6.1f} ms  {name}")
+    loaded = [name for name in extra if name.split(".")[0] in {m.split(".")[0] for m in DEFERRED_MODULES}
+              and any(name == m or name.startswith(m + ".") for m in DEFERRED_MODULES)]
+    if loaded:
+        print(f"  deferred modules imported on the no-op path: {', '.join(loaded)}")
+    fast = hook_ms - interpreter_ms < 50 and not loaded
+    print(f"  -> {'OK' if fast else 'TOO SLOW'}")
+    return 0 if fast else 1
+
+
+def per_message_log(log_file: Path):
+    """The hook's earlier logger: mkdir, exists/stat and an open/append for every message."""
+    def log(level: str, message: str) -> None:
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        if log_file.exists() and log_file.stat().st_size > 50 * 1024 * 1024:
+            lines = log_file.read_text().splitlines()[-500:]
+            log_file.write_text("\n".join(lines) + "\n")
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S")
+        with open(log_file, "a") as f:
+            f.write(f"{timestamp} [{level}] {message}\n")
+    return log
+
+
+def bench_log(size_mb: float) -> int:
+    """Show what logging costs as a share of a run with CC_LANGFUSE_DEBUG on, buffered vs per-message.
+
+    Turns are exported nowhere, so the run is all parsing and logging: the worst
+    case for the share logging takes.
+    """
+    hook = import_hook()
+    print(f"=== Logging: share of a debug-logging process_transcript run ({size_mb:.0f} MB transcript) ===")
+    hook.DEBUG = True
+    buffered_log = hook.log
+
+    def export(turn) -> None:
+        # Debug lines of a backend export, as create_trace() writes them: one per tool call and one per turn
+        for tool_call in turn.tool_calls:
+            hook.debug(f"Created span for tool: {tool_call.name}")
+        hook.debug(f"Created trace for turn {turn.turn_num}")
+
+    shares = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        transcript = Path(tmp) / "bench.jsonl"
+        write_synthetic_transcript(transcript, size_mb)
+        for name, log_fn in (("per-message", per_message_log(Path(tmp) / "per-message.log")), ("buffered", buffered_log)):
+            hook.LOG_FILE = Path(tmp) / f"{name}.log"
+            spent, lines = 0.0, 0
+
+            def timed_log(level: str, message: str, _log=log_fn) -> None:
+                nonlocal spent, lines
+                start = time.perf_counter()
+                _log(level, message)
+                spent += time.perf_counter() - start
+                lines += 1
+
+            hook.log = timed_log  # debug() looks log up as a module global
+            start = time.perf_counter()
+            hook.process_transcript("bench", transcript, {}, "bench", trace_creators=[("bench", export)], persist=False)
+            flush_start = time.perf_counter()
+            hook.flush_log()
+            spent += time.perf_counter() - flush_start
+            elapsed = time.perf_counter() - start
+            shares[name] = spent / elapsed
+            print(f"  {name:12s} {lines:7d} lines: {spent * 1000:8.1f} ms of a {elapsed:5.2f}s run "
+                  f"({shares[name]:5.1%}, {spent / lines * 1e6:5.2f} us/line)")
+        hook.log = buffered_log
+
+    cheap = shares["buffered"] < 0.10
+    print(f"  buffered logging share {shares['buffered']:.1%} -> {'OK' if cheap else 'TOO EXPENSIVE'}")
+    return 0 if cheap else 1
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Benchmarks for langfuse_hook.py")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    rss = sub.add_parser("rss", help="Peak RSS while processing a large synthetic transcript")
+    rss.add_argument("--size-mb", type=float, default=500)
+    sub.add_parser("join", help="Tool call/result join cost at 10, 100 and 1000 calls per turn")
+    startup = sub.add_parser("startup", help="Wall time and imports of a no-op hook run")
+    startup.add_argument("--runs", type=int, default=20)
+    log = sub.add_parser("log", help="Logging cost as a share of a run with debug logging on")
+    log.add_argument("--size-mb", type=float, default=20)
+    child = sub.add_parser("_rss-child")
+    child.add_argument("transcript")
+    args = parser.parse_args()
+
+    if args.bench == "rss":
+        return bench_rss(args.size_mb)
+    if args.bench == "join":
+        return bench_join()
+    if args.bench == "startup":
+        return bench_startup(args.runs)
+    if args.bench == "log":
+        return bench_log(args.size_mb)
+    if args.bench == "_rss-child":
+        _rss_child(args.transcript)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
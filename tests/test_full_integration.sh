@@ -110,7 +110,7 @@ else
     fail "install-hook.sh syntax invalid"
 fi
 
-if python3 -m py_compile hooks/langfuse_hook.py 2>/dev/null; then
+if python3 -m py_compile hooks/langfuse_hook.py hooks/langfuse_hook_core.py 2>/dev/null; then
     pass "langfuse_hook.py syntax valid"
 else
     fail "langfuse_hook.py syntax invalid"
@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
-"""Unit tests for langfuse_hook.py
+"""Unit tests for the hook (langfuse_hook_core.py, run through langfuse_hook.py)
 
 Tests the pure utility functions without requiring the langfuse package.
 """
+import json
+import os
 import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 # Mock the langfuse module before importing the hook
 sys.modules['langfuse'] = MagicMock()
@@ -13,7 +18,12 @@ sys.modules['langfuse'] = MagicMock()
 # Add hooks directory to path
 sys.path.insert(0, str(Path(__file__).parent.parent / 'hooks'))
 
-from langfuse_hook import extract_project_name, get_text_content, is_tool_result, get_content, merge_assistant_parts
+import langfuse_hook_core as langfuse_hook
+from langfuse_hook_core import extract_project_name, get_text_content, is_tool_result, get_content, merge_assistant_parts
+
+# Keep hook log and metrics output out of the real ~/.claude/state
+langfuse_hook.LOG_FILE = Path(tempfile.mkdtemp()) / "langfuse_hook.log"
+langfuse_hook.METRICS_FILE = langfuse_hook.LOG_FILE.with_name("hook_metrics.jsonl")
 
 
 def test_extract_project_name():
@@ -142,10 +152,1069 @@ def test_merge_assistant_parts():
     print("✓ merge_assistant_parts tests passed")
 
 
+def test_find_modified_transcripts_index():
+    """Test that the transcript index skips unchanged files and only reads new ones."""
+    with tempfile.TemporaryDirectory() as tmp:
+        project_dir = Path(tmp) / "-Users-alice-my-app"
+        project_dir.mkdir()
+        transcript = project_dir / "abc.jsonl"
+        transcript.write_text(json.dumps({"sessionId": "sess-1", "type": "user"}) + "\n")
+
+        with patch.object(langfuse_hook, "PROJECTS_DIR", Path(tmp)):
+            index = {"files": {}}
+            found = langfuse_hook.find_modified_transcripts({}, index=index)
+            assert found == [("sess-1", transcript, "my-app")]
+
+            # Processed: the next discovery has nothing to do and reads no files
+            langfuse_hook.mark_transcript_processed(index, transcript)
+            with patch.object(langfuse_hook, "read_session_id", side_effect=AssertionError("read")):
+                assert langfuse_hook.find_modified_transcripts({}, index=index) == []
+
+                # Appending changes the stat signature; the cached session ID is reused
+                with open(transcript, "a") as f:
+                    f.write(json.dumps({"type": "assistant"}) + "\n")
+                assert langfuse_hook.find_modified_transcripts({}, index=index) == [("sess-1", transcript, "my-app")]
+
+            # Deleted transcripts are dropped from the index
+            transcript.unlink()
+            assert langfuse_hook.find_modified_transcripts({}, index=index) == []
+            assert index["files"] == {}
+
+    print("✓ find_modified_transcripts index tests passed")
+
+
+def test_payload_fast_path():
+    """Test that the Stop payload's transcript is resolved directly and sweeps are periodic."""
+    with tempfile.TemporaryDirectory() as tmp:
+        project_dir = Path(tmp) / "-Users-alice-my-app"
+        project_dir.mkdir()
+        transcript = project_dir / "abc.jsonl"
+        transcript.write_text(json.dumps({"sessionId": "sess-1", "type": "user"}) + "\n")
+        payload = {"session_id": "sess-1", "transcript_path": str(transcript)}
+
+        index = {"files": {}}
+        assert langfuse_hook.find_payload_transcript(payload, {}, index) == ("sess-1", transcript, "my-app")
+        langfuse_hook.mark_transcript_processed(index, transcript)
+        assert langfuse_hook.find_payload_transcript(payload, {}, index) is None
+        assert langfuse_hook.find_payload_transcript({"transcript_path": str(project_dir / "gone.jsonl")}, {}, index) is None
+        assert langfuse_hook.find_payload_transcript({}, {}, index) is None
+
+    # First run sweeps (never swept before), then only every SWEEP_EVERY_RUNS runs
+    index = {"files": {}}
+    with patch.object(langfuse_hook, "SWEEP_EVERY_RUNS", 3):
+        assert [langfuse_hook.sweep_due(index) for _ in range(7)] == [True, False, False, True, False, False, True]
+
+    # A Stop event with nothing new doesn't rewrite the index; a sweep does
+    tmp = Path(tempfile.mkdtemp())
+    transcript = tmp / "projects" / "-Users-alice-my-app" / "abc.jsonl"
+    transcript.parent.mkdir(parents=True)
+    transcript.write_text(json.dumps({"sessionId": "sess-1", "type": "user", "message": {"role": "user", "content": "q"}}) + "\n"
+                          + json.dumps({"type": "assistant", "message": {"id": "a1", "stop_reason": "end_turn", "content": "r"}}) + "\n")
+    payload = {"session_id": "sess-1", "transcript_path": str(transcript)}
+    with patch.object(langfuse_hook, "STATE_FILE", tmp / "state.json"), \
+            patch.object(langfuse_hook, "INDEX_FILE", tmp / "index.json"), \
+            patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"), \
+            patch.object(langfuse_hook, "DIRTY_FILE", tmp / "dirty.jsonl"), \
+            patch.object(langfuse_hook, "PROJECTS_DIR", tmp / "projects"), \
+            patch.object(langfuse_hook, "LANGFUSE_EXPORTER", "ingestion"), \
+            patch.object(langfuse_hook, "backend_reachable", return_value=False), \
+            patch.dict("os.environ", {"TRACE_TO_LANGFUSE": "true", "TRACE_TO_GRAFANA": "false",
+                                      "LANGFUSE_PUBLIC_KEY": "pk", "LANGFUSE_SECRET_KEY": "sk"}):
+        langfuse_hook.run_hook([payload])
+        with patch.object(langfuse_hook, "save_index", wraps=langfuse_hook.save_index) as save_index:
+            langfuse_hook.run_hook([payload])
+            assert save_index.call_count == 0
+            langfuse_hook.run_hook([{}])
+            assert save_index.call_count == 1
+
+    print("✓ payload fast path tests passed")
+
+
+def read_appended(transcript, session_state):
+    """Read appended lines via TranscriptReader; returns (lines, start, offset, fingerprint)."""
+    with open(transcript, "rb") as f:
+        reader = langfuse_hook.TranscriptReader(f, session_state)
+        lines = [line.rstrip(b"\n") for line in reader.lines()]
+        return lines, reader.start_offset, reader.offset, reader.fingerprint()
+
+
+def test_transcript_reader():
+    """Test byte-offset tailing: partial lines held back, resume, rewrite and legacy state."""
+    with tempfile.TemporaryDirectory() as tmp:
+        transcript = Path(tmp) / "t.jsonl"
+        transcript.write_bytes(b'{"n": 1}\n{"n": 2}\n{"n": 3')
+
+        lines, start, offset, fingerprint = read_appended(transcript, {})
+        assert lines == [b'{"n": 1}', b'{"n": 2}'] and start == 0 and offset == 18
+
+        # Resume: only the completed trailing line and newly appended data are read
+        with open(transcript, "ab") as f:
+            f.write(b'}\n{"n": 4}\n')
+        state = {"offset": offset, "fingerprint": fingerprint}
+        lines, start, offset, fingerprint = read_appended(transcript, state)
+        assert lines == [b'{"n": 3}', b'{"n": 4}'] and start == 18
+
+        # Rewritten transcript: fingerprint mismatch restarts from the beginning
+        transcript.write_bytes(b'{"x": 1}\n{"x": 2}\n{"x": 3}\n{"x": 4}\n')
+        lines, start, _, _ = read_appended(transcript, {"offset": offset, "fingerprint": fingerprint})
+        assert start == 0 and len(lines) == 4
+
+        # Legacy line-index state is converted to a byte offset
+        lines, start, _, _ = read_appended(transcript, {"last_line": 3})
+        assert lines == [b'{"x": 4}'] and start == 27
+
+    print("✓ TranscriptReader tests passed")
+
+
+def test_turn_assembler():
+    """Test streaming turn assembly from decoded transcript lines."""
+    lines = [
+        b'{"type": "user", "message": {"role": "user", "content": "q1"}}\n',
+        b'{"type": "assistant", "message": {"id": "a", "content": [{"type": "text", "text": "x"}]}}\n',
+        b'not json\n',
+        b'{"type": "assistant", "message": {"id": "a", "content": [{"type": "text", "text": "y"}]}}\n',
+        b'{"type": "user", "message": {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t"}]}}\n',
+        b'{"type": "user", "message": {"role": "user", "content": "q2"}}\n',
+        b'{"type": "assistant", "message": {"id": "b", "content": "z"}}\n',
+    ]
+    assembler = langfuse_hook.TurnAssembler()
+    turns = list(assembler.turns(langfuse_hook.decode_messages(iter(lines))))
+    assert len(turns) == 1
+    user_msg, assistant_msgs, tool_outputs = turns[0]
+    assert get_text_content(user_msg) == "q1"
+    assert get_text_content(assistant_msgs[0]) == "x\ny"
+    assert tool_outputs == {"t": None}
+
+    # The second turn has no end-of-turn stop_reason: held open unless the Stop event fired
+    assert assembler.finish() is None
+    assert get_text_content(assembler.finish(stop_event=True)[0]) == "q2"
+    assert assembler.checkpoint() is None
+
+    print("✓ TurnAssembler tests passed")
+
+
+def test_turn_assembler_checkpoint():
+    """Test that an in-flight turn survives a checkpoint round-trip through JSON state."""
+    user = {"type": "user", "message": {"role": "user", "content": "run it"}}
+    tool_use = {"type": "assistant", "message": {"id": "a", "stop_reason": "tool_use", "content": [
+        {"type": "tool_use", "id": "t1", "name": "Bash", "input": {}}]}}
+    tool_result = {"type": "user", "message": {"role": "user", "content": [
+        {"type": "tool_result", "tool_use_id": "t1", "content": "ok"}]}}
+    answer = {"type": "assistant", "message": {"id": "b", "stop_reason": "end_turn", "content": [
+        {"type": "text", "text": "done"}]}}
+
+    # Run 1 sees the prompt and the tool call: the turn is not finished, even on Stop
+    assembler = langfuse_hook.TurnAssembler()
+    assert list(assembler.turns([user, tool_use])) == []
+    assert assembler.finish(stop_event=True) is None
+    checkpoint = json.loads(json.dumps(assembler.checkpoint()))
+    assert checkpoint["pending_tool_ids"] == ["t1"]
+
+    # Run 2 resumes from the checkpoint; the result alone still awaits the answer
+    assembler = langfuse_hook.TurnAssembler(checkpoint)
+    assert list(assembler.turns([tool_result])) == [] and assembler.finish(stop_event=True) is None
+    assembler = langfuse_hook.TurnAssembler(json.loads(json.dumps(assembler.checkpoint())))
+    assert list(assembler.turns([answer])) == []
+    user_msg, assistant_msgs, tool_outputs = assembler.finish()
+    assert get_text_content(user_msg) == "run it"
+    assert [get_text_content(m) for m in assistant_msgs] == ["", "done"]
+    assert tool_outputs == {"t1": "ok"}
+
+    print("✓ TurnAssembler checkpoint tests passed")
+
+
+def test_build_turn():
+    """Test that the canonical Turn joins tool calls with their results and round-trips the queue."""
+    user_msg = {"message": {"role": "user", "content": "list files"}}
+    assistant_msgs = [
+        {"message": {"model": "claude-test", "content": [
+            {"type": "text", "text": "checking"},
+            {"type": "tool_use", "id": "t1", "name": "Bash", "input": {"command": "ls"}},
+            {"type": "tool_use", "id": "t2", "name": "Read", "input": {"path": "a"}},
+        ]}},
+        {"message": {"content": [{"type": "text", "text": "two files"}]}},
+    ]
+    tool_results = [{"message": {"content": [
+        {"type": "tool_result", "tool_use_id": "t2", "content": "contents"},
+        {"type": "tool_result", "tool_use_id": "t1", "content": "a b"},
+    ]}}]
+
+    tool_outputs = langfuse_hook.index_tool_results(tool_results)
+    assert tool_outputs == {"t2": "contents", "t1": "a b"}
+    turn = langfuse_hook.build_turn("sess", 3, user_msg, assistant_msgs, tool_outputs, "my-app")
+    assert (turn.user_text, turn.final_output, turn.model) == ("list files", "two files", "claude-test")
+    assert [(tc.name, tc.output) for tc in turn.tool_calls] == [("Bash", "a b"), ("Read", "contents")]
+    assert turn.tags == ["claude-code", "my-app"]
+
+    restored = langfuse_hook.turn_from_queue_entry(json.loads(json.dumps(turn.to_dict())))
+    assert restored.to_dict() == turn.to_dict()
+
+    # Entries queued by older versions hold the raw messages
+    legacy = {"session_id": "sess", "turn_num": 3, "user_msg": user_msg, "assistant_msgs": assistant_msgs,
+              "tool_results": tool_results, "project_name": "my-app"}
+    assert langfuse_hook.turn_from_queue_entry(legacy).to_dict() == turn.to_dict()
+
+    print("✓ build_turn tests passed")
+
+
+def test_ingestion_exporter_batches():
+    """Test that the ingestion exporter mirrors the SDK trace structure and caps batch size."""
+    sent = []
+
+    class FakeResponse:
+        def __init__(self, request):
+            sent.append(json.loads(request.data))
+
+        def read(self):
+            return b'{"successes": [], "errors": []}'
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    tool_calls = [langfuse_hook.ToolCall(f"t{i}", "Read", {"path": str(i)}, "x" * 200) for i in range(3)]
+    turns = [langfuse_hook.Turn("sess", n, "my-app", "q", "a", "claude-test", tool_calls) for n in range(1, 11)]
+
+    exporter = langfuse_hook.LangfuseIngestionExporter("http://lf", "pk", "sk", max_batch_bytes=8000)
+    with patch("urllib.request.urlopen", side_effect=lambda req, timeout: FakeResponse(req)):
+        for turn in turns:
+            exporter.export(turn)
+        assert exporter.flush()
+
+    events = [event for batch in sent for event in batch["batch"]]
+    assert len(events) == 10 * 6 and exporter.events == 60
+    assert 1 < len(sent) == exporter.requests < 10
+    assert all(len(json.dumps(batch)) <= 8000 + 100 for batch in sent)
+
+    trace, root, generation, tool = events[:4]
+    assert trace["type"] == "trace-create" and trace["body"]["sessionId"] == "sess"
+    assert trace["body"]["tags"] == ["claude-code", "my-app"]
+    assert generation["type"] == "generation-create" and generation["body"]["model"] == "claude-test"
+    assert generation["body"]["parentObservationId"] == tool["body"]["parentObservationId"] == root["body"]["id"]
+    assert tool["body"]["name"] == "Tool: Read" and tool["body"]["traceId"] == trace["body"]["id"]
+
+    # An event bigger than a whole batch has its input/output truncated instead of being rejected on every retry
+    sent.clear()
+    huge = langfuse_hook.Turn("sess", 11, "my-app", "q", "a", "claude-test", [
+        langfuse_hook.ToolCall("t", "Read", {"path": "big"}, "é\"" * 20000)])
+    with patch("urllib.request.urlopen", side_effect=lambda req, timeout: FakeResponse(req)):
+        exporter.export(huge)
+        assert exporter.flush()
+    events = [event for batch in sent for event in batch["batch"]]
+    assert len(events) == 4 and all(len(json.dumps(batch)) <= 8000 + 100 for batch in sent)
+    assert "truncated, 40000 chars total" in events[-1]["body"]["output"]
+
+    print("✓ LangfuseIngestionExporter tests passed")
+
+
+def test_otlp_batching():
+    """Test that OTLP spans and log records are held until the flush and go out gzip'd, with requests and bytes counted."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    received = []
+
+    class Collector(BaseHTTPRequestHandler):
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"]))
+            received.append((self.path, self.headers.get("Content-Encoding"), len(body)))
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-protobuf")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Collector)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    otel = langfuse_hook.init_otel_providers(f"http://127.0.0.1:{server.server_port}/otlp", "i", "t")
+    tracer, trace_provider, otel_logger, log_provider, stats = otel
+
+    tool_calls = [langfuse_hook.ToolCall(f"t{i}", "Read", {"path": str(i)}, "x" * 200) for i in range(2)]
+    for n in range(1, 6):
+        langfuse_hook.create_otel_trace(tracer, langfuse_hook.Turn("sess", n, "my-app", "q", "a", "m", tool_calls), otel_logger)
+    time.sleep(0.2)
+    assert received == [] and stats.requests == 0
+
+    assert trace_provider.force_flush() and log_provider.force_flush()
+    assert sorted(path for path, _, _ in received) == ["/otlp/v1/logs", "/otlp/v1/traces"]
+    assert all(encoding == "gzip" for _, encoding, _ in received)
+    assert stats.requests == 2 and stats.bytes_sent == sum(size for _, _, size in received)
+    trace_provider.shutdown()
+    log_provider.shutdown()
+    server.shutdown()
+
+    print("✓ OTLP batching tests passed")
+
+
+def test_export_fanout():
+    """Test that backends export in parallel and a failing backend doesn't affect the other."""
+    exported, flushed = [], []
+
+    def slow_export(turn):
+        time.sleep(0.1)
+        exported.append(turn.turn_num)
+
+    def failing_export(turn):
+        time.sleep(0.1)
+        raise RuntimeError("backend down")
+
+    fanout = langfuse_hook.ExportFanout([
+        langfuse_hook.BackendWorker("good", slow_export, flush_fn=lambda: flushed.append("good")),
+        langfuse_hook.BackendWorker("bad", failing_export),
+    ])
+    start = time.perf_counter()
+    for n in range(1, 4):
+        fanout.submit(langfuse_hook.Turn("sess", n, "", "q", "a", "claude", []))
+    fanout.close()
+    elapsed = time.perf_counter() - start
+
+    good, bad = fanout.workers
+    assert exported == [1, 2, 3] and flushed == ["good"]
+    assert (good.exported, good.failed, bad.exported, bad.failed) == (3, 0, 0, 3)
+    assert elapsed < 0.5, f"backends ran serially ({elapsed:.2f}s)"
+    fanout.close()  # idempotent
+
+    print("✓ ExportFanout tests passed")
+
+
+def test_segmented_queue():
+    """Test that the queue rolls segments, resumes from the committed offset, and deletes acked segments."""
+    tmp = Path(tempfile.mkdtemp())
+    pending = langfuse_hook.SegmentedQueue(tmp / "queue", segment_bytes=100)
+    for n in range(1, 7):
+        pending.append({"turn_num": n, "pad": "x" * 40})
+    assert len(pending.segments()) == 3
+
+    # Drain half, ack, then resume from the committed position
+    seen = []
+    for entry, position in pending.entries():
+        seen.append(entry["turn_num"])
+        if len(seen) == 3:
+            break
+    pending.ack(position)
+    assert pending.segments() == [2, 3]
+    assert [e["turn_num"] for e, _ in pending.entries()] == [4, 5, 6]
+
+    # A torn append doesn't swallow the next entry
+    with open(tmp / "queue" / "00000003.jsonl", "ab") as f:
+        f.write(b'{"turn_num": 9')
+    pending.append({"turn_num": 7})
+    remaining = list(pending.entries())
+    assert [e["turn_num"] for e, _ in remaining] == [4, 5, 6, 7]
+
+    # Acking everything removes the queue
+    pending.ack(remaining[-1][1])
+    assert pending.segments() == [] and list(pending.entries()) == []
+
+    print("✓ SegmentedQueue tests passed")
+
+
+def test_drain_queue():
+    """Test that drain_queue migrates the legacy queue file and streams it to the creators once."""
+    tmp = Path(tempfile.mkdtemp())
+    legacy = tmp / "pending_traces.jsonl"
+    turns = [langfuse_hook.Turn("sess", n, "proj", "q", "a", "claude", []) for n in (1, 2)]
+    legacy.write_text("".join(json.dumps(t.to_dict()) + "\n" for t in turns))
+    drained, synced = [], []
+
+    with patch.object(langfuse_hook, "QUEUE_FILE", legacy), patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"):
+        creators = [("test", lambda turn: drained.append(turn.turn_num))]
+        assert langfuse_hook.drain_queue(creators, sync=lambda: synced.append(True)) == 2
+        assert langfuse_hook.drain_queue(creators) == 0
+
+    assert drained == [1, 2] and synced == [True]
+    assert not legacy.exists()
+
+    print("✓ drain_queue tests passed")
+
+
+def test_queue_by_reference():
+    """Test that queued turns reference transcript byte ranges and drain back to the same turns."""
+    tmp = Path(tempfile.mkdtemp())
+    transcript = tmp / "sess.jsonl"
+    big_output = "x" * 10000
+    lines = [
+        {"type": "user", "message": {"role": "user", "content": "q1"}},
+        {"type": "assistant", "message": {"id": "a", "model": "m", "stop_reason": "tool_use", "content": [
+            {"type": "tool_use", "id": "t1", "name": "Read", "input": {"file_path": "f"}}]}},
+        {"type": "user", "message": {"role": "user", "content": [
+            {"type": "tool_result", "tool_use_id": "t1", "content": big_output}]}},
+        {"type": "assistant", "message": {"id": "b", "stop_reason": "end_turn", "content": "done"}},
+        {"type": "user", "message": {"role": "user", "content": "q2"}},
+        {"type": "assistant", "message": {"id": "c", "stop_reason": "end_turn", "content": "ok"}},
+    ]
+    transcript.write_text("".join(json.dumps(line) + "\n" for line in lines))
+
+    drained = []
+    with patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"), \
+            patch.object(langfuse_hook, "QUEUE_FILE", tmp / "legacy.jsonl"), \
+            patch.object(langfuse_hook, "save_state"):
+        langfuse_hook.process_transcript("sess", transcript, {}, "proj", trace_creators=[("queue", langfuse_hook.queue_turn)])
+        entries = [entry for entry, _ in langfuse_hook.pending_queue().entries()]
+        assert [(e["start"], e["turn_num"]) for e in entries] == [(0, 1), (entries[1]["start"], 2)]
+        assert entries[0]["end"] == entries[1]["start"] and entries[1]["end"] == transcript.stat().st_size
+        assert all(len(json.dumps(e)) < 500 for e in entries)
+
+        assert langfuse_hook.drain_queue([("test", drained.append)]) == 2
+
+    first, second = drained
+    assert (first.user_text, first.final_output, first.project_name) == ("q1", "done", "proj")
+    assert first.tool_calls[0].output == big_output
+    assert (second.turn_num, second.user_text) == (2, "q2")
+
+    # A rewritten transcript no longer matches the queued range
+    entry = dict(entries[0])
+    transcript.write_text(json.dumps(lines[4]) + "\n")
+    try:
+        langfuse_hook.turn_from_queue_entry(entry)
+        assert False, "expected ValueError"
+    except ValueError:
+        pass
+
+    print("✓ Queue by reference tests passed")
+
+
+def test_sqlite_store():
+    """Test the SQLite state store: JSON state migration, per-session upserts and the queue."""
+    tmp = Path(tempfile.mkdtemp())
+    state_file = tmp / "langfuse_state.json"
+    state_file.write_text(json.dumps({"old": {"offset": 10, "turn_count": 1, "updated": "2020-01-01T00:00:00+00:00"}}))
+
+    with patch.object(langfuse_hook, "STATE_BACKEND", "sqlite"), \
+            patch.object(langfuse_hook, "STATE_DB", tmp / "state.db"), \
+            patch.object(langfuse_hook, "STATE_FILE", state_file), \
+            patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"), \
+            patch.object(langfuse_hook, "QUEUE_FILE", tmp / "legacy.jsonl"):
+        state = langfuse_hook.load_state()
+        assert state["old"]["offset"] == 10
+
+        state["new"] = {"offset": 5, "turn_count": 2, "updated": "2030-01-01T00:00:00+00:00"}
+        langfuse_hook.save_session(state, "new")
+        assert langfuse_hook.load_state() == state
+        assert langfuse_hook.state_db().execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        # Entries left in the segmented queue move into the database
+        langfuse_hook.SegmentedQueue(tmp / "queue").append({"session_id": "s", "turn_num": 1})
+        pending = langfuse_hook.pending_queue()
+        for n in (2, 3):
+            pending.append({"session_id": "s", "turn_num": n})
+        assert langfuse_hook.SegmentedQueue(tmp / "queue").segments() == []
+
+        entries = list(pending.entries())
+        assert [e["turn_num"] for e, _ in entries] == [1, 2, 3]
+        pending.ack(entries[1][1])
+        assert [e["turn_num"] for e, _ in pending.entries()] == [3]
+        assert langfuse_hook.state_db().execute("SELECT COUNT(*) FROM pending_turns").fetchone()[0] == 1
+
+    print("✓ SQLite store tests passed")
+
+
+def test_single_flight():
+    """Test that a run finding the lock busy hands its payload over, and the active run picks it up."""
+    tmp = Path(tempfile.mkdtemp())
+    payload = {"session_id": "s2", "transcript_path": "/tmp/s2.jsonl"}
+    runs = []
+
+    def fake_run(payloads, resources=None, budget=None, metrics=None):
+        runs.append(payloads)
+        if len(runs) == 1:
+            # Another invocation arrives while this run is working
+            langfuse_hook.mark_dirty(payload)
+
+    with patch.object(langfuse_hook, "LOCK_FILE", tmp / "hook.lock"), \
+            patch.object(langfuse_hook, "DIRTY_FILE", tmp / "dirty.jsonl"), \
+            patch.object(langfuse_hook, "run_hook", fake_run), \
+            patch.object(langfuse_hook, "read_hook_payload", return_value={"session_id": "s1"}), \
+            patch.dict("os.environ", {"TRACE_TO_LANGFUSE": "true"}):
+        lock = langfuse_hook.acquire_run_lock()
+        assert lock and langfuse_hook.acquire_run_lock() is None
+        try:
+            langfuse_hook.main()
+        except SystemExit:
+            pass
+        assert runs == [] and langfuse_hook.take_dirty() == [{"session_id": "s1"}]
+        langfuse_hook.release_run_lock(lock)
+
+        try:
+            langfuse_hook.main()
+        except SystemExit:
+            pass
+        assert runs == [[{"session_id": "s1"}], [payload]]
+        assert not langfuse_hook.dirty_pending()
+
+    print("✓ Single-flight run lock tests passed")
+
+
+def test_circuit_breaker():
+    """Test that a failed probe opens the breaker, backs off exponentially, and a success closes it."""
+    index = {"files": {}}
+    with patch.object(langfuse_hook, "check_langfuse_health", return_value=False) as probe:
+        assert not langfuse_hook.backend_reachable(index, "langfuse", "http://localhost:3050")
+        assert not langfuse_hook.backend_reachable(index, "langfuse", "http://localhost:3050")
+        assert probe.call_count == 1  # open: no probe at all
+        breaker = index["backends"]["langfuse"]
+        assert breaker["failures"] == 1 and breaker["retry_at"] - time.time() > 25
+
+        # Half-open probe fails: the backoff doubles
+        breaker["retry_at"] = 0
+        assert not langfuse_hook.backend_reachable(index, "langfuse", "http://localhost:3050")
+        assert probe.call_count == 2 and index["backends"]["langfuse"]["failures"] == 2
+        assert index["backends"]["langfuse"]["retry_at"] - time.time() > 55
+
+    index["backends"]["langfuse"]["retry_at"] = 0
+    with patch.object(langfuse_hook, "check_langfuse_health", return_value=True):
+        assert langfuse_hook.backend_reachable(index, "langfuse", "http://localhost:3050")
+    assert index["backends"] == {}
+
+    print("✓ Circuit breaker tests passed")
+
+
+def test_daemon_client():
+    """Test the thin client hands payloads to a listening daemon and falls back when none is running."""
+    import socket
+    import threading
+
+    tmp = Path(tempfile.mkdtemp(dir="/tmp"))  # short path: Unix socket paths are length-limited
+    sock_path = tmp / "hook.sock"
+    received = []
+
+    with patch.object(langfuse_hook, "DAEMON_SOCKET", sock_path):
+        assert not langfuse_hook.send_to_daemon({"session_id": "s1"})
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(str(sock_path))
+        server.listen(1)
+
+        def serve_one():
+            conn, _ = server.accept()
+            with conn:
+                received.append(json.loads(conn.recv(65536)))
+                conn.sendall(b"ok\n")
+
+        thread = threading.Thread(target=serve_one)
+        thread.start()
+        assert langfuse_hook.send_to_daemon({"session_id": "s1", "transcript_path": "/tmp/s1.jsonl"})
+        thread.join()
+        server.close()
+        assert received == [{"session_id": "s1", "transcript_path": "/tmp/s1.jsonl"}]
+
+        # Stale socket file with nobody listening: fall back to running in-process
+        assert not langfuse_hook.send_to_daemon({"session_id": "s1"})
+
+    print("✓ Daemon client tests passed")
+
+
+def test_hook_resources_cache():
+    """Test that warm resources keep state in memory until another process changes the files."""
+    tmp = Path(tempfile.mkdtemp())
+    with patch.object(langfuse_hook, "STATE_FILE", tmp / "state.json"), \
+            patch.object(langfuse_hook, "INDEX_FILE", tmp / "index.json"):
+        resources = langfuse_hook.HookResources()
+        state, index = resources.load()
+        state["s1"] = {"offset": 1}
+        langfuse_hook.save_state(state)
+        resources.saved()
+        assert resources.load()[0] is state
+
+        (tmp / "state.json").write_text(json.dumps({"s1": {"offset": 99}}))
+        assert resources.load()[0] == {"s1": {"offset": 99}}
+
+    print("✓ HookResources cache tests passed")
+
+
+def test_spawn_detached():
+    """Test that the export worker runs in its own session and the hook returns without waiting for it."""
+    marker = Path(tempfile.mkdtemp()) / "worker.json"
+
+    def worker():
+        time.sleep(0.3)
+        tmp = marker.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"pid": os.getpid(), "sid": os.getsid(0)}))
+        tmp.replace(marker)
+
+    start = time.perf_counter()
+    assert langfuse_hook.spawn_detached(worker)
+    assert time.perf_counter() - start < 0.3 and not marker.exists()
+
+    deadline = time.time() + 5
+    while not marker.exists() and time.time() < deadline:
+        time.sleep(0.05)
+    info = json.loads(marker.read_text())
+    assert info["pid"] != os.getpid() and info["sid"] != os.getsid(0)
+
+    print("✓ Detached worker tests passed")
+
+
+def test_run_budget():
+    """Test that a spent run budget stops between turns and hands the rest to the next run."""
+    tmp = Path(tempfile.mkdtemp())
+    lines = []
+    for n in (1, 2, 3):
+        lines.append({"type": "user", "message": {"role": "user", "content": f"q{n}"}})
+        lines.append({"type": "assistant", "message": {"id": f"a{n}", "stop_reason": "end_turn", "content": f"r{n}"}})
+    transcript = tmp / "sess.jsonl"
+    transcript.write_text("".join(json.dumps(line) + "\n" for line in lines))
+    other = tmp / "other.jsonl"
+    other.write_text(transcript.read_text().replace('"q', '"other q'))
+
+    def spent_budget():
+        budget = langfuse_hook.RunBudget()
+        budget.deadline = time.monotonic()
+        return budget
+
+    exported = []
+    state = {}
+    with patch.object(langfuse_hook, "save_state"):
+        budget = spent_budget()
+        assert langfuse_hook.process_transcript("sess", transcript, state, trace_creators=[("t", exported.append)], budget=budget) == 1
+        assert budget.exhausted and state["sess"]["turn_count"] == 1 and "assembler" in state["sess"]
+        assert langfuse_hook.process_transcript("sess", transcript, state, trace_creators=[("t", exported.append)]) == 2
+    assert [(t.turn_num, t.user_text) for t in exported] == [(1, "q1"), (2, "q2"), (3, "q3")]
+
+    # A checkpoint is saved only after sync() has flushed the turns it covers
+    events = []
+    with patch.object(langfuse_hook, "save_session", lambda state, session_id: events.append("save")):
+        langfuse_hook.process_transcript("sess", transcript, {}, trace_creators=[("t", lambda turn: events.append("turn"))],
+                                         sync=lambda: events.append("sync"))
+    assert events == ["turn", "turn", "turn", "sync", "save"]
+
+    # Export workers don't outlive the run: a backend still hung at the deadline is
+    # abandoned and every turn it hadn't flushed is handed back for the queue
+    import threading
+    release = threading.Event()
+    hung = langfuse_hook.BackendWorker("hung", lambda turn: release.wait(), maxsize=1)
+    fanout = langfuse_hook.ExportFanout([hung], deadline=time.monotonic() + 0.2)
+    start = time.perf_counter()
+    for turn in exported:
+        fanout.submit(turn)
+    fanout.close()
+    assert time.perf_counter() - start < 1
+    assert hung.abandoned and (hung.exported, hung.failed) == (0, 3)
+    assert [entry["turn_num"] for entry in hung.take_undelivered()] == [1, 2, 3]
+    release.set()
+
+    with patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"), \
+            patch.object(langfuse_hook, "QUEUE_FILE", tmp / "legacy.jsonl"):
+        for turn in exported:
+            langfuse_hook.queue_turn(turn)
+        assert langfuse_hook.drain_queue([("t", lambda turn: None)], budget=spent_budget()) == 0
+        assert langfuse_hook.drain_queue([("t", lambda turn: None)]) == 3
+
+    # A run out of budget leaves the cut-short and the untouched transcript in the dirty file
+    payloads = [{"session_id": "sess", "transcript_path": str(transcript)},
+                {"session_id": "other", "transcript_path": str(other)}]
+    with patch.object(langfuse_hook, "STATE_FILE", tmp / "state.json"), \
+            patch.object(langfuse_hook, "INDEX_FILE", tmp / "index.json"), \
+            patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue2"), \
+            patch.object(langfuse_hook, "QUEUE_FILE", tmp / "legacy.jsonl"), \
+            patch.object(langfuse_hook, "DIRTY_FILE", tmp / "dirty.jsonl"), \
+            patch.object(langfuse_hook, "PROJECTS_DIR", tmp / "projects"), \
+            patch.object(langfuse_hook, "LANGFUSE_EXPORTER", "ingestion"), \
+            patch.object(langfuse_hook, "backend_reachable", return_value=False), \
+            patch.dict("os.environ", {"TRACE_TO_LANGFUSE": "true", "LANGFUSE_PUBLIC_KEY": "pk", "LANGFUSE_SECRET_KEY": "sk"}):
+        langfuse_hook.run_hook(payloads, budget=spent_budget())
+        assert langfuse_hook.take_dirty() == [dict(payload, backlog=True) for payload in payloads]
+        assert len(list(langfuse_hook.pending_queue().entries())) == 1
+        assert langfuse_hook.load_index()["files"][str(transcript)]["size"] is None
+
+        langfuse_hook.run_hook([dict(payload, backlog=True) for payload in payloads])
+        assert langfuse_hook.take_dirty() == []
+        assert len(list(langfuse_hook.pending_queue().entries())) == 6
+
+    # A healthy backend still sends what it was handed when the budget runs out
+    class SlowResponse:
+        def read(self):
+            time.sleep(0.2)
+            return b'{"successes": [], "errors": []}'
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    with patch.object(langfuse_hook, "STATE_FILE", tmp / "state3.json"), \
+            patch.object(langfuse_hook, "INDEX_FILE", tmp / "index3.json"), \
+            patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue3"), \
+            patch.object(langfuse_hook, "QUEUE_FILE", tmp / "legacy.jsonl"), \
+            patch.object(langfuse_hook, "DIRTY_FILE", tmp / "dirty3.jsonl"), \
+            patch.object(langfuse_hook, "PROJECTS_DIR", tmp / "projects"), \
+            patch.object(langfuse_hook, "LANGFUSE_EXPORTER", "ingestion"), \
+            patch.object(langfuse_hook, "backend_reachable", return_value=True), \
+            patch("urllib.request.urlopen", return_value=SlowResponse()) as urlopen, \
+            patch.dict("os.environ", {"TRACE_TO_LANGFUSE": "true", "TRACE_TO_GRAFANA": "false",
+                                      "LANGFUSE_PUBLIC_KEY": "pk", "LANGFUSE_SECRET_KEY": "sk"}):
+        langfuse_hook.run_hook(payloads[:1], budget=spent_budget())
+        assert urlopen.call_count == 1
+        assert list(langfuse_hook.pending_queue().entries()) == []
+        assert langfuse_hook.load_state()["sess"]["turn_count"] == 1
+
+    print("✓ Run budget tests passed")
+
+
+def test_backlog_scheduler():
+    """Test that every modified transcript is found and the backlog is ranked by lag (bytes × waiting time)."""
+    tmp = Path(tempfile.mkdtemp())
+    project_dir = tmp / "-Users-alice-my-app"
+    project_dir.mkdir()
+    for n in range(12):
+        (project_dir / f"s{n}.jsonl").write_text(json.dumps({"sessionId": f"s{n}", "type": "user"}) + "\n")
+    with open(project_dir / "s0.jsonl", "a") as f:
+        f.write(json.dumps({"type": "assistant", "message": {"content": "x" * 100_000}}) + "\n")  # big, but only just noticed
+
+    index = {"files": {}}
+    with patch.object(langfuse_hook, "PROJECTS_DIR", tmp):
+        found = langfuse_hook.find_modified_transcripts({}, index=index)
+    assert len(found) == 12
+
+    old = str(project_dir / "s5.jsonl")
+    index["files"][old]["pending_since"] = time.time() - 3600
+    ranked = langfuse_hook.rank_backlog(found, {}, index)
+    assert [t[0] for t in ranked[:2]] == ["s5", "s0"]
+    # Bytes already exported don't count as lag
+    ranked = langfuse_hook.rank_backlog(found, {"s5": {"offset": 10**6}}, index)
+    assert ranked[0][0] == "s0"
+    assert "s5" in langfuse_hook.format_lag(ranked[-1:], {}, index)
+
+    langfuse_hook.mark_transcript_processed(index, Path(old))
+    assert "pending_since" not in index["files"][old]
+
+    # Shares split the time left; spending one leaves the run budget intact
+    budget = langfuse_hook.RunBudget(10)
+    share = budget.share(4)
+    assert 2 < share.deadline - time.monotonic() <= 2.5
+    share.deadline = time.monotonic()
+    assert share.expired() and not budget.expired()
+    assert langfuse_hook.RunBudget(0).share(4).deadline is None
+
+    print("✓ Backlog scheduler tests passed")
+
+
+def test_per_backend_delivery():
+    """Test that each backend has its own queue offset and failed turns are retried only where they failed."""
+    tmp = Path(tempfile.mkdtemp())
+    turns = [langfuse_hook.Turn("sess", n, "my-app", f"q{n}", "a", "m", []) for n in range(1, 4)]
+    delivered = {"langfuse": [], "grafana": []}
+    creators = {name: (name, lambda turn, _name=name: delivered[_name].append(turn.turn_num)) for name in delivered}
+    both = ("langfuse", "grafana")
+
+    with patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"), \
+            patch.object(langfuse_hook, "QUEUE_FILE", tmp / "legacy.jsonl"):
+        langfuse_hook.queue_turn(turns[0])
+        langfuse_hook.queue_turn(turns[1], ["grafana"])
+        langfuse_hook.queue_turn(turns[2], both)
+
+        # Grafana is down: Langfuse gets what it is owed, Grafana's offset stays put
+        assert langfuse_hook.drain_queue([creators["langfuse"]], consumers=both) == 2
+        assert langfuse_hook.drain_queue([creators["langfuse"]], consumers=both) == 0
+        assert langfuse_hook.pending_queue(both).segments()
+        assert langfuse_hook.drain_queue([creators["langfuse"], creators["grafana"]], consumers=both) == 3
+        assert delivered == {"langfuse": [1, 3], "grafana": [1, 2, 3]}
+        assert not (tmp / "queue").exists() or not list((tmp / "queue").iterdir())
+
+        # A turn a backend fails to receive is queued for that backend alone
+        def flaky(turn):
+            if turn.turn_num == 2:
+                raise ConnectionError("down")
+
+        worker = langfuse_hook.BackendWorker("grafana", flaky)
+        worker.start()
+        for turn in turns:
+            worker.submit(turn)
+        worker.close()
+        worker.join()
+        assert (worker.exported, worker.failed) == (2, 1)
+        assert [(e["turn_num"], e["backends"]) for e in worker.take_undelivered()] == [(2, ["grafana"])]
+
+    # The ingestion exporter hands back the turns of a batch that failed to send
+    exporter = langfuse_hook.LangfuseIngestionExporter("http://lf", "pk", "sk")
+    exporter.export(turns[0])
+    with patch("urllib.request.urlopen", side_effect=OSError("refused")):
+        assert not exporter.flush()
+    assert exporter.take_undelivered() == [turns[0]] and exporter.take_undelivered() == []
+
+    # So does the OTLP exporter, for the turns whose span batch failed to send
+    from types import SimpleNamespace
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+
+    def export_spans(spans):
+        return SimpleNamespace(value=1 if any(span.attributes.get("turn.number") == 2 for span in spans) else 0)
+
+    otel_exporter = MagicMock(export=export_spans)
+    with patch("opentelemetry.sdk.trace.export.BatchSpanProcessor", lambda exporter, **kw: SimpleSpanProcessor(exporter)), \
+            patch("opentelemetry.exporter.otlp.proto.http.trace_exporter.OTLPSpanExporter", lambda **kw: otel_exporter):
+        otel = langfuse_hook.init_otel_providers("http://127.0.0.1:9", "i", "t")
+    exporter = langfuse_hook.OtelTurnExporter(otel[:2] + (None, MagicMock(), otel[4]))
+    for turn in turns:
+        exporter.export(turn)
+    assert not exporter.flush()
+    assert exporter.take_undelivered() == [turns[1]] and exporter.take_undelivered() == []
+    otel[1].shutdown()
+    otel[3].shutdown()
+
+    print("✓ Per-backend delivery tests passed")
+
+
+def test_retention_queue_cursors():
+    """Test that retention moves every owed backend past old entries, including one that never acked."""
+    sys.path.insert(0, str(Path(__file__).parent.parent / "scripts"))
+    import retention
+
+    tmp = Path(tempfile.mkdtemp())
+    both = ("langfuse", "grafana")
+    pending = langfuse_hook.SegmentedQueue(tmp / "queue", segment_bytes=200, consumers=both)
+    for n in range(1, 5):
+        pending.append({"turn_num": n, "backends": ["grafana"] if n % 2 else list(both), "queued_at": "2020-01-01T00:00:00+00:00"})
+    pending.append({"turn_num": 5, "backends": ["grafana"], "queued_at": datetime.now(timezone.utc).isoformat()})
+
+    # Grafana has been down all along (no ack-grafana.json); Langfuse drained everything
+    *_, (_, last) = pending.entries()
+    pending.ack(last, ["langfuse"])
+    assert not (tmp / "queue" / "ack-grafana.json").exists()
+
+    with patch.object(retention, "QUEUE_DIR", tmp / "queue"), patch.dict(os.environ, {"TRACE_TO_GRAFANA": ""}):
+        assert retention.prune_segmented_queue(datetime.now(timezone.utc) - timedelta(days=1), dry_run=True) == 4
+        assert not (tmp / "queue" / "ack-grafana.json").exists()
+        assert retention.prune_segmented_queue(datetime.now(timezone.utc) - timedelta(days=1), dry_run=False) == 4
+    assert (tmp / "queue" / "ack-grafana.json").exists()
+    assert len(pending.segments()) == 1
+    assert [e["turn_num"] for e, _ in pending.entries()] == [5]
+
+    print("✓ Retention queue cursor tests passed")
+
+
+def test_deterministic_ids():
+    """Test that trace and span IDs derive from the turn, so re-exports upsert instead of duplicating."""
+    from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+    from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+
+    tool_calls = [langfuse_hook.ToolCall("toolu_1", "Read", {}, "x"), langfuse_hook.ToolCall("", "Bash", {}, "y")]
+    turn = langfuse_hook.Turn("sess", 7, "my-app", "q", "a", "m", tool_calls)
+    again = langfuse_hook.Turn.from_dict(json.loads(json.dumps(turn.to_dict())))
+    assert turn.trace_id == again.trace_id and len(turn.trace_id) == 32
+    assert turn.trace_id != langfuse_hook.Turn("sess", 8, "", "q", "a", "m", []).trace_id
+    span_ids = [turn.span_id("turn"), turn.span_id("response"), *turn.tool_span_ids()]
+    assert len(set(span_ids)) == 4 and all(len(span_id) == 16 for span_id in span_ids)
+
+    # Ingestion API: same event and object IDs on every export of the turn
+    events = langfuse_hook.LangfuseIngestionExporter._turn_events(turn)
+    replay = langfuse_hook.LangfuseIngestionExporter._turn_events(again)
+    assert [(e["id"], e["body"]["id"]) for e in events] == [(e["id"], e["body"]["id"]) for e in replay]
+    assert [e["body"]["id"] for e in events] == [turn.trace_id, *span_ids]
+
+    # The SDK picks its own observation IDs, so turns replayed from the queue go through the ingestion API
+    client, ingestion = MagicMock(), MagicMock()
+    sdk = langfuse_hook.LangfuseSdkExporter(client, ingestion)
+    replayed = langfuse_hook.turn_from_queue_entry(turn.to_dict())
+    sdk.export(turn)
+    sdk.export(replayed)
+    assert replayed.replay and not turn.replay
+    assert client.start_as_current_span.call_count == 1 + len(tool_calls)  # one export: root and tool spans
+    assert [c.args for c in ingestion.export.call_args_list] == [(replayed,)]
+
+    # OTEL: the provider's id generator hands the turn's IDs to the SDK; other spans stay random
+    memory = InMemorySpanExporter()
+    with patch("opentelemetry.sdk.trace.export.BatchSpanProcessor", lambda exporter, **kw: SimpleSpanProcessor(memory)):
+        tracer, trace_provider, _, log_provider, _ = langfuse_hook.init_otel_providers("http://127.0.0.1:9", "i", "t")
+    langfuse_hook.create_otel_trace(tracer, turn)
+    langfuse_hook.create_otel_trace(tracer, again)
+    with tracer.start_as_current_span("unrelated"):
+        pass
+    spans = memory.get_finished_spans()
+    first = sorted((format(s.context.trace_id, "032x"), format(s.context.span_id, "016x")) for s in spans[:4])
+    second = sorted((format(s.context.trace_id, "032x"), format(s.context.span_id, "016x")) for s in spans[4:8])
+    assert first == second == sorted((turn.trace_id, span_id) for span_id in span_ids)
+    assert format(spans[8].context.trace_id, "032x") != turn.trace_id
+    trace_provider.shutdown()
+    log_provider.shutdown()
+
+    print("✓ Deterministic ID tests passed")
+
+
+def test_backfill():
+    """Test that the backfill exports every unexported transcript from a process pool, once, and records progress."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import threading
+
+    traces = []
+
+    class Ingestion(BaseHTTPRequestHandler):
+        def do_POST(self):
+            batch = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["batch"]
+            traces.extend(e["body"]["id"] for e in batch if e["type"] == "trace-create")
+            self.send_response(207)
+            self.end_headers()
+            self.wfile.write(b'{"successes": [], "errors": []}')
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Ingestion)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    tmp = Path(tempfile.mkdtemp())
+    project = tmp / "projects" / "-Users-me-app"
+    project.mkdir(parents=True)
+    for session_id, count in (("s1", 3), ("s2", 2), ("s3", 4)):
+        lines = []
+        for n in range(count):
+            lines.append({"sessionId": session_id, "type": "user", "message": {"role": "user", "content": f"q{n}"}})
+            lines.append({"type": "assistant", "message": {"id": f"{session_id}{n}", "stop_reason": "end_turn", "content": "r"}})
+        transcript = project / f"{session_id}.jsonl"
+        transcript.write_text("".join(json.dumps(line) + "\n" for line in lines))
+        os.utime(transcript, (time.time() - 3600, time.time() - 3600))
+
+    with patch.object(langfuse_hook, "STATE_FILE", tmp / "state.json"), \
+            patch.object(langfuse_hook, "INDEX_FILE", tmp / "index.json"), \
+            patch.object(langfuse_hook, "LOCK_FILE", tmp / "hook.lock"), \
+            patch.object(langfuse_hook, "DIRTY_FILE", tmp / "dirty.jsonl"), \
+            patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"), \
+            patch.object(langfuse_hook, "PROJECTS_DIR", tmp / "projects"), \
+            patch.object(langfuse_hook, "LANGFUSE_EXPORTER", "ingestion"), \
+            patch.dict("os.environ", {"TRACE_TO_LANGFUSE": "true", "TRACE_TO_GRAFANA": "false",
+                                      "LANGFUSE_HOST": f"http://127.0.0.1:{server.server_port}",
+                                      "LANGFUSE_PUBLIC_KEY": "pk", "LANGFUSE_SECRET_KEY": "sk"}):
+        assert langfuse_hook.run_backfill(processes=2, rate=0, shard_bytes=1) == 0
+        assert len(traces) == len(set(traces)) == 9
+        state, index = langfuse_hook.load_state(), langfuse_hook.load_index()
+        assert [state[session_id]["turn_count"] for session_id in ("s1", "s2", "s3")] == [3, 2, 4]
+        assert all(entry["offset"] == entry["size"] for entry in index["files"].values())
+
+        # Resuming finds nothing left to export
+        assert langfuse_hook.run_backfill(processes=2, rate=0) == 0
+        assert len(traces) == 9 and not (tmp / "queue").exists()
+    server.shutdown()
+
+    # The token bucket paces all takers to the rate after an initial burst of one second's worth
+    limiter = langfuse_hook.RateLimiter(100)
+    start = time.monotonic()
+    for _ in range(120):
+        limiter.acquire()
+    assert 0.15 < time.monotonic() - start < 1
+
+    print("✓ Backfill tests passed")
+
+
+def test_buffered_log():
+    """Test that log lines are buffered until flushed or full, and a full log is rotated by renaming."""
+    langfuse_hook.flush_log()
+    log_file = Path(tempfile.mkdtemp()) / "hook.log"
+    with patch.object(langfuse_hook, "LOG_FILE", log_file), \
+            patch.object(langfuse_hook, "LOG_BUFFER_BYTES", 1000), \
+            patch.object(langfuse_hook, "LOG_ROTATE_BYTES", 2000):
+        langfuse_hook.log("INFO", "first")
+        assert not log_file.exists()
+        langfuse_hook.flush_log()
+        assert log_file.read_text().endswith("[INFO] first\n")
+
+        # Past LOG_BUFFER_BYTES the buffer is written out without an explicit flush
+        for n in range(20):
+            langfuse_hook.log("INFO", f"line {n} " + "x" * 40)
+        assert "line 10" in log_file.read_text() and "line 19" not in log_file.read_text()
+
+        # Past LOG_ROTATE_BYTES the file moves to .1 (and .1 to .2); the oldest segment is dropped
+        for n in range(200):
+            langfuse_hook.log("INFO", f"more {n} " + "x" * 40)
+        langfuse_hook.flush_log()
+        segments = sorted(p.name for p in log_file.parent.iterdir())
+        assert segments == ["hook.log", "hook.log.1", "hook.log.2"]
+        assert all(p.stat().st_size <= 2000 for p in log_file.parent.iterdir())
+        assert log_file.read_text().endswith("more 199 " + "x" * 40 + "\n")
+        assert "first" not in "".join(p.read_text() for p in log_file.parent.iterdir())
+
+    print("✓ Buffered log tests passed")
+
+
+def test_run_metrics():
+    """Test that each run appends one JSON record with per-phase timings and counters."""
+    tmp = Path(tempfile.mkdtemp())
+    lines = [
+        {"sessionId": "sess", "type": "user", "message": {"role": "user", "content": "q1"}},
+        {"type": "assistant", "message": {"id": "a1", "stop_reason": "tool_use", "content": [
+            {"type": "tool_use", "id": "t1", "name": "Read", "input": {}}]}},
+        {"type": "user", "message": {"role": "user", "content": [{"type": "tool_result", "tool_use_id": "t1", "content": "x"}]}},
+        {"type": "assistant", "message": {"id": "a2", "stop_reason": "end_turn", "content": "r1"}},
+        {"type": "user", "message": {"role": "user", "content": "q2"}},
+        {"type": "assistant", "message": {"id": "a3", "stop_reason": "end_turn", "content": "r2"}},
+    ]
+    transcript = tmp / "sess.jsonl"
+    transcript.write_text("".join(json.dumps(line) + "\n" for line in lines))
+
+    class FakeResponse:
+        def read(self):
+            return b'{"successes": [], "errors": []}'
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+    metrics_file = tmp / "metrics.jsonl"
+    with patch.object(langfuse_hook, "STATE_FILE", tmp / "state.json"), \
+            patch.object(langfuse_hook, "INDEX_FILE", tmp / "index.json"), \
+            patch.object(langfuse_hook, "LOCK_FILE", tmp / "hook.lock"), \
+            patch.object(langfuse_hook, "DIRTY_FILE", tmp / "dirty.jsonl"), \
+            patch.object(langfuse_hook, "QUEUE_DIR", tmp / "queue"), \
+            patch.object(langfuse_hook, "PROJECTS_DIR", tmp / "projects"), \
+            patch.object(langfuse_hook, "METRICS_FILE", metrics_file), \
+            patch.object(langfuse_hook, "LANGFUSE_EXPORTER", "ingestion"), \
+            patch.object(langfuse_hook, "backend_reachable", return_value=True), \
+            patch("urllib.request.urlopen", return_value=FakeResponse()), \
+            patch.dict("os.environ", {"TRACE_TO_LANGFUSE": "true", "TRACE_TO_GRAFANA": "false",
+                                      "LANGFUSE_PUBLIC_KEY": "pk", "LANGFUSE_SECRET_KEY": "sk"}):
+        payload = {"session_id": "sess", "transcript_path": str(transcript)}
+        assert langfuse_hook.run_single_flight([payload])
+        assert langfuse_hook.run_single_flight([payload])
+
+    first, second = [json.loads(line) for line in metrics_file.read_text().splitlines()]
+    for phase in ("discovery", "health_check", "read", "decode", "assemble", "dispatch",
+                  "export.langfuse", "flush.langfuse", "state_save"):
+        assert phase in first["phases"], phase
+    assert first["duration"] >= sum(first["phases"][p] for p in ("discovery", "read", "decode", "assemble"))
+    counters = first["counters"]
+    assert (counters["turns"], counters["turns.langfuse"], counters["spans.langfuse"]) == (2, 2, 5)
+    assert (counters["lines"], counters["bytes_read"]) == (6, transcript.stat().st_size)
+    assert counters["http_requests.langfuse"] == 1 and counters["bytes_sent.langfuse"] > 0
+    # An unchanged transcript still gets a record, with nothing read
+    assert "turns" not in second["counters"] and "read" not in second["phases"]
+
+    print("✓ Run metrics tests passed")
+
+
 if __name__ == "__main__":
     test_extract_project_name()
     test_get_content()
     test_get_text_content()
     test_is_tool_result()
     test_merge_assistant_parts()
+    test_find_modified_transcripts_index()
+    test_payload_fast_path()
+    test_transcript_reader()
+    test_turn_assembler()
+    test_turn_assembler_checkpoint()
+    test_build_turn()
+    test_ingestion_exporter_batches()
+    test_otlp_batching()
+    test_export_fanout()
+    test_segmented_queue()
+    test_drain_queue()
+    test_queue_by_reference()
+    test_sqlite_store()
+    test_single_flight()
+    test_circuit_breaker()
+    test_daemon_client()
+    test_hook_resources_cache()
+    test_spawn_detached()
+    test_run_budget()
+    test_backlog_scheduler()
+    test_per_backend_delivery()
+    test_retention_queue_cursors()
+    test_deterministic_ids()
+    test_backfill()
+    test_buffered_log()
+    test_run_metrics()
     print("\nAll unit tests passed!")
@@ -10,7 +10,7 @@ bash -n scripts/install-hook.sh
 echo "✓ Shell scripts valid"
 
 echo "=== Validating Python hook ==="
-python3 -m py_compile hooks/langfuse_hook.py
+python3 -m py_compile hooks/langfuse_hook.py hooks/langfuse_hook_core.py
 echo "✓ Python hook valid"
 
 echo "=== Validating docker-compose.yml ==="